@@ -0,0 +1,101 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+
+import bossdata
+import enemystats
+import freespace
+import randoconfig as cfg
+import roboribbon
+import statcompute
+import techdb
+
+
+# Snapshots of the rom right before the Randomizer builds its RandoConfig.
+# Everything up to that point (the always-on patches, the flag dependent
+# patches, robo's ribbon, parsing the config) only depends on the input rom
+# and which patches get applied.  A snapshot stores the patched image, the
+# free space map and the parsed RandoConfig so that the next seed with the
+# same inputs loads them from disk instead.
+#
+# Snapshots are keyed on a hash of the rom, the patch files used and the
+# code that builds the config.  Bump snapshot_version when the start up
+# sequence changes in a way the key does not see.
+snapshot_version = 1
+
+# Modules whose code decides what ends up in a snapshot
+_snapshot_modules = [
+    bossdata, cfg, enemystats, freespace, roboribbon, statcompute, techdb
+]
+
+
+class BaseSnapshot:
+
+    def __init__(self, rom_state, config: cfg.RandoConfig):
+        # From FSRom.get_state()
+        self.rom_state = rom_state
+        self.config = config
+
+
+def get_snapshot_key(rom: bytes, patch_files: list[str]) -> str:
+    hasher = hashlib.sha1()
+    hasher.update(f"snapshot v{snapshot_version}\0".encode('utf-8'))
+    hasher.update(hashlib.sha1(rom).digest())
+
+    for filename in patch_files:
+        hasher.update(os.path.basename(filename).encode('utf-8') + b'\0')
+        with open(filename, 'rb') as infile:
+            hasher.update(hashlib.sha1(infile.read()).digest())
+
+    # Frozen builds may not ship the sources.  The version still counts.
+    for module in _snapshot_modules:
+        try:
+            with open(module.__file__, 'rb') as infile:
+                hasher.update(hashlib.sha1(infile.read()).digest())
+        except (AttributeError, TypeError, OSError):
+            hasher.update(module.__name__.encode('utf-8'))
+
+    return hasher.hexdigest()
+
+
+def get_snapshot_filename(snapshot_dir: str, key: str) -> str:
+    return os.path.join(snapshot_dir, key + '.snapshot')
+
+
+# Returns None when there is no usable snapshot for the key.
+def load_snapshot(snapshot_dir: str, key: str) -> BaseSnapshot:
+    filename = get_snapshot_filename(snapshot_dir, key)
+
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, 'rb') as infile:
+            snapshot = pickle.load(infile)
+    except (OSError, pickle.UnpicklingError, EOFError,
+            AttributeError, ImportError):
+        print(f"Warning: Ignoring unreadable snapshot {filename}")
+        return None
+
+    if not isinstance(snapshot, BaseSnapshot):
+        return None
+
+    return snapshot
+
+
+def save_snapshot(snapshot_dir: str, key: str, snapshot: BaseSnapshot):
+    filename = get_snapshot_filename(snapshot_dir, key)
+
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated snapshot behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            pickle.dump(snapshot, outfile, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_filename, filename)
+    except (OSError, pickle.PicklingError) as err:
+        print(f"Warning: Unable to save snapshot {filename}: {err}")
@@ -0,0 +1,515 @@
+# Timing harnesses for the rom manipulation code.  Run from the sourcefiles
+# directory:
+#     python benchmarks.py <benchmark name> [rom_file]
+# The rom defaults to ./roms/ct.sfc like the rest of the test mains.
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+from ctdecompress import compress, decompress, decompress_bytewise, \
+    get_compressed_length, CompressMode
+from ctevent import Event, get_loc_event_ptr
+from eventcache import load_event_cache
+from eventcommand import get_command, get_command_length, decode_command
+from eventquery import EventQueryIndex
+from freespace import FreeSpace, IndexedFreeSpace, FSRom
+from patchbundle import compile_patches
+from weightedsampler import WeightedSampler
+import logicfactory
+import logicwriter_chronosanity
+import randoconfig as cfg
+import randosettings as rset
+
+
+# Location ids run from 0x000 to 0x1EF.  Many locations share a script, so
+# return each distinct event pointer once.
+def get_location_event_ptrs(rom) -> list[int]:
+    ptrs = dict()
+    for loc_id in range(0x1F0):
+        ptr = get_loc_event_ptr(rom, loc_id)
+        ptrs.setdefault(ptr, loc_id)
+
+    return list(ptrs.keys())
+
+
+def bench_compress(rom):
+    ptrs = get_location_event_ptrs(rom)
+    scripts = [decompress(rom, ptr) for ptr in ptrs]
+
+    total_in = sum(len(x) for x in scripts)
+    total_orig = sum(get_compressed_length(rom, ptr) for ptr in ptrs)
+    total_out = 0
+
+    start = time.perf_counter()
+    for script in scripts:
+        total_out += len(compress(script))
+    elapsed = time.perf_counter() - start
+
+    print(f"Compressed {len(scripts)} location events "
+          f"({total_in:X} bytes) in {elapsed:.3f}s")
+    print(f"Throughput: {total_in/elapsed/1024:.1f} KB/s")
+    print(f"Compressed size: {total_out:X} (vanilla {total_orig:X})")
+
+
+# Compare the greedy and optimal parses on every location event.
+def bench_compress_modes(rom):
+    ptrs = get_location_event_ptrs(rom)
+    scripts = [decompress(rom, ptr) for ptr in ptrs]
+
+    total_size = {mode: 0 for mode in CompressMode}
+    total_time = {mode: 0 for mode in CompressMode}
+
+    print('Location   Decompressed   Greedy  Optimal   Saved')
+    for ptr, script in zip(ptrs, scripts):
+        sizes = dict()
+        for mode in CompressMode:
+            start = time.perf_counter()
+            sizes[mode] = len(compress(script, mode))
+            total_time[mode] += time.perf_counter() - start
+            total_size[mode] += sizes[mode]
+
+        greedy = sizes[CompressMode.GREEDY]
+        optimal = sizes[CompressMode.OPTIMAL]
+        print(f"{ptr:06X}     {len(script):12X} {greedy:8X} {optimal:8X} "
+              f"{greedy-optimal:7d}")
+
+    print()
+    for mode in CompressMode:
+        print(f"{mode.name:8s} total size {total_size[mode]:X}, "
+              f"time {total_time[mode]:.3f}s")
+
+    saved = total_size[CompressMode.GREEDY] - total_size[CompressMode.OPTIMAL]
+    extra_time = \
+        total_time[CompressMode.OPTIMAL] - total_time[CompressMode.GREEDY]
+    print(f"Optimal saves {saved} bytes for {extra_time:.3f}s of extra time")
+
+
+# Decompress every location event with the old and new decoders.  The
+# outputs must match exactly.
+def bench_decompress(rom):
+    ptrs = get_location_event_ptrs(rom)
+
+    start = time.perf_counter()
+    old_scripts = [decompress_bytewise(rom, ptr) for ptr in ptrs]
+    old_time = time.perf_counter() - start
+
+    out_buffer = bytearray(0x10000)
+    start = time.perf_counter()
+    new_scripts = [decompress(rom, ptr, out_buffer) for ptr in ptrs]
+    new_time = time.perf_counter() - start
+
+    mismatches = [ptr for ptr, old, new in zip(ptrs, old_scripts, new_scripts)
+                  if old != new]
+
+    total = sum(len(x) for x in new_scripts)
+    print(f"Decompressed {len(ptrs)} location events ({total:X} bytes)")
+    print(f"Bytewise: {old_time:.3f}s  Fast: {new_time:.3f}s")
+
+    if mismatches:
+        print('Error: Output differs for events at ' +
+              ', '.join(f"{ptr:06X}" for ptr in mismatches))
+    else:
+        print('All outputs match.')
+
+
+# The patches the randomizer can apply, in the order it applies them.
+patch_files = [
+    './patch.ips',
+    './patches/patch_codebase.txt',
+    './patches/fast_overworld_walk_patch.txt',
+    './patches/faster_epoch_patch.txt',
+    './patches/faster_menu_dpad.txt',
+    './patches/zeal_end_boss.txt',
+    './patches/lost.ips',
+    './patches/fast_charge_pendant.txt',
+    './patches/hard.ips',
+    './patches/save_anywhere_patch.txt',
+    './patches/unequip_patch.txt',
+    './patches/fadeout_patch.txt',
+    './patches/hp_overflow_patch.txt',
+]
+
+
+def apply_patch_files(fsrom: FSRom):
+    for filename in patch_files:
+        if filename.endswith('.ips'):
+            fsrom.patch_ips_file(filename)
+        else:
+            fsrom.patch_txt_file(filename)
+
+
+def mark_patch_files(spaceman: FreeSpace):
+    for filename in patch_files:
+        if filename.endswith('.ips'):
+            spaceman.mark_blocks_ips(filename)
+        else:
+            spaceman.mark_blocks_txt(filename)
+
+
+# Replay every patch marking on each free space backend.  This is done once
+# through FSRom writes on the rom (mostly used space) and once directly on an
+# empty 6MB map, which fragments much more.  The resulting block maps must
+# agree between backends.
+def bench_freespace(rom):
+
+    def replay_writes(space_manager_type):
+        fsrom = FSRom(bytes(rom), False, space_manager_type)
+        apply_patch_files(fsrom)
+        return fsrom.space_manager
+
+    def replay_marks(space_manager_type):
+        spaceman = space_manager_type(0x600000, True)
+        mark_patch_files(spaceman)
+        return spaceman
+
+    for replay in (replay_writes, replay_marks):
+        print(replay.__name__)
+        markers = []
+
+        for space_manager_type in (FreeSpace, IndexedFreeSpace):
+            start = time.perf_counter()
+            spaceman = replay(space_manager_type)
+            elapsed = time.perf_counter() - start
+
+            markers.append((spaceman.first_free, spaceman.markers))
+            print(f"\t{space_manager_type.__name__}: {elapsed:.3f}s, "
+                  f"{len(spaceman.markers)} markers")
+
+        if markers[0] == markers[1]:
+            print('\tBlock maps match.')
+        else:
+            print('\tError: Block maps differ.')
+
+
+# Apply the patch files one by one and as a precompiled bundle.
+def bench_bundle(rom):
+    start = time.perf_counter()
+    bundle = compile_patches(patch_files)
+    compile_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fsrom_files = FSRom(bytes(rom), False)
+    apply_patch_files(fsrom_files)
+    files_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fsrom_bundle = FSRom(bytes(rom), False)
+    fsrom_bundle.apply_bundle(bundle)
+    bundle_time = time.perf_counter() - start
+
+    print(f"Compiled {len(patch_files)} patches into "
+          f"{len(bundle.records)} records in {compile_time:.3f}s")
+    print(f"Patch files: {files_time:.3f}s  Bundle: {bundle_time:.3f}s")
+
+    files_spaceman = fsrom_files.space_manager
+    bundle_spaceman = fsrom_bundle.space_manager
+    if fsrom_files.getvalue() != fsrom_bundle.getvalue():
+        print('Error: Patched roms differ.')
+    elif files_spaceman.markers != bundle_spaceman.markers or \
+            files_spaceman.first_free != bundle_spaceman.first_free:
+        print('Error: Block maps differ.')
+    else:
+        print('Patched roms and block maps match.')
+
+
+# Decode every command of every location event three ways: full
+# EventCommands with their args read, (id, length, args) tuples, and lengths
+# only.  All three must walk the scripts the same way.
+def bench_decode(rom):
+    ptrs = get_location_event_ptrs(rom)
+
+    # Script data starts after the object count byte.  The commands start
+    # at object 0's first function.
+    scripts = []
+    for ptr in ptrs:
+        data = decompress(rom, ptr)[1:]
+        scripts.append((data, int.from_bytes(data[0:2], 'little')))
+
+    def walk_commands(data, start):
+        walk = []
+        pos = start
+        while pos < len(data):
+            cmd = get_command(data, pos)
+            walk.append((cmd.command, len(cmd), tuple(cmd.args)))
+            pos += len(cmd)
+        return walk
+
+    def walk_tuples(data, start):
+        walk = []
+        pos = start
+        while pos < len(data):
+            cmd = decode_command(data, pos)
+            walk.append(cmd)
+            pos += cmd[1]
+        return walk
+
+    def walk_lengths(data, start):
+        walk = []
+        pos = start
+        while pos < len(data):
+            cmd_len = get_command_length(data, pos)
+            walk.append(cmd_len)
+            pos += cmd_len
+        return walk
+
+    results = []
+    for walk in (walk_commands, walk_tuples, walk_lengths):
+        start = time.perf_counter()
+        result = [walk(data, start) for (data, start) in scripts]
+        elapsed = time.perf_counter() - start
+
+        num_commands = sum(len(x) for x in result)
+        print(f"{walk.__name__}: {num_commands} commands in {elapsed:.3f}s "
+              f"({num_commands/elapsed/1000:.1f}k commands/s)")
+        results.append(result)
+
+    lengths = [[x[1] for x in walk] for walk in results[0]]
+    if results[0] != results[1] or lengths != results[2]:
+        print('Error: Decoded commands differ.')
+    else:
+        print('All decodes match.')
+
+
+# Read every location's event from the rom and from an event cache file.
+# The events must match.
+def bench_event_cache(rom):
+    rom = bytes(rom)
+    loc_ids = range(0x1F0)
+
+    start = time.perf_counter()
+    events = [Event.from_rom_location(rom, loc_id) for loc_id in loc_ids]
+    rom_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        load_event_cache(cache_dir, 'bench', rom)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cache = load_event_cache(cache_dir, 'bench', rom)
+        cached_events = [Event.from_rom_location(rom, loc_id, cache=cache)
+                         for loc_id in loc_ids]
+        cache_time = time.perf_counter() - start
+
+        size = sum(os.path.getsize(os.path.join(cache_dir, x))
+                   for x in os.listdir(cache_dir))
+
+    print(f"Read {len(events)} location events")
+    print(f"From rom: {rom_time:.3f}s  Build cache: {build_time:.3f}s  "
+          f"From cache file: {cache_time:.3f}s")
+    print(f"Cache file size: {size:X}")
+    cache.print_stats()
+
+    mismatches = [
+        loc_id for loc_id, event, cached in zip(loc_ids, events, cached_events)
+        if (event.num_objects, event.data, event.strings) !=
+        (cached.num_objects, cached.data, cached.strings)
+    ]
+
+    if mismatches:
+        print('Error: Events differ at locations ' +
+              ', '.join(f"{loc_id:03X}" for loc_id in mismatches))
+    else:
+        print('All events match.')
+
+
+# Find every ChangeLocation of every location to each target location by
+# scanning the scripts with find_command and by querying an index.
+def bench_query(rom):
+    rom = bytes(rom)
+    loc_ids = range(0x1F0)
+    change_loc_cmds = [0xDC, 0xDD, 0xDE, 0xDF, 0xE0, 0xE1]
+
+    events = [Event.from_rom_location(rom, loc_id) for loc_id in loc_ids]
+
+    start = time.perf_counter()
+    scan_found = dict()
+    for (loc_id, event) in zip(loc_ids, events):
+        pos = event.get_object_start(0)
+        while True:
+            (pos, cmd) = event.find_command(change_loc_cmds, pos)
+            if pos is None:
+                break
+
+            target = cmd.args[0] & 0x1FF
+            scan_found.setdefault(target, []).append((loc_id, pos))
+            pos += len(cmd)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = EventQueryIndex.from_rom(rom)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    query_found = dict()
+    for target in loc_ids:
+        hits = index.find(change_loc_cmds, {0: target}, {0: 0x1FF})
+        if hits:
+            query_found[target] = [(hit.loc_id, hit.offset) for hit in hits]
+    query_time = time.perf_counter() - start
+
+    print(f"Indexed {len(index.hits)} commands in {build_time:.3f}s")
+    print(f"ChangeLocations to each of {len(loc_ids)} locations:")
+    print(f"Scan: {scan_time:.3f}s  Query: {query_time:.3f}s "
+          f"({query_time/len(loc_ids)*1e6:.1f}us per query)")
+
+    if scan_found != query_found:
+        print('Error: Scan and query results differ.')
+    else:
+        print('All results match.')
+
+
+# Place key items for a range of seeds with each flag combination and report
+# how hard the placement search had to work.
+def bench_placement(rom):
+    config = cfg.RandoConfig(rom)
+    num_seeds = 200
+
+    flag_sets = {
+        'Chronosanity': rset.GameFlags.CHRONOSANITY,
+        'Chronosanity+LC': (rset.GameFlags.CHRONOSANITY |
+                            rset.GameFlags.LOCKED_CHARS),
+        'Chronosanity+LW': (rset.GameFlags.CHRONOSANITY |
+                            rset.GameFlags.LOST_WORLDS),
+        'Normal+LC': rset.GameFlags.LOCKED_CHARS,
+    }
+
+    for (name, flags) in flag_sets.items():
+        settings = rset.Settings()
+        settings.gameflags = flags
+
+        nodes = backtracks = pruned = failures = 0
+        start = time.perf_counter()
+        for seed in range(num_seeds):
+            random.seed(seed)
+            game_config = logicfactory.getGameConfig(settings, config)
+            (success, _) = \
+                logicwriter_chronosanity.determineKeyItemPlacement(game_config)
+
+            stats = logicwriter_chronosanity.placementStats
+            nodes += stats.nodes
+            backtracks += stats.backtracks
+            pruned += stats.pruned
+            failures += not success
+        elapsed = time.perf_counter() - start
+
+        print(f"{name}: {num_seeds} seeds in {elapsed:.3f}s, "
+              f"{nodes} nodes, {backtracks} backtracks, {pruned} pruned, "
+              f"{failures} failures")
+
+
+# Draw from weights that change between draws (like location group decay)
+# with a linear scan and with a WeightedSampler.  The rom isn't used.
+def bench_sampler(rom):
+    num_draws = 20000
+
+    for size in (5, 25, 200, 2000):
+        rng = random.Random(size)
+        init_weights = [rng.randrange(1, 100) for i in range(size)]
+        changes = [(rng.randrange(size), rng.randrange(1, 100))
+                   for i in range(num_draws)]
+
+        random.seed(0)
+        weights = list(init_weights)
+        start = time.perf_counter()
+        scan_draws = []
+        for (ind, weight) in changes:
+            weights[ind] = weight
+            target = random.randrange(0, sum(weights))
+            value = 0
+            for (draw, weight) in enumerate(weights):
+                value += weight
+                if value > target:
+                    break
+            scan_draws.append(draw)
+        scan_time = time.perf_counter() - start
+
+        random.seed(0)
+        sampler = WeightedSampler(init_weights)
+        start = time.perf_counter()
+        sampler_draws = []
+        for (ind, weight) in changes:
+            sampler.set_weight(ind, weight)
+            sampler_draws.append(sampler.draw())
+        sampler_time = time.perf_counter() - start
+
+        result = 'match' if scan_draws == sampler_draws else 'DIFFER'
+        print(f"{size} weights, {num_draws} updates and draws: "
+              f"Scan: {scan_time:.3f}s  Sampler: {sampler_time:.3f}s  "
+              f"Draws {result}")
+
+
+# Write the config of the same seed serially and with the stages on
+# threads.  The configs must be identical.
+def bench_streams(rom):
+    # randomizer needs tkinter (through randomizergui), so only this
+    # benchmark imports it.
+    from randomizer import Randomizer
+
+    settings = rset.Settings.get_race_presets()
+    settings.seed = 'streams'
+
+    def write_config_hash(workers):
+        rando = Randomizer(rom[:], settings)
+        start = time.perf_counter()
+        rando.write_config(workers)
+        elapsed = time.perf_counter() - start
+        digest = hashlib.sha256(pickle.dumps(rando.config)).hexdigest()
+        return (elapsed, digest)
+
+    # Draws from the global random module must not matter either.
+    random.seed(1)
+    (serial_time, serial_hash) = write_config_hash(1)
+    print(f"Serial: {serial_time:.3f}s")
+
+    for workers in (4, 8):
+        random.seed(workers)
+        (parallel_time, parallel_hash) = write_config_hash(workers)
+        print(f"{workers} workers: {parallel_time:.3f}s")
+
+        if parallel_hash != serial_hash:
+            print(f"Error: The config with {workers} workers differs from "
+                  "the serial config.")
+            exit(1)
+
+    print('Configs match')
+
+
+benchmarks = {
+    'bundle': bench_bundle,
+    'compress': bench_compress,
+    'compress_modes': bench_compress_modes,
+    'decode': bench_decode,
+    'decompress': bench_decompress,
+    'event_cache': bench_event_cache,
+    'freespace': bench_freespace,
+    'placement': bench_placement,
+    'query': bench_query,
+    'sampler': bench_sampler,
+    'streams': bench_streams,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print('Usage: python benchmarks.py '
+              f"[{'|'.join(benchmarks.keys())}] [rom_file]")
+        exit()
+
+    rom_file = './roms/ct.sfc'
+    if len(sys.argv) > 2:
+        rom_file = sys.argv[2]
+
+    with open(rom_file, 'rb') as infile:
+        rom = bytearray(infile.read())
+
+    benchmarks[sys.argv[1]](rom)
+
+
+if __name__ == '__main__':
+    main()
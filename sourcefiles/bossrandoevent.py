@@ -20,6 +20,7 @@ from eventfunction import EventFunction as EF
 # from eventscript import get_location_script, get_loc_event_ptr
 from freespace import FreeSpace as FS
 from mapmangler import LocExits, duplicate_heckran_map, duplicate_location_data
+from patchanchors import LocationAnchors, find_load_enemy, find_show_pos
 
 import randosettings as rset
 import randoconfig as cfg
@@ -121,9 +122,8 @@ def set_magus_castle_flea_spot_boss(ctrom: CTRom, boss: BossScheme):
     def show_pos_fn(script: Event) -> int:
         # The location to insert is a bit before the second battle in this
         # function.  The easiest marker is a 'Mem.7F020C = 01' command.
-        # In bytes it is '7506'
-        pos = script.find_exact_command(EC.generic_one_arg(0x75, 0x06),
-                                        script.get_function_start(0xC, 0))
+        # In bytes it is '7506'.  See patchanchors.show_pos_markers.
+        pos = get_show_pos(ctrom, loc_id, script)
 
         if pos is None:
             print("Error finding show pos (flea spot)")
@@ -155,7 +155,9 @@ def set_magus_castle_slash_spot_boss(ctrom: CTRom, boss: BossScheme):
     # for one of the endings (I think?).  You really have to set both of them
     # to the boss you want, otherwise you're highly likely to hit graphics
     # limits.
-    set_object_boss(script, 0xC, boss.ids[0], boss.slots[0])
+    anchors = ctrom.get_location_anchors(loc_id)
+    set_object_boss(script, 0xC, boss.ids[0], boss.slots[0],
+                    anchors=anchors)
 
     # The real, used Slash is in object 0xB.
     boss_obj = 0xB
@@ -163,8 +165,7 @@ def set_magus_castle_slash_spot_boss(ctrom: CTRom, boss: BossScheme):
     first_x, first_y = 0x80, 0x240
 
     def show_pos_fn(script: Event) -> int:
-        pos = script.find_exact_command(EC.generic_one_arg(0xE8, 0x8D),
-                                        script.get_function_start(0xB, 1))
+        pos = get_show_pos(ctrom, loc_id, script)
 
         if pos is None:
             print("Failed to find show pos (slash spot)")
@@ -173,7 +174,8 @@ def set_magus_castle_slash_spot_boss(ctrom: CTRom, boss: BossScheme):
         return pos
 
     set_generic_one_spot_boss_script(script, boss, boss_obj,
-                                     show_pos_fn, first_x, first_y)
+                                     show_pos_fn, first_x, first_y,
+                                     anchors=anchors)
 # End set_magus_castle_slash_spot_boss
 
 
@@ -237,8 +239,7 @@ def set_zeal_palace_boss(ctrom: CTRom, boss: BossScheme):
     def show_pos_fn(script: Event) -> int:
         # Right after the golem comes down to its final position.  The marker
         # is a play anim 5 command 'AA 05'
-        pos = script.find_exact_command(EC.generic_one_arg(0xAA, 0x5),
-                                        script.get_function_start(0xA, 3))
+        pos = get_show_pos(ctrom, loc_id, script)
 
         if pos is None:
             print('Error finding show pos (zeal palace)')
@@ -248,7 +249,9 @@ def set_zeal_palace_boss(ctrom: CTRom, boss: BossScheme):
 
     set_generic_one_spot_boss_script(script, boss, boss_obj,
                                      show_pos_fn,
-                                     first_x, first_y)
+                                     first_x, first_y,
+                                     anchors=ctrom.get_location_anchors(
+                                         loc_id))
 
 
 # Two spot locations follow the same general procedure:
@@ -327,7 +330,8 @@ def set_zenan_bridge_boss(ctrom: CTRom, boss: BossScheme):
             new_id = boss.ids[i]
             new_slot = boss.slots[i]
 
-            set_object_boss(script, reused_objs[i], new_id, new_slot)
+            set_object_boss(script, reused_objs[i], new_id, new_slot,
+                            anchors=ctrom.get_location_anchors(loc_id))
             set_object_coordinates(script, reused_objs[i], new_x, new_y)
 
         show_cmds = bytearray()
@@ -348,6 +352,7 @@ def set_death_peak_boss(ctrom: CTRom, boss: BossScheme):
     # 0x1EF is the Lavos Spawn's map - Death Peak Guardian Spawn
     loc_id = 0x1EF
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     # The shell is important since it needs to stick around after battle.
     # It is in object 9, and the head is in object 0xA
@@ -363,7 +368,8 @@ def set_death_peak_boss(ctrom: CTRom, boss: BossScheme):
 
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         set_object_coordinates(script, boss_objs[i], new_x, new_y)
 
     # Remove unused boss objects from the original script.
@@ -405,6 +411,7 @@ def set_giga_mutant_spot_boss(ctrom: CTRom, boss: BossScheme):
     # 0x143 is the Giga Mutant's map - Black Omen 63F Divine Guardian
     loc_id = 0x143
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     boss_objs = [0xE, 0xF]
 
@@ -429,7 +436,8 @@ def set_giga_mutant_spot_boss(ctrom: CTRom, boss: BossScheme):
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
 
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         set_object_coordinates(script, boss_objs[i], new_x, new_y)
 
     # Remove unused boss objects.
@@ -477,6 +485,7 @@ def set_terra_mutant_spot_boss(ctrom: CTRom, boss: BossScheme):
     # 0x145 is the Terra Mutant's map - Black Omen 98F Astral Guardian
     loc_id = 0x145
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     boss_objs = [0xF, 0x10]
 
@@ -500,7 +509,8 @@ def set_terra_mutant_spot_boss(ctrom: CTRom, boss: BossScheme):
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
 
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         set_object_coordinates(script, boss_objs[i], new_x, new_y)
 
     # Remove unused boss objects.
@@ -540,6 +550,7 @@ def set_elder_spawn_spot_boss(ctrom: CTRom, boss: BossScheme):
     # 0x60 is the Elder Spawn's map - Black Omen 98F Astral Progeny
     loc_id = 0x60
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     boss_objs = [0x8, 0x9]
 
@@ -554,7 +565,8 @@ def set_elder_spawn_spot_boss(ctrom: CTRom, boss: BossScheme):
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
 
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         # The coordinate setting is in activate for whatever reason.
         set_object_coordinates(script, boss_objs[i], new_x, new_y, True, 1)
 
@@ -651,6 +663,7 @@ def set_sun_palace_boss(ctrom: CTRom, boss: BossScheme):
     # 0xFB is Son of Sun's map - Sun Palace
     loc_id = 0xFB
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     # Eyeball in 0xB and rest are flames. 0x10 is hidden in rando.
     # Really, 0x10 should just be removed from the start.
@@ -670,7 +683,8 @@ def set_sun_palace_boss(ctrom: CTRom, boss: BossScheme):
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
 
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         set_object_coordinates(script, boss_objs[i], new_x, new_y, True)
 
         if i == 0:
@@ -679,8 +693,9 @@ def set_sun_palace_boss(ctrom: CTRom, boss: BossScheme):
             first_x, first_y = 0x100, 0x200
 
     # Remove unused boss objects.  In reverse order of course.
-    for i in range(len(boss_objs), len(boss.ids), -1):
-        script.remove_object(boss_objs[i-1])
+    with script.edit() as editor:
+        for i in range(len(boss_objs), len(boss.ids), -1):
+            editor.remove_object(boss_objs[i-1])
 
     # Add more boss objects if needed.  This will never happen for vanilla
     # Son of Sun, but maybe if scaling adds flames?
@@ -726,14 +741,16 @@ def set_desert_boss(ctrom: CTRom, boss: BossScheme):
     # 0xA1 is Retinite's map - Sunken Desert Devourer
     loc_id = 0xA1
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     boss_objs = [0xE, 0xF, 0x10]
 
     # Extra copies of retinite bottom for the vanilla random location
     # There are some blank objects that can be removed, but will not do so.
     del_objs = [0x12, 0x11]
-    for x in del_objs:
-        script.remove_object(x)
+    with script.edit() as editor:
+        for x in del_objs:
+            editor.remove_object(x)
 
     num_used = min(len(boss.ids), 2)
     first_x, first_y = 0x120, 0xC9
@@ -746,13 +763,15 @@ def set_desert_boss(ctrom: CTRom, boss: BossScheme):
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
 
-        set_object_boss(script, boss_objs[i], boss_id, boss_slot)
+        set_object_boss(script, boss_objs[i], boss_id, boss_slot,
+                        anchors=anchors)
         # The coordinate setting is in arb0 for whatever reason.
         set_object_coordinates(script, boss_objs[i], new_x, new_y, True, 4)
 
     # Remove unused boss objects.  In reverse order of course.
-    for i in range(len(boss_objs), len(boss.ids), -1):
-        script.remove_object(boss_objs[i-1])
+    with script.edit() as editor:
+        for i in range(len(boss_objs), len(boss.ids), -1):
+            editor.remove_object(boss_objs[i-1])
 
     # Add more boss objects if needed.
     calls = bytearray()
@@ -795,6 +814,7 @@ def set_twin_golem_spot(ctrom: CTRom, boss: BossScheme):
     # 0x19E is the Twin Golems' map - Ocean Palace Regal Antechamber
     loc_id = 0x19E
     script = ctrom.script_manager.get_script(loc_id)
+    anchors = ctrom.get_location_anchors(loc_id)
 
     if len(boss.ids) == 1:
         # Turn the one spot boss into a two spot copy
@@ -841,7 +861,8 @@ def set_twin_golem_spot(ctrom: CTRom, boss: BossScheme):
 
     # overwrite the boss objs
     for i in range(0, 2):
-        set_object_boss(script, boss_objs[i], boss.ids[i], boss.slots[i])
+        set_object_boss(script, boss_objs[i], boss.ids[i], boss.slots[i],
+                        anchors=anchors)
 
         new_x = first_x + boss.disps[i][0]
         new_y = first_y + boss.disps[i][1]
@@ -890,7 +911,8 @@ def set_generic_one_spot_boss(ctrom: CTRom,
     script = script_manager.get_script(loc_id)
 
     set_generic_one_spot_boss_script(script, boss, boss_obj,
-                                     show_pos_fn, first_x, first_y, is_shown)
+                                     show_pos_fn, first_x, first_y, is_shown,
+                                     ctrom.get_location_anchors(loc_id))
 
 
 # This is exactly like the above except that the user provides the script.
@@ -902,12 +924,13 @@ def set_generic_one_spot_boss_script(script: Event,
                                      show_pos_fn: Callable[[Event], int],
                                      first_x: int = None,
                                      first_y: int = None,
-                                     is_shown: bool = False):
+                                     is_shown: bool = False,
+                                     anchors: LocationAnchors = None):
 
     first_id = boss.ids[0]
     first_slot = boss.slots[0]
 
-    set_object_boss(script, boss_obj, first_id, first_slot)
+    set_object_boss(script, boss_obj, first_id, first_slot, anchors=anchors)
 
     show = EF()
 
@@ -926,26 +949,38 @@ def set_generic_one_spot_boss_script(script: Event,
         script.insert_commands(show.get_bytearray(), show_pos)
 
 
+# anchors are the patch points of the script's location, if known.
 def set_object_boss(script: Event, obj_id: int, boss_id: int, boss_slot: int,
-                    ignore_jumps: bool = True):
+                    ignore_jumps: bool = True,
+                    anchors: LocationAnchors = None):
 
-    start = script.get_object_start(obj_id)
-    end = script.get_function_end(obj_id, 0)
+    pos = None
+    if anchors is not None and ignore_jumps:
+        pos = anchors.get_load_enemy_pos(script, obj_id)
 
-    pos = start
-    while pos < end:
+    if pos is None:
+        pos = find_load_enemy(script, obj_id, ignore_jumps)
 
-        cmd = get_command(script.data, pos)
+    if pos is not None:
+        # LoadEnemy is 83 ee ss.  Keep the slot's static bit.
+        is_static = script.data[pos+2] & 0x80
+        script.data[pos+1] = boss_id
+        script.data[pos+2] = boss_slot | is_static
 
-        if cmd.command in EC.fwd_jump_commands and ignore_jumps:
-            pos += (cmd.args[-1] - 1)
-        elif cmd.command == 0x83:
-            is_static = cmd.args[1] & 0x80
-            cmd.args[0], cmd.args[1] = boss_id, (boss_slot | is_static)
-            script.data[pos:pos+len(cmd)] = cmd.to_bytearray()
-            break
 
-        pos += len(cmd)
+# Where to insert the commands that show a boss's extra parts for the
+# locations in patchanchors.show_pos_markers
+def get_show_pos(ctrom: CTRom, loc_id: int, script: Event) -> int:
+    pos = None
+
+    anchors = ctrom.get_location_anchors(loc_id)
+    if anchors is not None:
+        pos = anchors.get_show_pos(script)
+
+    if pos is None:
+        pos = find_show_pos(script, loc_id)
+
+    return pos
 
 
 def set_object_coordinates(script: Event, obj_id: int, x: int, y: int,
@@ -1042,8 +1077,9 @@ def duplicate_maps(fsrom: FS):
 
     del_objs = [0x18, 0x17, 0x16, 0x15, 0x14, 0x13, 0x12, 0x11, 0x10, 0xF,
                 0xE, 0xC, 2, 1]
-    for x in del_objs:
-        script.remove_object(x)
+    with script.edit() as editor:
+        for x in del_objs:
+            editor.remove_object(x)
 
     free_event(fsrom, 0xC0)  # New Heckran location id
     Event.write_to_rom_fs(fsrom, 0xC0, script)
@@ -1099,8 +1135,9 @@ def duplicate_maps(fsrom: FS):
     # be changed, but it's worth it?
 
     del_objs = [0x19, 0x0C, 0x0B]
-    for x in del_objs:
-        script.remove_object(x)
+    with script.edit() as editor:
+        for x in del_objs:
+            editor.remove_object(x)
 
     # New Yakra XII object is 0xB
 
@@ -1109,9 +1146,11 @@ def duplicate_maps(fsrom: FS):
 
 
 # This function needs to write the boss assignment to the config respecting
-# the provided settings.
+# the provided settings.  rng is the random.Random (or the random module) to
+# draw with.
 def write_assignment_to_config(settings: rset.Settings,
-                               config: cfg.RandoConfig):
+                               config: cfg.RandoConfig,
+                               rng=random):
 
     boss_settings = settings.ro_settings
 
@@ -1160,7 +1199,7 @@ def write_assignment_to_config(settings: rset.Settings,
             exit()
 
         # Now do the assignment
-        random.shuffle(one_part_bosses)
+        rng.shuffle(one_part_bosses)
         print(one_part_bosses)
 
         for i in range(len(one_part_locations)):
@@ -1168,7 +1207,7 @@ def write_assignment_to_config(settings: rset.Settings,
             location = one_part_locations[i]
             config.boss_assign_dict[location] = boss
 
-        random.shuffle(two_part_bosses)
+        rng.shuffle(two_part_bosses)
         print(two_part_bosses)
         input()
 
@@ -1178,9 +1217,11 @@ def write_assignment_to_config(settings: rset.Settings,
             config.boss_assign_dict[location] = boss
     else:  # Ignore part count, just randomize!
         locations = boss_settings.loc_list
-        bosses = boss_settings.boss_list
 
-        random.shuffle(bosses)
+        # Shuffle a copy so that the settings give the same assignment
+        # every time they are used.
+        bosses = boss_settings.boss_list[:]
+        rng.shuffle(bosses)
 
         if len(bosses) < len(locations):
             print('RO Error: Fewer bosses than locations given.')
@@ -23,10 +23,12 @@ import randosettings as rset
 
 
 # This needs to be called BEFORE assigning key items
-def write_pcs_to_config(settings: rset.Settings, config: cfg.RandoConfig):
+# rng is the random.Random (or the random module) to draw with.
+def write_pcs_to_config(settings: rset.Settings, config: cfg.RandoConfig,
+                        rng=random):
     # First, choose the locations for each character
     chars = [CharID(i) for i in range(7)]
-    random.shuffle(chars)
+    rng.shuffle(chars)
 
     char_man = config.char_manager
     lost_worlds = rset.GameFlags.LOST_WORLDS in settings.gameflags
@@ -56,7 +58,7 @@ def write_pcs_to_config(settings: rset.Settings, config: cfg.RandoConfig):
     # Now, reassign characters if duplicates is on
     if rset.GameFlags.DUPLICATE_CHARS in settings.gameflags:
         # Catch bad char_choices here?
-        choices = [CharID(random.choice(settings.char_choices[i]))
+        choices = [CharID(rng.choice(settings.char_choices[i]))
                    for i in range(7)]
 
         new_stats = [copy.deepcopy(char_man.pcs[choices[i]].stats)
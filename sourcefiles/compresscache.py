@@ -0,0 +1,119 @@
+from __future__ import annotations
+from collections import OrderedDict
+import hashlib
+import os
+import time
+
+from ctdecompress import compress, CompressMode
+
+
+# Content-addressed cache for ctdecompress.compress.
+# Scripts are keyed by a hash of their decompressed bytes, so a script that
+# comes out the same as something compressed earlier (unchanged location,
+# same seed re-run, batch generation) skips compression entirely.
+#   - The in-memory tier is an LRU holding at most max_entries packets.
+#   - If cache_dir is given, packets are also stored there, one file per
+#     packet, and survive between runs.
+class CompressionCache:
+
+    def __init__(self, max_entries: int = 512, cache_dir: str = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> (compressed packet, seconds it took to compress)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.time_spent = 0
+        self.time_saved = 0
+
+    @staticmethod
+    def get_key(source, mode: CompressMode) -> str:
+        digest = hashlib.sha1(source).hexdigest()
+        return f"{digest}_{mode.name.lower()}"
+
+    # Drop-in replacement for ctdecompress.compress.  The returned bytearray
+    # is a copy, so callers are free to change it.
+    def compress(self, source,
+                 mode: CompressMode = CompressMode.GREEDY) -> bytearray:
+        key = CompressionCache.get_key(source, mode)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            packet, compr_time = self.entries[key]
+
+            self.hits += 1
+            self.time_saved += compr_time
+            return bytearray(packet)
+
+        packet = self.__read_disk(key)
+        if packet is not None:
+            # We don't know how long this one took to compress.
+            self.disk_hits += 1
+            self.__add_entry(key, packet, 0)
+            return bytearray(packet)
+
+        self.misses += 1
+
+        start = time.perf_counter()
+        packet = bytes(compress(source, mode))
+        compr_time = time.perf_counter() - start
+        self.time_spent += compr_time
+
+        self.__add_entry(key, packet, compr_time)
+        self.__write_disk(key, packet)
+
+        return bytearray(packet)
+
+    def clear(self):
+        self.entries.clear()
+
+    def print_stats(self):
+        print(f"Compression cache: {self.hits} hits, "
+              f"{self.disk_hits} disk hits, {self.misses} misses")
+        print(f"Time compressing: {self.time_spent:.3f}s, "
+              f"saved: {self.time_saved:.3f}s")
+
+    def __add_entry(self, key, packet, compr_time):
+        self.entries[key] = (packet, compr_time)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __get_filename(self, key):
+        return os.path.join(self.cache_dir, key + '.bin')
+
+    def __read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+
+        filename = self.__get_filename(key)
+        if not os.path.exists(filename):
+            return None
+
+        with open(filename, 'rb') as infile:
+            return infile.read()
+
+    def __write_disk(self, key, packet):
+        if self.cache_dir is None:
+            return
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated packet behind.
+        filename = self.__get_filename(key)
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            outfile.write(packet)
+
+        os.replace(tmp_filename, filename)
+
+
+# The cache used by ctevent's write paths unless told otherwise.  Replace it
+# (e.g. with one that has a cache_dir) to change the behavior for all
+# scripts.
+default_cache = CompressionCache()
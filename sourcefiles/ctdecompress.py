@@ -1,9 +1,129 @@
 # Copied from Gieger's (Michael Springer, evilpeer@hotmail.com) C version
+from bisect import bisect_left
+from enum import Enum, auto
+
 from byteops import get_value_from_bytes, to_file_ptr, print_bytes, \
     to_little_endian
 
 
-def decompress(rom, start):
+# Decompress the packet at rom[start] into out_buffer and return the number
+# of bytes written.  Nothing is allocated here, so callers that decompress
+# many packets can pass the same buffer every time.
+#   - rom can be anything supporting the buffer protocol (bytes, bytearray,
+#     an FSRom's getbuffer()).  It is read through a memoryview.
+#   - out_buffer should be a bytearray of at least 0x10000 bytes (the max
+#     size of a decompressed packet).
+def decompress_into(rom, start, out_buffer):
+    with memoryview(rom) as rom:
+        return _decompress_view(rom, start, out_buffer)
+
+
+def _decompress_view(rom, start, out_buffer):
+    buf_len = len(out_buffer)
+
+    # First two bytes are little endian size of compressed packet
+    main_len = rom[start] | (rom[start+1] << 8)
+
+    out_pos = 0
+    src_pos = start+2
+
+    end_pos = src_pos + main_len
+
+    if rom[end_pos] & 0xC0 != 0:
+        size_shift = 3
+        off_mask = 0x07FF
+    else:
+        size_shift = 4
+        off_mask = 0x0FFF
+
+    while True:
+        # First check if we've passed the main body
+        if src_pos == end_pos:
+            if rom[src_pos] & 0x3F == 0:
+                # No addendum
+                return out_pos
+            else:
+                # Addendum, new end in next two bytes
+                end_pos = start + (rom[src_pos+1] | (rom[src_pos+2] << 8))
+                src_pos += 3  # Get to the byte after the new end byte
+
+        header = rom[src_pos]
+        src_pos += 1
+
+        if header == 0 and src_pos + 8 <= end_pos:
+            # Whole packet is uncompressed.  Copy all 8 bytes at once.
+            if out_pos + 8 > buf_len:
+                print('Error: Decompressed data exceeds buffer.')
+                exit()
+
+            out_buffer[out_pos:out_pos+8] = rom[src_pos:src_pos+8]
+            out_pos += 8
+            src_pos += 8
+            continue
+
+        for i in range(8):
+            if src_pos == end_pos:
+                # ran out of data mid packet (in addendum)
+                break
+            elif header & (1 << i) == 0:
+                # Uncompressed, copy next byte
+                out_buffer[out_pos] = rom[src_pos]
+                out_pos += 1
+                src_pos += 1
+            else:
+                # Compressed, determine copy size and offset
+                copy_size = (rom[src_pos+1] >> size_shift) + 3
+                copy_off = \
+                    (rom[src_pos] | (rom[src_pos+1] << 8)) & off_mask
+
+                if out_pos + copy_size > buf_len:
+                    print('Error: Decompressed data exceeds buffer.')
+                    exit()
+
+                copy_st = out_pos - copy_off
+                if copy_off == 0 or copy_st < 0:
+                    # Not valid data, but some unused packets have it.
+                    # Give what decompress_bytewise does with its zeroed
+                    # buffer: bytes from before the start of the data or
+                    # not written yet (an offset of 0) are 0.  out_buffer
+                    # may hold an earlier packet, so they are written out.
+                    for j in range(copy_size):
+                        src = copy_st + j
+                        if 0 <= src < out_pos + j:
+                            out_buffer[out_pos+j] = out_buffer[src]
+                        else:
+                            out_buffer[out_pos+j] = 0
+                elif copy_off >= copy_size:
+                    # No overlap.  Copy the whole block.
+                    out_buffer[out_pos:out_pos+copy_size] = \
+                        out_buffer[copy_st:copy_st+copy_size]
+                else:
+                    # The copy overlaps what it's writing, so the result is
+                    # the copy_off bytes at copy_st repeated.  Everything
+                    # copied so far is a whole number of repeats, so the
+                    # chunk can double each time.
+                    copied = 0
+                    while copied < copy_size:
+                        chunk = min(copy_off + copied, copy_size - copied)
+                        out_buffer[out_pos+copied:out_pos+copied+chunk] = \
+                            out_buffer[copy_st:copy_st+chunk]
+                        copied += chunk
+
+                out_pos += copy_size
+                src_pos += 2
+
+
+def decompress(rom, start, out_buffer=None):
+    if out_buffer is None:
+        out_buffer = bytearray(0x10000)
+
+    out_len = decompress_into(rom, start, out_buffer)
+    return out_buffer[0:out_len]
+
+
+# Original byte-at-a-time version of decompress.  Not used by the
+# randomizer.  Kept to check the faster version against.
+def decompress_bytewise(rom, start):
     out_buffer = bytearray([0 for i in range(0, 0x10000)])
 
     # First two bytes are little endian size of compressed packet
@@ -276,174 +396,250 @@ def CTCopyBytes(rom, WorkingBuffer, nBytePos, nWorkPos,  bSmallerBitWidth):
     return nBytePos, nWorkPos
 
 
-# Modification of Michael Springer's code to fit my applications
-# This is a greedy algorithm. On occassion it will be a byte (or two?) larger
-# than the original game's compression.  This happens when you almost fill up
-# the addendum packet but then have to add another 2 bytes for the compressed
-# length prior to the addendum.
-def compress(source):
+# Index every position of the source by the 3 bytes starting there.  A
+# compressed copy is never shorter than 3 bytes, so any usable match for
+# src_pos must start at a position sharing src_pos's 3-byte prefix.
+# Each chain is a list of positions in increasing order.
+def _build_match_chains(source):
+    chains = dict()
+    source = bytes(source)
 
-    # We have to try compressing in two configurations and then return the
-    # better of the two.
-    compressed_data = [bytearray([0 for i in range(0x10000)])
-                       for j in range(2)]
+    for pos in range(len(source)-2):
+        key = source[pos:pos+3]
+        chain = chains.get(key)
+        if chain is None:
+            chains[key] = [pos]
+        else:
+            chain.append(pos)
 
-    for i in range(2):
-        # i=0: use 0x07FF for the range, 0xF800 for the max copy length
-        # i=1: use 0x0FFF for the range, 0xF000 for the max copy length
-        lookback_range = 0x07FF | (i << 11)
+    return chains
 
-        # max_copy_length = 0xFFFF ^ lookback_range (bits used)
-        max_copy_length = (0xFFFF ^ lookback_range) >> (16-(5-i))
-        max_copy_length += 3
 
-        src_pos = 0
+# Find the longest match (up to max_copy_length) for the data at src_pos
+# starting in the lookback window.  Ties go to the earliest start, which is
+# what the old list-refining search produced, so output is unchanged.
+# Returns (best_len, best_len_st) with best_len = 0 when there's no match of
+# at least 3 bytes.
+def _find_match(source, src_pos, chains, lookback_range, max_copy_length):
 
-        # First two bytes are main body length
-        # Next byte will be the first packet's header
-        out_pos = 2
+    if src_pos + 2 >= len(source):
+        return 0, 0
 
-        done = False
-        best_size = 0x10000
+    chain = chains.get(bytes(source[src_pos:src_pos+3]))
 
-        # print('i =', i)
+    # Only starts in [src_pos - lookback_range, src_pos) are reachable.
+    first = bisect_left(chain, src_pos - lookback_range)
+    last = bisect_left(chain, src_pos, first)
 
-        while out_pos < best_size and not done:
-            # Fill up a compressed packet
-            header_pos = out_pos
-            out_pos += 1
+    max_len = min(max_copy_length, len(source) - src_pos)
+    target = source[src_pos:src_pos+max_len]
 
-            for bit in range(8):
+    best_len = 0
+    best_len_st = 0
 
-                # While filling a packet we ran out of source.
-                if src_pos == len(source):
-                    if bit == 0:
-                        # If bit == 0, then we ran out after filling a packet.
-                        # This means no addendum.
-                        compressed_data[i][header_pos] = 0xC0*(1-i)
+    for ind in range(first, last):
+        start = chain[ind]
 
-                        # Truncate to used size
-                        compressed_data[i] = compressed_data[i][0:header_pos+1]
-                    else:
-                        # Otherwise, we're mid-packet.  The packet becomes
-                        # the addendum.
-
-                        # set unused bits of header for addendum header
-                        mask = (0xFF << bit) & 0xFF
-                        compressed_data[i][header_pos] |= mask
-
-                        # shift the addendum packet down three bytes
-                        compressed_data[i][header_pos+3:out_pos+3] = \
-                            compressed_data[i][header_pos:out_pos]
-
-                        # copy range + addendum length
-                        compressed_data[i][header_pos] = \
-                            0xC0*(1-i) | bit
-
-                        # total compressed length (remember shift by 3)
-                        compressed_data[i][header_pos+1:header_pos+3] = \
-                            to_little_endian(out_pos+3, 2)
-
-                        # Truncate to used size
-                        compressed_data[i][out_pos+3] = 0xC0*(1-i)
-                        compressed_data[i] = compressed_data[i][0:out_pos+4]
-
-                    # print(f"Main body len: {header_pos-2:04X}")
-                    compressed_data[i][0:2] = \
-                        to_little_endian(header_pos-2, 2)
-
-                    done = True
-                    break
-                
-                lookback_st = max(0, src_pos - lookback_range)
-                lookback_end = src_pos
-
-                best_len = 0
-                best_len_st = 0
-
-                # Weird python stuff to avoid too many loops
-                # I hope we can do better than this.
-
-                # Use list comprehension to find potential starts
-                starts = [x for x in range(lookback_st, lookback_end)
-                          if source[x] == source[src_pos]]
-
-                # Refine the list of starts by matching the next bytes up
-                # to max copy length
-                for j in range(1, max_copy_length):
-                    next_starts = \
-                        [x for x in starts
-                         if (src_pos + j < len(source)
-                             and source[x+j] == source[src_pos+j])]
-
-                    if not next_starts:  # 'pythonic' way to check empty
-                        break
-                    else:
-                        starts = next_starts
-                        best_len_st = starts[0]
-                        best_len = j+1
+        # Cheap test for a full length match before going byte by byte
+        if source[start:start+max_len] == target:
+            return max_len, start
+
+        cur_len = 3
+        while source[start+cur_len] == source[src_pos+cur_len]:
+            cur_len += 1
+
+        if cur_len > best_len:
+            best_len = cur_len
+            best_len_st = start
+
+    return best_len, best_len_st
 
-                '''
-                # This is how it would go in a C program and in Geiger's orig
 
-                best_len = 0
-                for start in range(lookback_st, lookback_end):
-                # for start in starts:
+# Greedy parse: always take the longest match available.
+# The parse is a list of (length, value) items.  A copy has length >= 3 and
+# value is the lookback.  A literal has length 1 and value is the byte.
+def _greedy_parse(source, chains, lookback_range, max_copy_length):
+    items = []
+    src_pos = 0
 
-                    # Match the source starting at 'start' with the source
-                    # starting at 'src_pos'
-                    cur_len = 0
+    while src_pos < len(source):
+        best_len, best_len_st = \
+            _find_match(source, src_pos, chains,
+                        lookback_range, max_copy_length)
 
-                    while (src_pos + cur_len < len(source) and
-                           cur_len < max_copy_length and
-                           source[start+cur_len] == source[src_pos+cur_len]):
-                        cur_len += 1
+        if best_len > 2:
+            # We matched at least 3 bytes, so we'll use compression
+            items.append((best_len, src_pos - best_len_st))
+            src_pos += best_len
+        else:
+            # We failed to match 3 or more bytes, so just copy a byte
+            items.append((1, source[src_pos]))
+            src_pos += 1
+
+    return items
+
+
+# Optimal parse: shortest path through the source where the cost of an item
+# depends on its position within a packet.
+#   - A literal costs 1 byte and a copy costs 2 bytes regardless of length.
+#   - The first item of each packet also pays for the packet's header.
+#   - Ending on a full packet costs 1 more byte (the terminator).  Ending
+#     mid-packet costs 4 (addendum byte, 2 byte length, terminator).
+# So the state is (source position, number of items mod 8).  Every shorter
+# prefix of the longest match is also a match, so the longest match at each
+# position gives all of the copy edges out of it.
+def _optimal_parse(source, chains, lookback_range, max_copy_length):
+    num_bytes = len(source)
+    no_path = 0x10000000
+
+    # cost[k][pos] is the cheapest way to encode source[:pos] with a number
+    # of items that is k mod 8.  back[k][pos] remembers the last item.
+    cost = [[no_path]*(num_bytes+1) for k in range(8)]
+    back = [[None]*(num_bytes+1) for k in range(8)]
+    cost[0][0] = 0
+
+    for src_pos in range(num_bytes):
+        match_len, match_st = \
+            _find_match(source, src_pos, chains,
+                        lookback_range, max_copy_length)
+        lookback = src_pos - match_st
+        literal = source[src_pos]
+
+        for k in range(8):
+            cur_cost = cost[k][src_pos]
+            if cur_cost == no_path:
+                continue
+
+            next_k = (k+1) % 8
+            header_cost = 1 if k == 0 else 0
+            next_cost = cost[next_k]
+            next_back = back[next_k]
+
+            lit_cost = cur_cost + header_cost + 1
+            if lit_cost < next_cost[src_pos+1]:
+                next_cost[src_pos+1] = lit_cost
+                next_back[src_pos+1] = (1, literal)
+
+            copy_cost = cur_cost + header_cost + 2
+            for length in range(3, match_len+1):
+                if copy_cost < next_cost[src_pos+length]:
+                    next_cost[src_pos+length] = copy_cost
+                    next_back[src_pos+length] = (length, lookback)
+
+    end_k = min(range(8),
+                key=lambda k: cost[k][num_bytes] + (1 if k == 0 else 4))
+
+    # Walk the back pointers to recover the items
+    items = []
+    src_pos = num_bytes
+    k = end_k
+    while src_pos > 0:
+        item = back[k][src_pos]
+        items.append(item)
+        src_pos -= item[0]
+        k = (k-1) % 8
+
+    items.reverse()
+    return items
+
+
+# Write out the parsed items in CT's packet format.  i is the configuration
+# (see compress) which determines the lookback width.
+def _encode_items(items, i):
+    # Width flag that goes in the addendum/terminator byte
+    width_flag = 0xC0*(1-i)
+
+    # First two bytes are main body length
+    # Next byte will be the first packet's header
+    out = bytearray(2)
+    header_pos = 2
+
+    for ind, (length, value) in enumerate(items):
+        bit = ind % 8
+        if bit == 0:
+            # Start a new packet
+            header_pos = len(out)
+            out.append(0)
+
+        if length > 2:
+            # Mark the header to use compression for this bit
+            out[header_pos] |= (1 << bit)
+
+            # length is encoded with a -3 because there are always at
+            # least 3 bytes to copy.  The length is shifted to the most
+            # significant bits.  The shift depends on i.
+            compr_stream = value | ((length-3) << (16-(5-i)))
+            out.extend(to_little_endian(compr_stream, 2))
+        else:
+            out.append(value)
+
+    bit = len(items) % 8
+    if bit == 0:
+        # We ran out after filling a packet.  This means no addendum.
+        header_pos = len(out)
+        out.append(width_flag)
+    else:
+        # Otherwise, we're mid-packet.  The packet becomes the addendum.
+        out_pos = len(out)
 
-                    # Update best match if needed
-                    if cur_len >= best_len:
-                        best_len = cur_len
-                        best_len_st = start
-                        if cur_len == max_copy_length:
-                            break
+        # set unused bits of header for addendum header
+        out[header_pos] |= (0xFF << bit) & 0xFF
 
-                '''
+        # copy range + addendum length, total compressed length (remember
+        # the shift by 3)
+        out[header_pos:header_pos] = \
+            bytearray([width_flag | bit]) + to_little_endian(out_pos+3, 2)
 
-                if best_len > 2:
-                    # We matched at least 3 bytes, so we'll use compression
+        out.append(width_flag)
 
-                    # Mark the header to use compression for this bit
-                    compressed_data[i][header_pos] |= (1 << bit)
+    out[0:2] = to_little_endian(header_pos-2, 2)
 
-                    lookback = src_pos - best_len_st
-                    # print(f"\tlookback: {lookback:04X}")
+    return out
 
-                    # length is encoded with a -3 because there are always at
-                    # least 3 bytes to copy.  The length is shifted to the most
-                    # significant bits.  The shift depends on i.
-                    length = ((best_len-3) << (16-(5-i)))
 
-                    compr_stream = lookback | length
+class CompressMode(Enum):
+    GREEDY = auto()
+    OPTIMAL = auto()
 
-                    compressed_data[i][out_pos:out_pos+2] = \
-                        to_little_endian(compr_stream, 2)
 
-                    out_pos += 2
-                    src_pos += best_len
-                else:
-                    # We failed to match 3 or more bytes, so just copy a byte
-                    compressed_data[i][out_pos] = source[src_pos]
-                    out_pos += 1
-                    src_pos += 1
-            # End of for loop to fill packet
-        # End of while not done loop
-
-        if len(compressed_data[i]) < best_size:
-            best_size = len(compressed_data[i])
-
-    if len(compressed_data[0]) <= len(compressed_data[1]):
-        return compressed_data[0]
+# Modification of Michael Springer's code to fit my applications
+# The default is a greedy algorithm. On occassion it will be a byte (or two?)
+# larger than the original game's compression.  This happens when you almost
+# fill up the addendum packet but then have to add another 2 bytes for the
+# compressed length prior to the addendum.
+# CompressMode.OPTIMAL finds the smallest possible packet for each lookback
+# width at the cost of more CPU time.
+def compress(source, mode: CompressMode = CompressMode.GREEDY):
+
+    # Both configurations search the same source, so the match index only
+    # needs to be built once.
+    chains = _build_match_chains(source)
+
+    if mode == CompressMode.OPTIMAL:
+        parse = _optimal_parse
     else:
-        return compressed_data[1]
+        parse = _greedy_parse
+
+    # We have to try compressing in two configurations and then return the
+    # better of the two.
+    best_data = None
+
+    for i in range(2):
+        # i=0: use 0x07FF for the range, 0xF800 for the max copy length
+        # i=1: use 0x0FFF for the range, 0xF000 for the max copy length
+        lookback_range = 0x07FF | (i << 11)
+
+        # max_copy_length = 0xFFFF ^ lookback_range (bits used)
+        max_copy_length = (0xFFFF ^ lookback_range) >> (16-(5-i))
+        max_copy_length += 3
+
+        items = parse(source, chains, lookback_range, max_copy_length)
+        compressed_data = _encode_items(items, i)
+
+        if best_data is None or len(compressed_data) < len(best_data):
+            best_data = compressed_data
+
+    return best_data
 
 
 if __name__ == '__main__':
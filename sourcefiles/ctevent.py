@@ -1,13 +1,22 @@
 from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from io import BytesIO
+import os
+import struct as st
+from typing import Tuple
 
+import compresscache
 from ctdecompress import compress, decompress, get_compressed_length, \
     get_compressed_packet
 from ctenums import LocID
 from byteops import get_value_from_bytes, to_little_endian, to_file_ptr, \
     to_rom_ptr, print_bytes
 import ctstrings
-from eventcommand import EventCommand as EC, get_command, FuncSync
+from eventcommand import EventCommand as EC, get_command, \
+    get_command_length, decode_command, command_ids, command_lengths, \
+    FuncSync
 from eventfunction import EventFunction as EF
 from freespace import FreeSpace as FS, FSRom, FSWriteType 
 
@@ -31,7 +40,7 @@ def get_compressed_script(rom, event_id):
     return get_compressed_packet(rom, event_ptr)
 
 
-def get_loc_event_ptr(rom, loc_id):
+def get_loc_event_id(rom, loc_id):
     # Location data begins at 0x360000.
     # Each record is 14 bytes.  Bytes 8 and 9 (0-indexed) hold an index into
     # the pointer table for event scripts.
@@ -39,12 +48,14 @@ def get_loc_event_ptr(rom, loc_id):
     loc_data_st = 0x360000
     event_ind_st = loc_data_st + 14*loc_id + 8
 
-    loc_script_ind = get_value_from_bytes(rom[event_ind_st:event_ind_st+2])
+    return get_value_from_bytes(rom[event_ind_st:event_ind_st+2])
 
+
+def get_event_ptr(rom, event_id):
     event_ptr_st = 0x3CF9F0
 
     # Each event pointer is an absolute, 3 byte pointer
-    start = event_ptr_st + 3*loc_script_ind
+    start = event_ptr_st + 3*event_id
     event_ptr = \
         get_value_from_bytes(rom[start:start+3])
 
@@ -53,6 +64,25 @@ def get_loc_event_ptr(rom, loc_id):
     return event_ptr
 
 
+def get_loc_event_ptr(rom, loc_id):
+    return get_event_ptr(rom, get_loc_event_id(rom, loc_id))
+
+
+# Whether a location uses an event other than event_id whose pointer is
+# event_ptr.  Locations share scripts, not always through the same entry
+# of the event pointer table, so a packet can only be freed when no other
+# entry points at it.
+def is_event_packet_shared(rom, event_id, event_ptr) -> bool:
+    # Location ids run from 0x000 to 0x1EF
+    for loc_id in range(0x1F0):
+        other_id = get_loc_event_id(rom, loc_id)
+        if other_id != event_id and \
+           get_event_ptr(rom, other_id) == event_ptr:
+            return True
+
+    return False
+
+
 def get_location_script(rom, loc_id):
     # Location data begins at 0x360000.
     # Each record is 14 bytes.  Bytes 8 and 9 (0-indexed) hold an index into
@@ -68,56 +98,395 @@ def get_location_script(rom, loc_id):
     return get_compressed_script(rom, loc_script_ind)
 
 
-def free_event(fsrom: FS, loc_id: int):
+def free_event(fsrom: FSRom, loc_id: int):
     ''' Mark a location's script and (if possible) strings as free space. '''
 
     rom = fsrom.getbuffer()
-    event_ptr = get_loc_event_ptr(rom, loc_id)
+    event_id = get_loc_event_id(rom, loc_id)
+    event_ptr = get_event_ptr(rom, event_id)
     event_len = get_compressed_length(rom, event_ptr)
 
-    fsrom.mark_block((event_ptr, event_ptr+event_len), True)
+    spaceman = fsrom.space_manager
+    if not is_event_packet_shared(rom, event_id, event_ptr):
+        spaceman.mark_block((event_ptr, event_ptr+event_len),
+                            FSWriteType.MARK_FREE)
+
+    # Only the string owners know which strings no other event uses.
+    # Without them the strings are left behind, since a string table can be
+    # shared with other events.
+    if fsrom.string_owners is not None:
+        for block in fsrom.string_owners.release_event(event_id):
+            spaceman.mark_block(block, FSWriteType.MARK_FREE)
+
+
+# Every jump's last arg is a single byte, so a jump can only reach this far
+# from where its command starts.
+_jump_commands = set(EC.fwd_jump_commands + EC.back_jump_commands)
+_jump_reach = 0xFF + max(command_lengths[x] for x in _jump_commands)
+
+
+# Where every command in a script starts and how long it is, as parallel
+# lists sorted by offset.  Event builds one of these the first time it needs
+# to walk its commands and keeps it up to date through insert_commands and
+# delete_commands.  Opcodes are read from the script data itself so that
+# editing a command in place (same length) never makes the index stale.
+# The offsets of the jump commands are also kept (the relocation table) so
+# that edits only look at the jumps near them.
+class CommandIndex:
+
+    def __init__(self, data: bytearray, start: int):
+        self.offsets = []
+        self.lengths = []
+        self.jumps = []
+
+        pos = start
+        while pos < len(data):
+            cmd_len = get_command_length(data, pos)
+            self.offsets.append(pos)
+            self.lengths.append(cmd_len)
+
+            if command_ids[data[pos]] in _jump_commands:
+                self.jumps.append(pos)
+
+            pos += cmd_len
+
+    # Index of the command starting at pos or None if no command starts
+    # there.
+    def find(self, pos: int) -> int:
+        ind = bisect_left(self.offsets, pos)
+
+        if ind < len(self.offsets) and self.offsets[ind] == pos:
+            return ind
+
+        return None
+
+    # Index of the first command starting at or after pos
+    def find_after(self, pos: int) -> int:
+        return bisect_left(self.offsets, pos)
+
+    # Whether a command starts at pos.  The end of the script counts.
+    def is_boundary(self, pos: int) -> bool:
+        if self.find(pos) is not None:
+            return True
+
+        return bool(self.offsets) and \
+            pos == self.offsets[-1] + self.lengths[-1]
+
+    # Offsets of the jump commands starting in [start, end)
+    def get_jumps(self, start: int, end: int) -> list[int]:
+        return self.jumps[bisect_left(self.jumps, start):
+                          bisect_left(self.jumps, end)]
+
+    # Bring the index up to date after edits were applied.  The edits must
+    # all be on command boundaries.
+    def apply_edits(self, edits: EventEdits):
+        offsets, lengths = [], []
+
+        def add_commands(buf, pos):
+            cmd_pos = 0
+            while cmd_pos < len(buf):
+                cmd_len = get_command_length(buf, cmd_pos)
+                offsets.append(pos+cmd_pos)
+                lengths.append(cmd_len)
+                cmd_pos += cmd_len
+
+        ins_ind = 0
+        for (offset, length) in zip(self.offsets, self.lengths):
+            # Inserted commands go before the command at the same position
+            while ins_ind < len(edits.ins_pos) and \
+                    edits.ins_pos[ins_ind] <= offset:
+                x = edits.ins_pos[ins_ind]
+                add_commands(edits.ins_data[ins_ind], edits.get_new_pos(x))
+                ins_ind += 1
+
+            if not edits.is_deleted(offset):
+                offsets.append(edits.get_new_pos(offset, True))
+                lengths.append(length)
+
+        while ins_ind < len(edits.ins_pos):
+            x = edits.ins_pos[ins_ind]
+            add_commands(edits.ins_data[ins_ind], edits.get_new_pos(x))
+            ins_ind += 1
+
+        self.offsets = offsets
+        self.lengths = lengths
+
+    # The jumps have to be found again from the new data.
+    def find_jumps(self, data: bytearray):
+        self.jumps = [pos for pos in self.offsets
+                      if command_ids[data[pos]] in _jump_commands]
+
+
+# A batch of insertions and deletions on an Event's data.  All positions are
+# in the script as it is before any of the edits.  Deletions are [start, end)
+# and may not overlap each other.  Insertions at the same position keep the
+# order they were added in.
+# Jumps and function starts are relocated by these rules:
+#   - A forward jump at p to t is lengthened by insertions strictly between
+#     p and t and shortened by deletions entirely inside (p, t].
+#   - A backward jump at p to t is lengthened by insertions in [t, p] and
+#     shortened by deletions entirely inside (t, p].
+#   - A function start s moves by insertions before s and deletions that
+#     start before s.
+# For a single edit this is exactly what insert_commands and
+# delete_commands have always done.  Jumps and function starts that point
+# into deleted commands have no sensible place to go and are not handled
+# consistently.
+class EventEdits:
+
+    def __init__(self):
+        # Insertions as parallel lists sorted by position
+        self.ins_pos = []
+        self.ins_data = []
+
+        # Deletions as parallel lists sorted by start
+        self.del_st = []
+        self.del_end = []
+
+        self.__ins_cum = None
+        self.__del_cum = None
+
+    def insert(self, pos: int, new_commands: bytearray):
+        ind = bisect_right(self.ins_pos, pos)
+
+        if ind > 0 and self.ins_pos[ind-1] == pos:
+            self.ins_data[ind-1] = self.ins_data[ind-1] + new_commands
+        else:
+            self.ins_pos.insert(ind, pos)
+            self.ins_data.insert(ind, bytearray(new_commands))
+
+        self.__ins_cum = None
+
+    def delete(self, start: int, end: int):
+        if end <= start:
+            return
+
+        ind = bisect_left(self.del_st, start)
+
+        if (ind > 0 and self.del_end[ind-1] > start) or \
+           (ind < len(self.del_st) and self.del_st[ind] < end):
+            print(f"Error: Deletion [{start:04X}, {end:04X}) overlaps "
+                  "another deletion.")
+            exit()
+
+        self.del_st.insert(ind, start)
+        self.del_end.insert(ind, end)
+        self.__del_cum = None
+
+    def is_empty(self) -> bool:
+        return not self.ins_pos and not self.del_st
 
-    event = Event.from_rom(rom, event_ptr)
-    string_index = event.get_string_index()
+    # Whether pos is inside one of the deleted ranges.
+    def is_deleted(self, pos: int) -> bool:
+        ind = bisect_right(self.del_st, pos) - 1
+        return ind >= 0 and pos < self.del_end[ind]
 
-    # It is possible for there to not be any strings in an event and hence
-    # no string index.
-    if string_index is not None:
-        # Here we're going to try to detect whether the strings are all
-        # particular to the event we're reading.  If so we'll mark them as free
+    def __get_cums(self):
+        if self.__ins_cum is None:
+            self.__ins_cum = [0]
+            for data in self.ins_data:
+                self.__ins_cum.append(self.__ins_cum[-1] + len(data))
 
-        str_bank = string_index % 0x10000
-        first_str_addr = \
-            get_value_from_bytes(rom[string_index:string_index+2]) + str_bank
+        if self.__del_cum is None:
+            self.__del_cum = [0]
+            for (start, end) in zip(self.del_st, self.del_end):
+                self.__del_cum.append(self.__del_cum[-1] + end - start)
 
-        # Assume that everything from the string index to the first string is
-        # two byte pointers to the strings.
+        return self.__ins_cum, self.__del_cum
 
-        # This will not always be true...strings are going to take more care
-        # to free correctly.  For now let's live with some string duplication.
-        num_strings = (first_str_addr - string_index) / 2
+    # Bytes inserted before pos (or at pos if inclusive)
+    def inserted_before(self, pos: int, inclusive: bool = False) -> int:
+        ins_cum, _ = self.__get_cums()
 
-        str_total_len = sum(len(x) for x in event.strings)
+        if inclusive:
+            return ins_cum[bisect_right(self.ins_pos, pos)]
+        else:
+            return ins_cum[bisect_left(self.ins_pos, pos)]
+
+    # Bytes of the deletions with lo < start and end <= hi
+    def deleted_between(self, lo: int, hi: int) -> int:
+        _, del_cum = self.__get_cums()
+
+        first = bisect_right(self.del_st, lo)
+        last = bisect_right(self.del_end, hi)
+
+        if last > first:
+            return del_cum[last] - del_cum[first]
 
-        if num_strings == len(event.strings):
-            fsrom.mark_block((string_index,
-                              string_index + 2*num_strings + str_total_len),
-                             True)
+        return 0
 
-            # Some diagnostic stuff
-            # print(f"Num strings at index: {num_strings}")
-            # print(f"Num strings used: {len(event.strings)}")
+    # Bytes of the deletions starting before pos
+    def deleted_before(self, pos: int) -> int:
+        _, del_cum = self.__get_cums()
+        return del_cum[bisect_left(self.del_st, pos)]
+
+    # Where pos ends up after the edits.  Commands starting at pos move
+    # past anything inserted at pos (after_inserts).  Inserted data at pos
+    # starts at get_new_pos(pos).
+    def get_new_pos(self, pos: int, after_inserts: bool = False) -> int:
+        _, del_cum = self.__get_cums()
+        deleted = del_cum[bisect_right(self.del_end, pos)]
+
+        return pos + self.inserted_before(pos, after_inserts) - deleted
+
+    # How much a jump at pos with the given target changes
+    def get_jump_shift(self, pos: int, target: int) -> int:
+        if target > pos:
+            return self.inserted_before(target) - \
+                self.inserted_before(pos, True) - \
+                self.deleted_between(pos, target)
         else:
-            # We can maybe still do something if the strings are shared
-            # between multiple scripts.
+            return self.inserted_before(pos, True) - \
+                self.inserted_before(target) - \
+                self.deleted_between(target, pos)
+
+    # How much a function start changes
+    def get_start_shift(self, start: int) -> int:
+        return self.inserted_before(start) - self.deleted_before(start)
+
+    # Ranges of positions that a jump must start in to be affected.
+    def get_jump_windows(self) -> list[Tuple[int, int]]:
+        windows = [(x-_jump_reach, x+_jump_reach+1) for x in self.ins_pos]
+        windows.extend((start-_jump_reach, end+_jump_reach)
+                       for (start, end) in zip(self.del_st, self.del_end))
+        windows.sort()
+
+        merged = []
+        for (start, end) in windows:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
 
-            # Some duplicate strings will be left behind, but I don't see how
-            # to fix it without reading ALL of the scripts and tracking where
-            # the strings are.
+        return merged
 
-            # Maybe do this once, pickle the result?  You'll have to update
-            # the initial db whenever there's a script change in patch.ips.
-            pass
+    # The data with the edits applied
+    def apply(self, data: bytearray) -> bytearray:
+        cuts = sorted(
+            [(x, 1, i) for (i, x) in enumerate(self.ins_pos)] +
+            [(x, 0, i) for (i, x) in enumerate(self.del_st)]
+        )
+
+        new_data = bytearray()
+        pos = 0
+        for (cut_pos, is_insert, i) in cuts:
+            if cut_pos > pos:
+                new_data += data[pos:cut_pos]
+                pos = cut_pos
+
+            if is_insert:
+                new_data += self.ins_data[i]
+            else:
+                pos = max(pos, self.del_end[i])
+
+        new_data += data[pos:]
+        return new_data
+
+
+# Queues changes to one Event so that they are applied together.  Get one
+# from Event.edit() or ScriptManager.get_script_editor().
+#     with script.edit() as editor:
+#         editor.insert_commands(cmds, pos)
+#         editor.delete_commands(other_pos, 2)
+#         editor.remove_object(0x10)
+# Every position and object id is in the script as it is before any of the
+# queued edits, so callers can find all of their positions first and never
+# track how earlier edits moved things.  Nothing in the script changes until
+# apply() is called.  Then the data is rebuilt once and the jumps and
+# function starts are fixed up once (see EventEdits for the rules).
+# Inserted commands are written as given.  Object calls in them should use
+# the object numbering after the removals.
+class EventEditor:
+
+    def __init__(self, event: Event):
+        self.event = event
+        self.__reset()
+
+    def __reset(self):
+        self.edits = EventEdits()
+
+        # Removed objects and whether to remove their calls
+        self.removed_objs = dict()
+
+    def is_empty(self) -> bool:
+        return self.edits.is_empty() and not self.removed_objs
+
+    def insert_commands(self, new_commands: bytearray, ins_position: int):
+        self.edits.insert(ins_position, new_commands)
+
+    def delete_commands(self, del_pos: int, num_commands: int = 1):
+        data = self.event.data
+        pos = del_pos
+
+        for i in range(num_commands):
+            if pos >= len(data):
+                print("Error: Deleting out of script's range.")
+                exit()
+
+            pos += get_command_length(data, pos)
+
+        self.edits.delete(del_pos, pos)
+
+    # Same as Event.remove_object.  Calls to the object (and draw status
+    # commands on it) are removed and calls to later objects renumbered when
+    # the edits are applied.
+    def remove_object(self, obj_id: int, remove_calls: bool = True):
+        event = self.event
+
+        if obj_id >= event.num_objects or obj_id in self.removed_objs:
+            print(f"Error: Can not remove object {obj_id:02X}.")
+            exit()
+
+        self.edits.delete(event.get_object_start(obj_id),
+                          event.get_object_end(obj_id))
+        self.edits.delete(32*obj_id, 32*(obj_id+1))
+        self.removed_objs[obj_id] = remove_calls
+
+    def apply(self):
+        if self.is_empty():
+            return
+
+        event = self.event
+
+        call_objs = sorted(obj_id for (obj_id, remove_calls)
+                           in self.removed_objs.items() if remove_calls)
+        if call_objs:
+            self.__remove_shift_object_calls(call_objs)
+
+        event.apply_edits(self.edits)
+        event.num_objects -= len(self.removed_objs)
+
+        self.__reset()
+
+    # Queue deletions for calls to the removed objects and renumber calls to
+    # the objects after them.  The renumbering is in place, so it does not
+    # move anything.
+    def __remove_shift_object_calls(self, removed_objs: list[int]):
+        calls = [2, 3, 4]
+        draw_status = [0x7C, 0x7D]
+
+        obj_cmds = calls + draw_status
+
+        event = self.event
+        edits = self.edits
+        removed_args = [2*obj_id for obj_id in removed_objs]
+
+        pos = event.get_function_start(0, 0)
+        while True:
+            (pos, cmd) = event.find_command(obj_cmds, pos)
+            if pos is None:
+                break
+
+            # It just so happens that the draw status commands and the object
+            # call commands use 2*obj_id and have the object in arg0
+            if not edits.is_deleted(pos):
+                if cmd.args[0] in removed_args:
+                    edits.delete(pos, pos+len(cmd))
+                else:
+                    shift = 2*bisect_left(removed_args, cmd.args[0])
+                    event.data[pos+1] -= shift
+
+            pos += len(cmd)
 
 
 # The strategy is to handle the event very similarly to how the game does.
@@ -126,6 +495,11 @@ def free_event(fsrom: FS, loc_id: int):
 class Event:
 
     def __init__(self):
+        # A lazy event (see from_rom) holds the compressed packet until data
+        # is needed and where to read the strings from until they are needed.
+        self.__packet = None
+        self.__string_rom = None
+
         self.num_objects = 0
 
         # self.extra_ptr_st = 0
@@ -134,6 +508,101 @@ class Event:
         self.data = bytearray()
 
         self.strings = []
+        self.modified_strings = False
+
+    # Assigning new data throws away the command index.
+    @property
+    def data(self) -> bytearray:
+        if self.__packet is not None:
+            self.__decompress()
+
+        return self.__data
+
+    @data.setter
+    def data(self, data: bytearray):
+        self.__packet = None
+        self.__data = data
+        self.__cmd_index = None
+
+    @property
+    def num_objects(self) -> int:
+        if self.__packet is not None:
+            self.__decompress()
+
+        return self.__num_objects
+
+    @num_objects.setter
+    def num_objects(self, num_objects: int):
+        self.__num_objects = num_objects
+
+    def __decompress(self):
+        event = decompress(self.__packet, 0)
+        self.__packet = None
+
+        # See from_rom for why the first byte is split off.
+        self.__num_objects = event[0]
+        self.__data = event[1:]
+        self.__cmd_index = None
+
+    # Reading or changing the strings of a lazy event reads them from the
+    # rom first.
+    @property
+    def strings(self) -> list[bytearray]:
+        if self.__string_rom is not None:
+            string_rom = self.__string_rom
+            self.__string_rom = None
+
+            # An FSRom is read through a short-lived view so that it can
+            # still be written to afterwards.
+            if isinstance(string_rom, BytesIO):
+                string_rom = string_rom.getbuffer()
+
+            self.__init_strings(string_rom)
+
+        return self.__strings
+
+    @strings.setter
+    def strings(self, strings: list[bytearray]):
+        self.__string_rom = None
+        self.__strings = strings
+
+    # Whether the strings have been read (and so may have been changed)
+    # since the event was read from the rom.  The strings of an event that
+    # was not read lazily always count as touched.
+    @property
+    def strings_touched(self) -> bool:
+        return self.__string_rom is None
+
+    # Checking modified_strings on a lazy event doesn't read the strings.
+    # They can't have been modified if they haven't been read.
+    @property
+    def modified_strings(self) -> bool:
+        return self.strings_touched and self.__modified_strings
+
+    @modified_strings.setter
+    def modified_strings(self, modified_strings: bool):
+        self.__modified_strings = modified_strings
+
+    # The command index is built on first use.  Changes to the script made
+    # through Event's methods keep it current.  Anything else that changes
+    # the length of commands in data should call invalidate_command_index.
+    def get_command_index(self) -> CommandIndex:
+        if self.__cmd_index is None:
+            self.__cmd_index = \
+                CommandIndex(self.data, self.get_object_start(0))
+
+        return self.__cmd_index
+
+    def invalidate_command_index(self):
+        self.__cmd_index = None
+
+    # Queue up edits and apply them all at once when the block finishes.
+    # Nothing is applied if the block raises.  See EventEditor.
+    @contextmanager
+    def edit(self):
+        editor = EventEditor(self)
+        yield editor
+        editor.apply()
 
     def get_bytearray(self) -> bytearray:
         return bytearray([self.num_objects]) + self.data
@@ -167,6 +636,13 @@ class Event:
         for x in script.strings:
             fsrom.write(x, FSWriteType.MARK_USED)
 
+        # Nothing else uses the new strings yet.
+        if fsrom.string_owners is not None and script.strings:
+            fsrom.string_owners.add_event(
+                get_loc_event_id(fsrom.getbuffer(), loc_id),
+                [(string_index, string_index+total_len)]
+            )
+
         # Now we need to go into the script and update the string index
         string_index_b = to_little_endian(to_rom_ptr(string_index), 3)
 
@@ -181,7 +657,8 @@ class Event:
 
             pos += len(cmd)
 
-        compr_event = compress(script.get_bytearray())
+        compr_event = \
+            compresscache.default_cache.compress(script.get_bytearray())
 
         # debug stuff
         '''
@@ -223,11 +700,27 @@ class Event:
 
     # End write_to_rom_fs
 
-    def from_rom_location(rom: bytearray, loc_id: int) -> Event:
+    def from_rom_location(rom: bytearray, loc_id: int,
+                          lazy: bool = False, cache=None) -> Event:
         ''' Read an event from the specified game location. '''
 
-        ptr = get_loc_event_ptr(rom, loc_id)
-        return Event.from_rom(rom, ptr)
+        # cache is an eventcache.EventCache.  Locations whose script is
+        # unchanged since the cache was made are not decompressed at all.
+        if isinstance(rom, BytesIO):
+            buf = rom.getbuffer()
+            ptr = get_loc_event_ptr(buf, loc_id)
+            if cache is not None:
+                event = cache.get_event(buf, loc_id)
+            del buf
+        else:
+            ptr = get_loc_event_ptr(rom, loc_id)
+            if cache is not None:
+                event = cache.get_event(rom, loc_id)
+
+        if cache is not None and event is not None:
+            return event
+
+        return Event.from_rom(rom, ptr, lazy)
 
     def from_flux(filename: str):
         '''Reads a .flux file and loads it into an Event'''
@@ -304,9 +797,41 @@ class Event:
 
         return ret_script
 
-    def from_rom(rom: bytearray, ptr: int) -> Event:
+    # A lazy event only copies the compressed packet.  It is decompressed
+    # the first time data (or num_objects) is used and the strings are read
+    # from rom the first time they are used.  For lazy events rom should be
+    # an FSRom or bytes that stay around.  A view from getbuffer() can't be
+    # held onto since that would stop the FSRom from being written, so the
+    # strings of such an event are read right away.
+    # The strings are also read right away from an FSRom with string owners.
+    # Its string blocks can be freed (see free_event) and reused before a
+    # lazy read would happen.
+    def from_rom(rom: bytearray, ptr: int, lazy: bool = False) -> Event:
         ret_event = Event()
 
+        if lazy:
+            # get_compressed_length leaves out the final addendum byte of a
+            # packet with addenda, but decompress reads it.
+            if isinstance(rom, BytesIO):
+                buf = rom.getbuffer()
+                packet_len = get_compressed_length(buf, ptr) + 1
+                ret_event.__packet = bytes(buf[ptr:ptr+packet_len])
+                del buf
+            else:
+                packet_len = get_compressed_length(rom, ptr) + 1
+                ret_event.__packet = bytes(rom[ptr:ptr+packet_len])
+
+            if isinstance(rom, memoryview):
+                ret_event.__init_strings(rom)
+            elif getattr(rom, 'string_owners', None) is not None:
+                buf = rom.getbuffer()
+                ret_event.__init_strings(buf)
+                del buf
+            else:
+                ret_event.__string_rom = rom
+
+            return ret_event
+
         event = decompress(rom, ptr)
 
         # Note: The game itself writes all pointers as offsets from the initial
@@ -368,13 +893,14 @@ class Event:
 
         pos = start
         found = False
-        while pos < end:
-            cmd = get_command(self.data, pos)
+        while True:
+            (pos, cmd) = self.find_command([0xB8], pos, end)
+            if pos is None:
+                break
 
-            if cmd.command == 0xB8:
-                string_index = cmd.args[0]
-                found = True
-                # Can maybe just return here.  There should only be one
+            string_index = cmd.args[0]
+            found = True
+            # Can maybe just return here.  There should only be one
 
             pos += len(cmd)
 
@@ -409,15 +935,16 @@ class Event:
         pos = self.get_object_start(0)
 
         str_pos = None
-        while pos < len(self.data):
-            cmd = get_command(self.data, pos)
+        while True:
+            (pos, cmd) = self.find_command([0xB8], pos)
+            if pos is None:
+                break
 
-            if cmd.command == 0xB8:
-                str_pos = cmd.args[0]
-                # print(cmd)
+            str_pos = cmd.args[0]
+            # print(cmd)
 
-                # The string index should only be set once
-                # break
+            # The string index should only be set once
+            # break
 
             pos += len(cmd)
 
@@ -435,13 +962,14 @@ class Event:
         str_addrs = []
 
         pos = self.get_object_start(0)
-        while pos < len(self.data):
-            cmd = get_command(self.data, pos)
+        while True:
+            (pos, cmd) = self.find_command(EC.str_commands, pos)
+            if pos is None:
+                break
 
-            if cmd.command in EC.str_commands:
-                # string index argument is 0th arg
-                str_indices.add(cmd.args[0])
-                str_addrs.append(pos+1)
+            # string index argument is 0th arg
+            str_indices.add(cmd.args[0])
+            str_addrs.append(pos+1)
 
             pos += len(cmd)
 
@@ -510,14 +1038,15 @@ class Event:
         # addresses in the script data where an index is located
         # store these to go back and update the indices if we have to
         pos = self.get_object_start(0)
-        while pos < len(self.data):
-            cmd = get_command(self.data, pos)
+        while True:
+            (pos, cmd) = self.find_command(EC.str_commands, pos)
+            if pos is None:
+                break
 
-            if cmd.command in EC.str_commands:
-                # string index argument is 0th arg.  In other words
-                # index is in self.data[pos+1]
-                self.data[pos+1] = \
-                    self.orig_str_indices.index(self.data[pos+1])
+            # string index argument is 0th arg.  In other words
+            # index is in self.data[pos+1]
+            self.data[pos+1] = \
+                self.orig_str_indices.index(self.data[pos+1])
 
             pos += len(cmd)
 
@@ -570,59 +1099,8 @@ class Event:
     # Worried about what might happen if some of those extra pointers point
     # to routines in the deleted object.
     def remove_object(self, obj_id: int, remove_calls: bool = True):
-
-        if remove_calls:
-            self.__remove_shift_object_calls(obj_id)
-
-        obj_st = self.get_object_start(obj_id)
-
-        if obj_id == self.num_objects-1:
-            obj_end = len(self.data)
-        else:
-            obj_end = self.get_object_start(obj_id+1)
-
-        obj_len = obj_end-obj_st
-
-        # print(f"{obj_st+1:04X} - {obj_end+1:04X}")
-        # input()
-
-        self.__shift_starts(obj_st, -obj_len)
-        self.__shift_starts(-1, -32)
-
-        del(self.data[obj_st:obj_end])
-        del(self.data[32*obj_id:32*(obj_id+1)])
-
-        self.num_objects -= 1
-
-    def __remove_shift_object_calls(self, obj_id):
-        # Remove all calls to object 0xC's functions
-        calls = [2, 3, 4]
-        draw_status = [0x7C, 0x7D]
-
-        obj_cmds = calls + draw_status
-
-        pos = self.get_function_start(0, 0)
-        end = len(self.data)
-        while True:
-            (pos, cmd) = self.find_command(obj_cmds,
-                                           pos, end)
-            if pos is None:
-                break
-            # It just so happens that the draw status commands and the object
-            # call commands use 2*obj_id and have the object in arg0
-            elif cmd.command in obj_cmds:
-                if cmd.args[0] == 2*obj_id:
-                    # print(f"deleted [{pos:04X}] " + str(cmd))
-                    # input()
-                    self.delete_commands(pos, 1)
-                    end = len(self.data)
-                else:
-                    if cmd.args[0] > 2*obj_id:
-                        # print('shifting')
-                        # print(f"[{pos:04X}] " + str(cmd))
-                        # input()
-                        self.data[pos+1] -= 2
-                    pos += len(cmd)
+        with self.edit() as editor:
+            editor.remove_object(obj_id, remove_calls)
 
     def remove_object_calls(self, obj_id):
         # Remove all calls to object 0xC's functions
@@ -694,6 +1172,8 @@ class Event:
         for i in range(1+32*ind, 1+32*(self.num_objects)):
             self.data[i] += ins_data_length
 
+        self.invalidate_command_index()
+
     def print_func_starts(self, obj_id: int):
 
         for i in range(16):
@@ -722,6 +1202,7 @@ class Event:
 
         self.data.extend(obj_data)
         self.num_objects += 1
+        self.invalidate_command_index()
 
         return self.num_objects-1
 
@@ -742,6 +1223,7 @@ class Event:
 
         # Now it's safe to increment the number of objects
         self.num_objects += 1
+        self.invalidate_command_index()
 
         return self.num_objects-1
 
@@ -809,6 +1291,7 @@ class Event:
 
         self.data[func_st_ptr:func_st_ptr+2] = to_little_endian(func_st, 2)
         self.data[func_st:func_end] = ev_func.get_bytearray()
+        self.invalidate_command_index()
 
         for ptr in range(func_st_ptr+2, last_ptr, 2):
             self.data[ptr:ptr+2] = to_little_endian(func_st, 2)
@@ -855,6 +1338,7 @@ class Event:
         # delete object data and pointers
         del(self.data[start:end])
         del(self.data[32*obj_id:32*(obj_id+1)])
+        self.invalidate_command_index()
 
         # update object count
         self.num_objects -= 1
@@ -921,9 +1405,9 @@ class Event:
     def set_string_index(self, rom_ptr: int):
 
         start = self.get_function_start(0, 0)
-        end = self.get_function_start(0, 0)
+        end = self.get_object_end(0)
 
-        pos = self.find_command([0xB8], start, end)
+        (pos, cmd) = self.find_command([0xB8], start, end)
 
         if pos is None:
             # No string index set
@@ -937,7 +1421,7 @@ class Event:
                 self.insert_commands(cmd.to_bytearray(), start)
         else:
             str_ind_bytes = to_little_endian(rom_ptr, 3)
-            self.data[pos+1:pos+3] = str_ind_bytes
+            self.data[pos+1:pos+4] = str_ind_bytes
 
     def find_command(self, cmd_ids: list[int],
                      start_pos: int = None,
@@ -951,6 +1435,36 @@ class Event:
 
         # print(f"{start_pos:04X}, {end_pos:04X}")
 
+        index = self.get_command_index()
+        ind = index.find(start_pos)
+
+        # Not the start of a command, so decode from there as asked.
+        if ind is None:
+            return self.__find_command_linear(cmd_ids, start_pos, end_pos)
+
+        data = self.data
+        offsets = index.offsets
+        cmd_ids = set(cmd_ids)
+
+        for i in range(ind, len(offsets)):
+            pos = offsets[i]
+            if pos >= end_pos:
+                break
+
+            if command_ids[data[pos]] in cmd_ids:
+                cmd = get_command(data, pos)
+
+                # Someone changed a command's length behind our back.
+                if len(cmd) != index.lengths[i]:
+                    self.invalidate_command_index()
+                    return self.find_command(cmd_ids, start_pos, end_pos)
+
+                return (pos, cmd)
+
+        return (None, None)
+
+    def __find_command_linear(self, cmd_ids: list[int],
+                              start_pos: int, end_pos: int) -> (int, EC):
         pos = start_pos
         while pos < end_pos:
             cmd = get_command(self.data, pos)
@@ -974,62 +1488,83 @@ class Event:
         # print(f"{start_pos: 04x}")
         # input()
 
+        # Only commands with the right id need to be compared.
         pos = start_pos
-        while pos < end_pos:
-            cmd = get_command(self.data, pos)
-            # print(f"{cmd.command:02X}" + str(cmd))
+        while True:
+            (pos, cmd) = self.find_command([find_cmd.command], pos, end_pos)
 
-            if cmd == find_cmd:
+            if pos is None:
+                return None
+            elif cmd == find_cmd:
                 return pos
 
             pos += len(cmd)
 
-            # print(f"{find_cmd.command:02X}" + str(find_cmd))
-        return None
-
-    # Helper method to shift all jumps by a given amount.  Typically this
-    # is called for removals/insertions.
-    #   - All forward jumps before before_pos will be shifted forward by
-    #     shift_mag (shift can be negative).
-    #   - All backward jumps after after_pos will be shifted backward by
-    #     shift
-    # The two usual use cases area
-    #   (1) We are inserting some commands at a position x:
-    #       Then before_pos == after_pos == x and shift is the total length
-    #       of the inserted commands.
-    #   (2) We are deleting commands on some interval [a,b):
-    #       Then before_pos = a, after_pos = b and shift is a-b (neg).
-    def __shift_jumps(self, before_pos: int,
-                      after_pos: int,
-                      shift: int):
-        pos = self.get_object_start(0)
-
-        jmp_cmds = EC.fwd_jump_commands + EC.back_jump_commands
+    # Apply a batch of edits to the script in one pass.  Only the jumps near
+    # an edit are looked at, the function starts are read and written as a
+    # block, and the command index is updated rather than rebuilt.
+    def apply_edits(self, edits: EventEdits):
+        if edits.is_empty():
+            return
 
-        while True:
-            # Find the next jump command
-            (pos, cmd) = self.find_command(jmp_cmds, pos)
+        for x in edits.ins_pos:
+            if edits.is_deleted(x) and x not in edits.del_st:
+                print(f"Error: Insertion at {x:04X} is inside a deletion.")
+                exit()
 
-            if pos is None:
-                break
+        index = self.get_command_index()
+        data = self.data
+
+        # Read every affected jump before changing anything.  If a jump has
+        # been edited into something else behind our back, start over with
+        # a fresh index.
+        jumps = []
+        for (start, end) in edits.get_jump_windows():
+            for pos in index.get_jumps(start, end):
+                if command_ids[data[pos]] not in _jump_commands:
+                    self.invalidate_command_index()
+                    return self.apply_edits(edits)
+
+                if not edits.is_deleted(pos):
+                    jumps.append((pos, decode_command(data, pos)))
+
+        # The jump distance is always the last arg and always 1 byte.
+        for (pos, (cmd_id, cmd_len, args)) in jumps:
+            if cmd_id in EC.fwd_jump_commands:
+                target = pos + cmd_len + args[-1] - 1
             else:
-                jump_mult = 2*(cmd.command in EC.fwd_jump_commands)-1
-                jump_target = pos + len(cmd) + cmd.args[-1]*jump_mult - 1
-
-                st = min(jump_target, pos)
-                end = max(jump_target, pos)
-
-                # the >= and < are due to treating [before_pos, after_pos)
-                # as a half open interval (as python tends to do)
-                if end >= after_pos and st < before_pos:
-                    arg_offset = len(cmd) - cmd.arg_lens[-1]
-                    self.data[pos+arg_offset] += shift
-                else:
-                    pass
-                    # print('not shifting')
-                    # input()
+                target = pos - args[-1] + cmd_len - 1
+
+            shift = edits.get_jump_shift(pos, target)
+            if shift != 0:
+                data[pos+cmd_len-1] += shift
+
+        self.__shift_starts_by(edits.get_start_shift)
+
+        # Edits to the pointer block (object removal) are before every
+        # command, so they don't break the index either.
+        def is_aligned(pos):
+            return index.is_boundary(pos) or \
+                (bool(index.offsets) and pos <= index.offsets[0])
+
+        aligned = all(is_aligned(x) for x in edits.ins_pos) and \
+            all(is_aligned(x) for x in edits.del_st) and \
+            all(is_aligned(x) for x in edits.del_end)
+
+        # Keep the same bytearray since callers may hold on to it.
+        if len(edits.ins_pos) == 1 and not edits.del_st:
+            x = edits.ins_pos[0]
+            data[x:x] = edits.ins_data[0]
+        elif len(edits.del_st) == 1 and not edits.ins_pos:
+            del(data[edits.del_st[0]:edits.del_end[0]])
+        else:
+            data[:] = edits.apply(data)
 
-                pos += len(cmd)
+        if aligned:
+            index.apply_edits(edits)
+            index.find_jumps(data)
+        else:
+            self.invalidate_command_index()
 
     # Helper method for dealing with insertions and deletions.
     # All function starts strictly exceeding start_thresh will be shifted
@@ -1044,11 +1579,21 @@ class Event:
     #       the pointer block expanded/contracted.  Use start_thresh <=0 and
     #       shift will be +/- a multiple of 32.
     def __shift_starts(self, start_thresh: int, shift: int):
-        for ptr in range(32*self.num_objects-2, -2, -2):
-            ptr_loc = get_value_from_bytes(self.data[ptr:ptr+2])
-
-            if ptr_loc > start_thresh:
-                self.data[ptr:ptr+2] = to_little_endian(ptr_loc+shift, 2)
+        self.__shift_starts_by(
+            lambda start: shift if start > start_thresh else 0
+        )
+
+    # Move every function start by get_shift(start).  The pointer block is
+    # read in one go and only changed pointers are written back.
+    def __shift_starts_by(self, get_shift):
+        num_ptrs = 16*self.num_objects
+        starts = st.unpack_from(f"<{num_ptrs}H", self.data, 0)
+
+        for (ind, start) in enumerate(starts):
+            shift = get_shift(start)
+            if shift != 0:
+                st.pack_into('<H', self.data, 2*ind,
+                             (start+shift) % 0x10000)
 
     def __shift_calls_back(self, deleted_obj: int):
         pos = self.get_function_start(0, 0)
@@ -1079,85 +1624,20 @@ class Event:
 
             cmd = get_command(self.data, pos)
             cmd_len += len(cmd)
+            pos += len(cmd)
 
-        self.__shift_jumps(before_pos=pos,
-                           after_pos=pos+cmd_len,
-                           shift=-cmd_len)
-
-        self.__shift_starts(start_thresh=del_pos,
-                            shift=-cmd_len)
-
-        del(self.data[del_pos:del_pos+cmd_len])
+        edits = EventEdits()
+        edits.delete(del_pos, del_pos+cmd_len)
+        self.apply_edits(edits)
 
     # This is for short additions.  In particular no string additions are
     # allowed here.  For larger additions, use insert_script, remove_object.
+    # Forward jumps before the position that jump past it and backward
+    # jumps after the position that jump to or before it are lengthened.
     def insert_commands(self, new_commands: bytearray, ins_position: int):
-        # First, look for jump commands prior to the position that jump after
-        # the position
-
-        # print(ins_position)
-        # print(f"{ins_position: 04X}")
-        # input()
-
-        pos = self.get_object_start(0)
-        while pos < ins_position:
-            cmd = get_command(self.data, pos)
-
-            # print(f"[{pos:04X}] {cmd}")
-            # Check for jumps that go over the insertion point
-            # bytes to jump is always in last argument
-            if cmd.command in EC.fwd_jump_commands:
-
-                jump_target = pos + len(cmd) + cmd.args[-1] - 1
-                if jump_target > ins_position:
-
-                    arg_offset = len(cmd) - cmd.arg_lens[-1]
-                    self.data[pos + arg_offset] += len(new_commands)
-
-                    # Test:
-                    # new_cmd = get_command(self.data, pos)
-                    # print(f"New: [{pos:04X}] {new_cmd}")
-
-            pos += len(cmd)
-
-        # print("done forward jumps")
-        # Now check for backwards jump commands after the insertion point that
-        # jump before the insertion point
-
-        pos = ins_position
-        while pos < len(self.data):
-            cmd = get_command(self.data, pos)
-            # print(f"[{pos:04X}] {cmd}")
-
-            if cmd.command in EC.back_jump_commands:
-                jump_target = pos - cmd.args[-1] + len(cmd) - 1
-                # print(f"{jump_target:04X}")
-
-                # We assume our inserted commands are not supposed to be
-                # the jump target.  So we use <=.
-                if jump_target <= ins_position:
-                    arg_offset = len(cmd) - cmd.arg_lens[-1]
-                    self.data[pos+arg_offset] += len(new_commands)
-
-                    # Test:
-                    # new_cmd = get_command(self.data, pos)
-                    # print(f"[{pos:04X}] {new_cmd}")
-
-            pos += len(cmd)
-
-        # print("done backward jumps")
-        self.data[ins_position:ins_position] = new_commands
-
-        # Every function start pointer whose value exceeds the insertion
-        # point should be shifted
-
-        # print(f"Ins Pos: {ins_position: 04X}")
-        for ptr in range(32*self.num_objects-2, -2, -2):
-            ptr_loc = get_value_from_bytes(self.data[ptr:ptr+2])
-
-            if ptr_loc > ins_position:
-                self.data[ptr:ptr+2] = \
-                    to_little_endian(ptr_loc+len(new_commands), 2)
+        edits = EventEdits()
+        edits.insert(ins_position, new_commands)
+        self.apply_edits(edits)
 
     '''
     def get_object(self, obj_id):
@@ -1196,6 +1676,24 @@ def get_compressed_event_length(rom: bytearray, loc_id: int) -> int:
     return get_compressed_length(rom, ptr)
 
 
+# ScriptManager.preload's worker processes.  Each worker gets its own
+# read-only copy of the rom once, when it starts, rather than with every
+# location it is handed.
+_preload_rom = None
+
+
+def _init_preload_worker(rom: bytes):
+    global _preload_rom
+    _preload_rom = rom
+
+
+def _preload_location(loc_id: int) -> Tuple[int, Event, int]:
+    script = Event.from_rom_location(_preload_rom, loc_id)
+    compr_len = get_compressed_event_length(_preload_rom, loc_id)
+
+    return (loc_id, script, compr_len)
+
+
 # Class for reading scripts from an FSRom and writing them back out.
 # The main job of this class is to avoid reading the same script many times
 # when changing a location's key items, sealed chests, bosses, etc.
@@ -1205,19 +1703,33 @@ class ScriptManager:
     def __init__(self, fsrom: FSRom,
                  location_list: list[LocID],
                  loc_data_ptr=0x360000,
-                 event_data_ptr=0x3CF9F0):
+                 event_data_ptr=0x3CF9F0,
+                 compression_cache: compresscache.CompressionCache = None,
+                 event_cache=None):
         self.fsrom = fsrom
 
+        # Scripts are compressed through a cache so that unchanged scripts
+        # are not recompressed.  None means use the module's default cache.
+        self.compression_cache = compression_cache
+
+        # An eventcache.EventCache of the decoded scripts of the base image.
+        # Scripts are read through it when it is set.
+        self.event_cache = event_cache
+
         self.script_dict = {x: None for x in list(LocID)}
         self.orig_len_dict = {x: None for x in list(LocID)}
 
+        # Edits queued with get_script_editor, applied on write
+        self.editor_dict = dict()
+
         # TODO: Just read the ptr from the rom since we have it.
         self.loc_data_ptr = loc_data_ptr
         self.event_data_ptr = event_data_ptr
 
         for x in location_list:
             self.script_dict[x] = \
-                Event.from_rom_location(self.fsrom.getbuffer(), x)
+                Event.from_rom_location(self.fsrom, x, True,
+                                        self.event_cache)
             self.orig_len_dict[x] = \
                 get_compressed_event_length(self.fsrom.getbuffer(), x)
 
@@ -1225,35 +1737,132 @@ class ScriptManager:
     # the copy in the manager.  This is how I think it should be since
     # making copies, editing copies and then re-setting the manager is
     # clunky.
+    # Scripts are read lazily.  A caller that only changes a few bytes never
+    # has the strings read and the script is only decompressed when its
+    # data is first used.
     def get_script(self, loc_id: LocID) -> Event:
         if not self.script_dict[loc_id]:
             self.script_dict[loc_id] = \
-                Event.from_rom_location(self.fsrom.getbuffer(), loc_id)
+                Event.from_rom_location(self.fsrom, loc_id, True,
+                                        self.event_cache)
             self.orig_len_dict[loc_id] = \
                 get_compressed_event_length(self.fsrom.getbuffer(), loc_id)
 
         return self.script_dict[loc_id]
 
+    # Get the shared queue of edits for a location's script.  Every caller
+    # asking for the same location gets the same EventEditor, so edits from
+    # different places land in one rebuild of the script when it is written
+    # (or when apply_script_edits is called).  Positions are in the script
+    # from get_script as it is before any queued edits, so don't mix queued
+    # edits with direct edits of the same script.
+    def get_script_editor(self, loc_id: LocID) -> EventEditor:
+        if loc_id not in self.editor_dict:
+            self.editor_dict[loc_id] = EventEditor(self.get_script(loc_id))
+
+        return self.editor_dict[loc_id]
+
+    # Apply the queued edits for one location or for all of them.
+    def apply_script_edits(self, loc_id: LocID = None):
+        if loc_id is None:
+            loc_ids = list(self.editor_dict.keys())
+        elif loc_id in self.editor_dict:
+            loc_ids = [loc_id]
+        else:
+            loc_ids = []
+
+        for x in loc_ids:
+            self.editor_dict.pop(x).apply()
+
+    # Read the scripts for many locations up front instead of one at a time
+    # as get_script is called.  With more than one worker the locations are
+    # decompressed and parsed in a process pool.  workers=None uses one per
+    # cpu.  The pool only pays off for many uncached locations, and a frozen
+    # front end must call multiprocessing.freeze_support to start it, so the
+    # default is to read them here.  Locations that are already loaded are
+    # left alone.
+    # Returns the scripts of all of the given locations.
+    def preload(self, loc_ids: list[LocID],
+                workers: int = 1) -> dict[LocID, Event]:
+        loc_ids = list(dict.fromkeys(loc_ids))
+        new_loc_ids = [x for x in loc_ids if not self.script_dict[x]]
+
+        # Cached scripts are cheaper to read here than to send back from a
+        # worker.  Only the misses go to the pool.
+        if self.event_cache is not None:
+            buf = self.fsrom.getbuffer()
+            for loc_id in new_loc_ids:
+                script = self.event_cache.get_event(buf, loc_id)
+                if script is not None:
+                    self.script_dict[loc_id] = script
+                    self.orig_len_dict[loc_id] = \
+                        get_compressed_event_length(buf, loc_id)
+            del buf
+
+            new_loc_ids = [x for x in new_loc_ids if not self.script_dict[x]]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        workers = min(workers, len(new_loc_ids))
+
+        if workers <= 1:
+            for loc_id in new_loc_ids:
+                self.get_script(loc_id)
+        else:
+            rom = self.fsrom.getvalue()
+
+            # Hand the locations out in a few big chunks.  Each one is only
+            # a few ms of work.
+            chunksize = max(1, len(new_loc_ids)//(4*workers))
+
+            with ProcessPoolExecutor(workers,
+                                     initializer=_init_preload_worker,
+                                     initargs=(rom,)) as pool:
+                results = pool.map(_preload_location, new_loc_ids,
+                                   chunksize=chunksize)
+
+                for (loc_id, script, compr_len) in results:
+                    self.script_dict[loc_id] = script
+                    self.orig_len_dict[loc_id] = compr_len
+
+        return {x: self.script_dict[x] for x in loc_ids}
+
     def set_script(self, script, loc_id: LocID):
         if self.script_dict[loc_id] is None:
             self.orig_len_dict[loc_id] = \
-                get_compressed_length(self.fsrom.getbuffer(), loc_id)
+                get_compressed_event_length(self.fsrom.getbuffer(), loc_id)
 
+        # Edits queued for the old script don't apply to the new one.
+        self.editor_dict.pop(loc_id, None)
         self.script_dict[loc_id] = script
 
     def free_script(self, loc_id: LocID):
         script = self.get_script(loc_id)
-        script_ptr = get_loc_event_ptr(self.fsrom.getbuffer(), loc_id)
-        script_compr_len = self.orig_len_dict[loc_id]
+
+        buf = self.fsrom.getbuffer()
+        event_id = get_loc_event_id(buf, loc_id)
+        script_ptr = get_event_ptr(buf, event_id)
+
+        # The length of the packet there now.  Another location with the
+        # same event id may have written a new packet since this script was
+        # read, so orig_len_dict can be for a different packet.
+        script_compr_len = get_compressed_length(buf, script_ptr)
+        shared = is_event_packet_shared(buf, event_id, script_ptr)
+        del buf
 
         spaceman = self.fsrom.space_manager
 
-        if script.modified_strings:
-            # Do something to free the strings.
-            # This will take some more sophistication to do correctly.
-            pass
+        # The script will get new strings.  The old ones can go if no other
+        # script uses them, which only the string owners know.
+        owners = self.fsrom.string_owners
+        if script.modified_strings and owners is not None:
+            for block in owners.release_event(event_id):
+                spaceman.mark_block(block, FSWriteType.MARK_FREE)
 
-        spaceman.mark_block((script_ptr, script_ptr+script_compr_len), True)
+        if not shared:
+            spaceman.mark_block((script_ptr, script_ptr+script_compr_len),
+                                FSWriteType.MARK_FREE)
 
     # writes the script to the specified locations
     def write_script_to_rom(self, loc_id: LocID):
@@ -1261,9 +1870,12 @@ class ScriptManager:
 
         spaceman = self.fsrom.space_manager
 
+        self.apply_script_edits(loc_id)
         self.free_script(loc_id)
         script = self.get_script(loc_id)
 
+        # Scripts whose strings were never touched skip this without the
+        # strings ever being read.
         if script.modified_strings:
             # We need to find space for the new strings
             strings_len = sum(len(x) for x in script.strings)
@@ -1287,10 +1899,20 @@ class ScriptManager:
             for x in script.strings:
                 self.fsrom.write(x, FSWriteType.MARK_USED)
 
-            # script.set_string_index(to_rom_ptr(string_index))
+            script.set_string_index(to_rom_ptr(string_index))
+
+            if self.fsrom.string_owners is not None:
+                self.fsrom.string_owners.add_event(
+                    get_loc_event_id(self.fsrom.getbuffer(), loc_id),
+                    [(string_index, string_index+total_len)]
+                )
 
         # The rest is mostly straightforward
-        compr_event = compress(script.get_bytearray())
+        cache = self.compression_cache
+        if cache is None:
+            cache = compresscache.default_cache
+
+        compr_event = cache.compress(script.get_bytearray())
         script_ptr = spaceman.get_free_addr(len(compr_event))
 
         self.fsrom.seek(script_ptr)
@@ -1311,7 +1933,7 @@ class ScriptManager:
 
         # When the script is written, update the orig len and modified_strings.
         # Just in case we end up modifying and writing again.
-        self.modified_strings = False
+        script.modified_strings = False
         self.orig_len_dict[loc_id] = len(compr_event)
     # End of write_script_to_rom
 # End class ScriptManager
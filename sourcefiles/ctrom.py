@@ -34,6 +34,10 @@ class CTRom():
         self.rom_data = FSRom(rom, False)
         self.script_manager = ScriptManager(self.rom_data, [])
 
+        # A patchanchors.AnchorTable of the places in the scripts that the
+        # boss and treasure writers change.  Without one they search.
+        self.patch_anchors = None
+
     @classmethod
     def from_file(cls, filename: str, ignore_checksum=False):
         with open(filename, 'rb') as infile:
@@ -41,6 +45,14 @@ class CTRom():
 
         return cls(rom_bytes, ignore_checksum)
 
+    # The patch points of a location's script (a
+    # patchanchors.LocationAnchors) or None if there is no anchor table.
+    def get_location_anchors(self, loc_id: LocID):
+        if self.patch_anchors is None:
+            return None
+
+        return self.patch_anchors.get_location(loc_id)
+
     def write_all_scripts_to_rom(self):
         script_dict = self.script_manager.script_dict
         for loc_id in script_dict.keys():
@@ -287,7 +287,8 @@ late_bosses = [
 
 # This method just alters the cfg.RandoConfig object.
 def write_enemy_rewards_to_config(settings: rset.Settings,
-                                  config: cfg.RandoConfig):
+                                  config: cfg.RandoConfig,
+                                  rng=random):
 
     # Maybe this dict can be set up globally with the enemy lists
     enemy_group_dict = dict()
@@ -305,13 +306,13 @@ def write_enemy_rewards_to_config(settings: rset.Settings,
             get_distributions(group, settings.item_difficulty)
 
         for enemy in enemies:
-            drop = drop_dist.get_random_item()
+            drop = drop_dist.get_random_item(rng)
             if charm_dist is None:
                 charm = drop
             else:
-                charm = charm_dist.get_random_item()
+                charm = charm_dist.get_random_item(rng)
 
-            if random.random() > drop_rate:
+            if rng.random() > drop_rate:
                 drop = ItemID.NONE
 
             config.enemy_dict[enemy].drop_item = drop
@@ -0,0 +1,272 @@
+from __future__ import annotations
+import hashlib
+import mmap
+import os
+import struct as st
+from io import BytesIO
+
+from ctdecompress import get_compressed_length
+from ctevent import Event, get_loc_event_ptr
+
+
+# Persistent cache of decoded location events.
+# Every seed made from the same base image (same rom, same start up patches)
+# starts out with the same location scripts.  The cache stores each
+# location's decompressed script, object count, string table and
+# compressed length in one file so that a new process can skip
+# decompressing and string hunting entirely.
+#
+# Entries are only used if the location still points at the same,
+# unchanged compressed packet.  So a script that was rewritten during the
+# run (e.g. by bossrandoevent.duplicate_maps) is read from the rom as usual.
+#
+# Cache file layout (little endian):
+#   header:  'CTEC', version (1 byte), sha1 of the key (20 bytes),
+#            entry count (4 bytes)
+#   entries: location (2 bytes), event pointer (4 bytes), compressed
+#            length (4 bytes), sha1 of the compressed packet (20 bytes),
+#            object count (1 byte), data offset (4 bytes), data length
+#            (4 bytes), string index (4 bytes, signed, -1 for none),
+#            strings offset (4 bytes), string count (2 bytes)
+#   payload: script data and strings.  Each string is its original index
+#            (1 byte), its length (2 bytes) and its bytes.  Locations that
+#            share a script share the payload.  Offsets are from the start
+#            of the payload.
+cache_magic = b'CTEC'
+cache_version = 1
+
+_header = st.Struct('<4sB20sI')
+_entry = st.Struct('<HII20sBIIiIH')
+_string = st.Struct('<BH')
+
+# Location ids run from 0x000 to 0x1EF
+num_locations = 0x1F0
+
+
+class EventCacheEntry:
+
+    def __init__(self, ptr: int, compr_len: int, digest: bytes,
+                 num_objects: int, data: bytes, orig_str_index: int,
+                 orig_str_indices: list[int], strings: list[bytes]):
+        self.ptr = ptr
+        self.compr_len = compr_len
+        self.digest = digest
+        self.num_objects = num_objects
+        self.data = data
+        self.orig_str_index = orig_str_index
+        self.orig_str_indices = orig_str_indices
+        self.strings = strings
+
+    @classmethod
+    def from_event(cls, rom, ptr: int, event: Event) -> EventCacheEntry:
+        compr_len = get_compressed_length(rom, ptr)
+        digest = hashlib.sha1(rom[ptr:ptr+compr_len]).digest()
+
+        return cls(ptr, compr_len, digest, event.num_objects,
+                   bytes(event.data), event.orig_str_index,
+                   list(event.orig_str_indices),
+                   [bytes(x) for x in event.strings])
+
+    # A new Event with the cached contents, the same as Event.from_rom
+    # would have made.
+    def to_event(self) -> Event:
+        event = Event()
+        event.num_objects = self.num_objects
+        event.data = bytearray(self.data)
+        event.strings = [bytearray(x) for x in self.strings]
+        event.orig_str_index = self.orig_str_index
+        event.orig_str_indices = list(self.orig_str_indices)
+        event.modified_strings = False
+
+        return event
+
+
+class EventCache:
+
+    def __init__(self, key_digest: bytes):
+        self.key_digest = key_digest
+
+        # location id -> EventCacheEntry
+        self.entries = dict()
+
+        self.hits = 0
+        self.misses = 0
+
+    # Decode every location's event from rom.  rom should be the base image
+    # that the key describes.
+    @classmethod
+    def from_rom(cls, rom, key_digest: bytes) -> EventCache:
+        cache = cls(key_digest)
+
+        # Many locations share a script.  Decode each one once.
+        ptr_entries = dict()
+        for loc_id in range(num_locations):
+            ptr = get_loc_event_ptr(rom, loc_id)
+
+            if ptr not in ptr_entries:
+                event = Event.from_rom(rom, ptr)
+                ptr_entries[ptr] = EventCacheEntry.from_event(rom, ptr, event)
+
+            cache.entries[loc_id] = ptr_entries[ptr]
+
+        return cache
+
+    # Read a cache file.  Returns None if the file isn't a cache file.
+    @classmethod
+    def from_file(cls, filename: str) -> EventCache:
+        with open(filename, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                return cls.__from_buffer(mapped)
+
+    @classmethod
+    def __from_buffer(cls, buf) -> EventCache:
+        if len(buf) < _header.size:
+            return None
+
+        (magic, version, key_digest, count) = _header.unpack_from(buf, 0)
+
+        if magic != cache_magic or version != cache_version:
+            return None
+
+        cache = cls(key_digest)
+        payload_st = _header.size + count*_entry.size
+
+        # Entries that share a payload offset share the entry object too.
+        offset_entries = dict()
+
+        pos = _header.size
+        for i in range(count):
+            (loc_id, ptr, compr_len, digest, num_objects, data_off,
+             data_len, str_index, str_off, num_strings) = \
+                _entry.unpack_from(buf, pos)
+            pos += _entry.size
+
+            if data_off not in offset_entries:
+                data_st = payload_st + data_off
+                data = bytes(buf[data_st:data_st+data_len])
+
+                str_indices = []
+                strings = []
+                str_pos = payload_st + str_off
+                for j in range(num_strings):
+                    (index, str_len) = _string.unpack_from(buf, str_pos)
+                    str_pos += _string.size
+
+                    str_indices.append(index)
+                    strings.append(bytes(buf[str_pos:str_pos+str_len]))
+                    str_pos += str_len
+
+                if str_index < 0:
+                    str_index = None
+
+                offset_entries[data_off] = \
+                    EventCacheEntry(ptr, compr_len, digest, num_objects, data,
+                                    str_index, str_indices, strings)
+
+            cache.entries[loc_id] = offset_entries[data_off]
+
+        return cache
+
+    def to_file(self, filename: str):
+        entries = bytearray()
+        payload = bytearray()
+
+        # id of entry -> (data offset, strings offset)
+        offsets = dict()
+
+        for (loc_id, entry) in sorted(self.entries.items()):
+            if id(entry) not in offsets:
+                data_off = len(payload)
+                payload += entry.data
+
+                str_off = len(payload)
+                for (index, string) in zip(entry.orig_str_indices,
+                                           entry.strings):
+                    payload += _string.pack(index, len(string))
+                    payload += string
+
+                offsets[id(entry)] = (data_off, str_off)
+
+            (data_off, str_off) = offsets[id(entry)]
+
+            str_index = entry.orig_str_index
+            if str_index is None:
+                str_index = -1
+
+            entries += _entry.pack(loc_id, entry.ptr, entry.compr_len,
+                                   entry.digest, entry.num_objects, data_off,
+                                   len(entry.data), str_index, str_off,
+                                   len(entry.strings))
+
+        data = _header.pack(cache_magic, cache_version, self.key_digest,
+                            len(self.entries)) + entries + payload
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated cache behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            outfile.write(data)
+
+        os.replace(tmp_filename, filename)
+
+    # The cached event for a location or None if the location's script in
+    # rom is not the one that was cached.  Used by Event.from_rom_location.
+    def get_event(self, rom, loc_id: int) -> Event:
+        entry = self.entries.get(loc_id)
+
+        if entry is not None:
+            ptr = get_loc_event_ptr(rom, loc_id)
+            end = ptr + entry.compr_len
+
+            if ptr == entry.ptr and \
+               hashlib.sha1(rom[ptr:end]).digest() == entry.digest:
+                self.hits += 1
+                return entry.to_event()
+
+        self.misses += 1
+        return None
+
+    def print_stats(self):
+        print(f"Event cache: {self.hits} hits, {self.misses} misses")
+
+
+def get_key_digest(key: str) -> bytes:
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+
+def get_cache_filename(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.events')
+
+
+# Get the event cache for a base image, reading it from cache_dir if it was
+# made before and otherwise decoding every location of rom and saving the
+# result there.  key identifies the base image (the rom and the patches
+# applied to it, see basesnapshot.get_snapshot_key).  rom may be an FSRom.
+def load_event_cache(cache_dir: str, key: str, rom) -> EventCache:
+    filename = get_cache_filename(cache_dir, key)
+    key_digest = get_key_digest(key)
+
+    if os.path.exists(filename):
+        try:
+            cache = EventCache.from_file(filename)
+        except (OSError, ValueError, st.error):
+            cache = None
+
+        if cache is not None and cache.key_digest == key_digest:
+            return cache
+
+        print(f"Warning: Ignoring unusable event cache {filename}")
+
+    if isinstance(rom, BytesIO):
+        rom = rom.getvalue()
+
+    cache = EventCache.from_rom(rom, key_digest)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache.to_file(filename)
+    except OSError as err:
+        print(f"Warning: Unable to save event cache {filename}: {err}")
+
+    return cache
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from byteops import to_little_endian, get_value_from_bytes
+from byteops import to_little_endian
 from enum import Enum, auto
+from typing import NamedTuple, Tuple
 
 
 # Small enum to store the synchronization scheme when a function is called
@@ -10,6 +11,27 @@ class FuncSync(Enum):
     CONT = auto()
     SYNC = auto()
 
+
+# The parts of a command that never change: its layout and descriptions.
+# Every EventCommand points at one of these instead of carrying its own
+# copies.  command_specs (below the command table) has the spec for every
+# command byte along with the jump/string classification.
+class CommandSpec(NamedTuple):
+    command: int
+    num_args: int
+    arg_lens: Tuple[int, ...]
+    arg_descs: Tuple[str, ...]
+    name: str
+    desc: str
+
+    # Length of the command including the command byte.  Only meaningful
+    # for commands that are not variable length.
+    length: int = 1
+    is_fwd_jump: bool = False
+    is_back_jump: bool = False
+    is_str: bool = False
+
+
 class EventCommand:
 
     str_commands = [0xBB, 0xC0, 0xC1, 0xC2, 0xC3, 0xC4]
@@ -27,15 +49,19 @@ class EventCommand:
     back_jump_commands = [0x11]
     back_jump_arg_pos = [-1]
 
+    # Decoded commands are made in bulk, so keep them small.  A command read
+    # by get_command keeps the command's bytes and only splits them into
+    # args when args is first used.
+    __slots__ = ['command', 'spec', 'arg_lens', 'logical_args',
+                 '__args', '__raw']
+
     def __init__(self, command, num_args,
                  arg_lens, arg_descs,
                  name, desc):
         self.command = command
-        self.num_args = num_args
-        self.arg_lens = arg_lens
-        self.arg_descs = arg_descs
-        self.name = name
-        self.desc = desc
+        self.spec = CommandSpec(command, num_args, tuple(arg_lens),
+                                tuple(arg_descs), name, desc)
+        self.arg_lens = tuple(arg_lens)
 
         # These are the actual arguments from the string of bytes in the script
         self.args = []
@@ -43,6 +69,66 @@ class EventCommand:
         # These are the decoded args
         self.logical_args = []
 
+    # A command read from a script.  Nothing is copied from the spec.
+    @classmethod
+    def from_spec(cls, spec: CommandSpec, arg_lens, raw: bytes):
+        ret = cls.__new__(cls)
+        ret.command = spec.command
+        ret.spec = spec
+        ret.arg_lens = arg_lens
+        ret.logical_args = []
+        ret.__args = None
+        ret.__raw = raw
+
+        return ret
+
+    @property
+    def args(self) -> list[int]:
+        if self.__args is None:
+            self.__args = list(get_args(self.__raw, 1, self.arg_lens))
+            self.__raw = None
+
+        return self.__args
+
+    @args.setter
+    def args(self, args: list[int]):
+        self.__args = args
+        self.__raw = None
+
+    # Specs are shared, so changing a description swaps in a new spec for
+    # just this command.  Only the command table itself does this.
+    @property
+    def num_args(self) -> int:
+        return self.spec.num_args
+
+    @num_args.setter
+    def num_args(self, num_args: int):
+        self.spec = self.spec._replace(num_args=num_args)
+
+    @property
+    def arg_descs(self) -> Tuple[str, ...]:
+        return self.spec.arg_descs
+
+    @arg_descs.setter
+    def arg_descs(self, arg_descs):
+        self.spec = self.spec._replace(arg_descs=tuple(arg_descs))
+
+    @property
+    def name(self) -> str:
+        return self.spec.name
+
+    @name.setter
+    def name(self, name: str):
+        self.spec = self.spec._replace(name=name)
+
+    @property
+    def desc(self) -> str:
+        return self.spec.desc
+
+    @desc.setter
+    def desc(self, desc: str):
+        self.spec = self.spec._replace(desc=desc)
+
     def __eq__(self, other):
         return self.command == other.command and self.args == other.args
 
@@ -189,14 +275,8 @@ class EventCommand:
         return EventCommand.generic_one_arg(0xB8, str_ind_rom)
 
     def copy(self) -> EventCommand:
-        ret_command = EventCommand(-1, 0, [], [], '', '')
+        ret_command = EventCommand.from_spec(self.spec, self.arg_lens, None)
         ret_command.command = self.command
-        ret_command.num_args = self.num_args
-        ret_command.arg_lens = self.arg_lens[:]
-        ret_command.arg_descs = self.arg_descs[:]
-        ret_command.name = self.name
-        ret_command.desc = self.desc
-
         ret_command.args = self.args[:]
 
         return ret_command
@@ -1846,57 +1926,138 @@ event_commands[0xFF] = \
                  'Mode 7 Scene.')
 
 
-def get_command(buf: bytearray, offset: int) -> EventCommand:
+# Immutable per command byte metadata.  Built from the final state of
+# event_commands, so aliased bytes get the spec of the command they alias.
+def _make_spec(command: EventCommand) -> CommandSpec:
+    cmd_id = command.command
+    return CommandSpec(cmd_id, command.num_args, tuple(command.arg_lens),
+                       command.arg_descs, command.name, command.desc,
+                       1 + sum(command.arg_lens),
+                       cmd_id in EventCommand.fwd_jump_commands,
+                       cmd_id in EventCommand.back_jump_commands,
+                       cmd_id in EventCommand.str_commands)
 
-    command_id = buf[offset]
-    command = event_commands[command_id].copy()
 
-    # print(command)
-    # input()
+command_specs = [_make_spec(cmd) for cmd in event_commands]
+
+# Commands whose length depends on their first argument.  get_command sorts
+# these out.
+variable_length_commands = [0x2E, 0x88, 0xF1, 0xFF]
+
+# Length of every other command, including the command byte
+command_lengths = [spec.length for spec in command_specs]
+
+# The id get_command reports for each command byte.  Aliases report the
+# id of the command they alias.
+command_ids = [spec.command for spec in command_specs]
+
+
+# The arg layout of a variable length command.  The spec's layout is right
+# for everything else.
+def _get_var_arg_lens(buf, offset: int, command_id: int) -> Tuple[int, ...]:
+    arg_lens = command_specs[command_id].arg_lens
 
     if command_id == 0x2E:
         mode = buf[offset+1] >> 4
         if mode in [4, 5]:
-            command.arg_lens = [1, 1, 1, 1, 1]
+            arg_lens = (1, 1, 1, 1, 1)
         elif mode == 8:
-            command.arg_lens = [1, 1, 2]
+            arg_lens = (1, 1, 2)
         else:
             print(f"{command_id:02X}: Error, Unknown Mode")
             input()
     elif command_id == 0x88:
         mode = buf[offset+1] >> 4
         if mode == 0:
-            command.arg_lens = [1]
+            arg_lens = (1,)
         elif mode in [2, 3]:
-            command.arg_lens = [1, 1, 1]
+            arg_lens = (1, 1, 1)
         elif mode in [4, 5]:
-            command.arg_lens = [1, 1, 1, 1]
+            arg_lens = (1, 1, 1, 1)
         elif mode == 8:
             # bytes to copy follow command
             copy_len = buf[offset+2] - 2
-            command.arg_lens = [1, 1, 1, copy_len]
+            arg_lens = (1, 1, 1, copy_len)
         else:
             print(f"{command_id:02X}: Error, Unknown Mode")
             input()
     elif command_id == 0xF1:
         color = buf[offset+1]
         if color == 0:
-            command.arg_lens = [1]
+            arg_lens = (1,)
         else:
-            command.arg_lens = [1, 1]
+            arg_lens = (1, 1)
     elif command_id == 0xFF:  # Mode7 scenes can be weird
         scene = buf[offset+1]
         if scene == 0x90:
-            command.arg_lens = [1, 1, 1, 1]
+            arg_lens = (1, 1, 1, 1)
         if scene == 0x97:
-            command.arg_lens = [1, 1, 1]
+            arg_lens = (1, 1, 1)
+
+    return arg_lens
 
-    # Now we can use arg_lens to extract the args
-    pos = offset + 1
-    command.args = []
 
-    for i in command.arg_lens:
-        command.args.append(get_value_from_bytes(buf[pos:pos+i]))
+# Little endian args laid out by arg_lens starting at buf[pos]
+def get_args(buf, pos: int, arg_lens) -> Tuple[int, ...]:
+    # A command cut off by the end of the buffer reads what is there.
+    short = pos + sum(x for x in arg_lens if x > 0) > len(buf)
+
+    args = []
+    for i in arg_lens:
+        if i == 1 and not short:
+            args.append(buf[pos])
+        else:
+            args.append(int.from_bytes(buf[pos:pos+i], 'little'))
         pos += i
 
-    return command
+    return tuple(args)
+
+
+def get_command(buf: bytearray, offset: int) -> EventCommand:
+
+    command_id = buf[offset]
+    spec = command_specs[command_id]
+
+    if command_id in variable_length_commands:
+        arg_lens = _get_var_arg_lens(buf, offset, command_id)
+        cmd_len = 1 + sum(arg_lens)
+    else:
+        arg_lens = spec.arg_lens
+        cmd_len = spec.length
+
+    # A bogus copy length (0x88 mode 8) can make the args run past the
+    # command's end.  Read those right away.
+    if cmd_len < 1 + len(arg_lens):
+        command = EventCommand.from_spec(spec, arg_lens, None)
+        command.args = list(get_args(buf, offset+1, arg_lens))
+        return command
+
+    # Keep a copy of the bytes rather than a view.  A view would stop the
+    # script's bytearray from being resized while the command is alive.
+    return EventCommand.from_spec(spec, arg_lens,
+                                  bytes(buf[offset:offset+cmd_len]))
+
+
+# For hot loops that only need the numbers: (command id, length, args)
+# without building an EventCommand.
+def decode_command(buf, offset: int) -> Tuple[int, int, Tuple[int, ...]]:
+    command_id = buf[offset]
+
+    if command_id in variable_length_commands:
+        arg_lens = _get_var_arg_lens(buf, offset, command_id)
+    else:
+        arg_lens = command_specs[command_id].arg_lens
+
+    return (command_ids[command_id], 1 + sum(arg_lens),
+            get_args(buf, offset+1, arg_lens))
+
+
+# Same as len(get_command(buf, offset)) without making the command or
+# reading the args.  Used for walking over a script.
+def get_command_length(buf: bytearray, offset: int) -> int:
+    command_id = buf[offset]
+
+    if command_id in variable_length_commands:
+        return 1 + sum(_get_var_arg_lens(buf, offset, command_id))
+
+    return command_lengths[command_id]
@@ -0,0 +1,230 @@
+from __future__ import annotations
+from bisect import bisect_right
+from io import BytesIO
+import os
+import pickle
+from typing import NamedTuple, Tuple
+
+from ctevent import Event, get_loc_event_ptr
+from eventcommand import decode_command
+
+
+# Queries over the commands of every location script.
+# The writers find the commands they change (LoadEnemy, ChangeLocation, ...)
+# by scanning the functions they expect them in.  EventQueryIndex reads
+# every location's script once and indexes every command by its id so that
+# questions like "every ChangeLocation to location 0x1B6" are dictionary
+# lookups:
+#     index.find([0xDC, 0xDD, 0xDE, 0xDF, 0xE0, 0xE1],
+#                args={0: 0x1B6}, masks={0: 0x1FF})
+#
+# The index describes the base image it was built from.  Scripts changed
+# afterwards are not seen.
+#
+# Built indices are pickled per base image like basesnapshot does.
+query_version = 1
+
+# Location ids run from 0x000 to 0x1EF
+num_locations = 0x1F0
+
+
+# Where one command was found.  offset is into Event.data.  command and
+# args are as EventCommand would have them (command is find_command's id).
+class CommandHit(NamedTuple):
+    loc_id: int
+    obj_id: int
+    func_id: int
+    offset: int
+    command: int
+    args: Tuple[int, ...]
+
+
+class EventQueryIndex:
+
+    def __init__(self, hits: list[CommandHit]):
+        self.version = query_version
+
+        # Every command of every location, by location then offset
+        self.hits = hits
+
+        # command id -> indices into hits
+        self.by_command = dict()
+        for ind, hit in enumerate(hits):
+            self.by_command.setdefault(hit.command, []).append(ind)
+
+        # (command id, arg index, mask) -> {masked arg value -> indices into
+        # hits}.  Each is made the first time a query needs it.
+        self.__arg_tables = dict()
+
+    # Read every location's script.  Scripts are read through event_cache
+    # (an eventcache.EventCache) if one is given.
+    @classmethod
+    def from_rom(cls, rom, event_cache=None) -> EventQueryIndex:
+        hits = []
+
+        # Many locations share a script.  Decode each one once.
+        ptr_commands = dict()
+        for loc_id in range(num_locations):
+            ptr = get_loc_event_ptr(rom, loc_id)
+
+            if ptr not in ptr_commands:
+                event = Event.from_rom_location(rom, loc_id, True,
+                                                event_cache)
+                ptr_commands[ptr] = get_event_commands(event)
+
+            hits.extend(CommandHit(loc_id, *x) for x in ptr_commands[ptr])
+
+        return cls(hits)
+
+    # The commands with one of the given ids whose args match.  args maps
+    # an arg index to the value it must have.  masks optionally maps an arg
+    # index to a mask applied to the arg before comparing (e.g. 0x1FF for
+    # the location of a ChangeLocation, whose other bits are flags).
+    def find(self, cmd_ids, args: dict[int, int] = None,
+             masks: dict[int, int] = None) -> list[CommandHit]:
+        if isinstance(cmd_ids, int):
+            cmd_ids = [cmd_ids]
+
+        if args is None:
+            args = dict()
+
+        if masks is None:
+            masks = dict()
+
+        found = []
+        for cmd_id in cmd_ids:
+            if cmd_id not in self.by_command:
+                continue
+
+            if not args:
+                found.extend(self.by_command[cmd_id])
+                continue
+
+            # Intersect the matches of each arg, smallest first.
+            matches = [
+                self.__get_arg_table(cmd_id, arg_ind, masks.get(arg_ind))
+                .get(value, [])
+                for (arg_ind, value) in args.items()
+            ]
+            matches.sort(key=len)
+
+            if len(matches) == 1:
+                found.extend(matches[0])
+            else:
+                others = [set(x) for x in matches[1:]]
+                found.extend(ind for ind in matches[0]
+                             if all(ind in x for x in others))
+
+        return [self.hits[ind] for ind in sorted(found)]
+
+    # The locations with at least one matching command
+    def find_locations(self, cmd_ids, args: dict[int, int] = None,
+                       masks: dict[int, int] = None) -> list[int]:
+        hits = self.find(cmd_ids, args, masks)
+        return list(dict.fromkeys(hit.loc_id for hit in hits))
+
+    def __get_arg_table(self, cmd_id: int, arg_ind: int, mask: int):
+        key = (cmd_id, arg_ind, mask)
+
+        if key not in self.__arg_tables:
+            table = dict()
+            for ind in self.by_command[cmd_id]:
+                cmd_args = self.hits[ind].args
+                if arg_ind >= len(cmd_args):
+                    continue
+
+                value = cmd_args[arg_ind]
+                if mask is not None:
+                    value &= mask
+
+                table.setdefault(value, []).append(ind)
+
+            self.__arg_tables[key] = table
+
+        return self.__arg_tables[key]
+
+    # Only the hits are saved.  The rest is rebuilt on load.
+    def __getstate__(self):
+        return {'version': self.version, 'hits': self.hits}
+
+    def __setstate__(self, state):
+        self.__init__(state['hits'])
+        self.version = state['version']
+
+
+# (obj_id, func_id, offset, command id, args) for every command of an event.
+# A command belongs to the function whose start is the closest one before
+# it.  Functions that share a start (unused ones often do) get the lowest
+# function id.
+def get_event_commands(event: Event) -> list[Tuple[int, int, int, int,
+                                                   Tuple[int, ...]]]:
+    data = event.data
+
+    func_starts = []
+    func_ids = []
+    for obj_id in range(event.num_objects):
+        for func_id in range(16):
+            start = event.get_function_start(obj_id, func_id)
+            if not func_starts or start > func_starts[-1]:
+                func_starts.append(start)
+                func_ids.append((obj_id, func_id))
+
+    commands = []
+    pos = event.get_object_start(0)
+    while pos < len(data):
+        (cmd_id, cmd_len, args) = decode_command(data, pos)
+
+        ind = max(0, bisect_right(func_starts, pos) - 1)
+        (obj_id, func_id) = func_ids[ind]
+        commands.append((obj_id, func_id, pos, cmd_id, args))
+
+        pos += cmd_len
+
+    return commands
+
+
+def get_index_filename(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.query')
+
+
+# Get the query index of a base image, reading it from cache_dir if it was
+# built before and otherwise building it from rom and saving it there.  key
+# identifies the base image (see basesnapshot.get_snapshot_key).  rom may
+# be an FSRom.
+def load_query_index(cache_dir: str, key: str, rom,
+                     event_cache=None) -> EventQueryIndex:
+    filename = get_index_filename(cache_dir, key)
+
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as infile:
+                index = pickle.load(infile)
+        except (OSError, pickle.UnpicklingError, EOFError,
+                AttributeError, ImportError):
+            index = None
+
+        if isinstance(index, EventQueryIndex) and \
+           index.version == query_version:
+            return index
+
+        print(f"Warning: Ignoring unusable query index {filename}")
+
+    if isinstance(rom, BytesIO):
+        rom = rom.getvalue()
+
+    index = EventQueryIndex.from_rom(rom, event_cache)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated index behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            pickle.dump(index, outfile, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_filename, filename)
+    except (OSError, pickle.PicklingError) as err:
+        print(f"Warning: Unable to save query index {filename}: {err}")
+
+    return index
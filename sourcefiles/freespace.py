@@ -1,7 +1,10 @@
 # I am fed up with hardcoding write locations.
 from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 from enum import Enum
 from io import BytesIO
+import random
 from typing import Tuple
 
 from byteops import get_value_from_bytes_be  # for ips marker
@@ -13,6 +16,86 @@ class FSWriteType(Enum):
     NO_MARK = 2
 
 
+# Rules for what counts as room in a bank when allocating same-bank data.
+#   - bank_size: Size of a bank.  Nearly everything uses 64KB banks.
+#   - allow_bank_end: get_free_addr never lets data run up to the very last
+#     byte of a bank.  Set this to allow using that byte.
+#   - allow_crossing: Data only needs to start in the bank.  The rest can
+#     run into the next bank.  Only sensible for data read with long
+#     addressing.
+class BankRules:
+
+    def __init__(self, bank_size: int = 0x10000,
+                 allow_bank_end: bool = False,
+                 allow_crossing: bool = False):
+        self.bank_size = bank_size
+        self.allow_bank_end = allow_bank_end
+        self.allow_crossing = allow_crossing
+
+    # The usable free runs of the bank starting at bank_st as a list of
+    # [start, end) pairs.  Only addresses >= min_addr are used.
+    def get_bank_runs(self, spaceman: FreeSpace, bank_st: int,
+                      min_addr: int) -> list[Tuple[int, int]]:
+
+        bank_end = bank_st + self.bank_size
+        if not self.allow_bank_end:
+            bank_end -= 1
+
+        if self.allow_crossing:
+            # Keep going past the bank's end so that the run's full
+            # length is seen.
+            runs = []
+            for (start, end) in spaceman.get_free_blocks(min_addr,
+                                                         spaceman.end):
+                if start >= bank_end:
+                    break
+                runs.append((start, end))
+            return runs
+        else:
+            return list(spaceman.get_free_blocks(min_addr, bank_end))
+
+
+# Best fit decreasing.  Going from largest to smallest size, each block is
+# put into the run with the least room left that can still hold it.
+# If max_start is given, no block may start at or after it.
+# Returns the start address for each size (in the original order) or None
+# if the sizes do not all fit.
+def best_fit_pack(runs: list[Tuple[int, int]],
+                  sizes: list[int],
+                  max_start: int = None) -> list[int]:
+
+    # Remaining [start, end) of each run
+    room = [list(run) for run in runs]
+    addrs = [None for x in sizes]
+
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+
+    for i in order:
+        best = None
+        for run in room:
+            if max_start is not None and run[0] >= max_start:
+                continue
+
+            left = run[1] - run[0]
+            if left >= sizes[i] and (best is None or
+                                     left < best[1] - best[0]):
+                best = run
+
+        if best is None:
+            return None
+
+        addrs[i] = best[0]
+        best[0] += sizes[i]
+
+    return addrs
+
+
+# Kinds of entries in a FreeSpace's undo journal
+class _UndoType(Enum):
+    MARK = 0    # (MARK, start, end, free blocks in [start, end) before)
+    EXTEND = 1  # (EXTEND, old end, None, None)
+
+
 class FreeSpace():
     def __init__(self, num_bytes, is_free):
 
@@ -20,6 +103,14 @@ class FreeSpace():
         self.markers = [0, self.num_bytes]
         self.first_free = is_free
 
+        # Stack of open transactions.  Each is a list of undo entries.
+        self.journal = []
+
+    # End of the buffer being tracked.
+    @property
+    def end(self):
+        return self.markers[-1]
+
     # Mark a block of the buffer as free/not free depending on is_free.
     # block is a half-open interval [block[0], block[1]) as is Python's way.
     def mark_block(self,
@@ -38,16 +129,98 @@ class FreeSpace():
 
         # If the block to mark goes past the end of the file, extend?
         # This should probably throw an error.
-        if block[1] > self.markers[-1]:
+        if block[1] > self.end:
             print('Warning: block [%6.6X, %6.6X) exceeds EOF. Truncating.'
                   % (block[0], block[1]))
-            block = (block[0], self.markers[-1])
+            block = (block[0], self.end)
 
         if block[0] < 0:
             print('Warning: block [%6.6X, %6.6X) preceeds 0. Truncating.'
                   % (block[0], block[1]))
             block = (0, block[1])
 
+        if self.journal and block[1] > block[0]:
+            self.journal[-1].append(
+                (_UndoType.MARK, block[0], block[1],
+                 list(self.get_free_blocks(block[0], block[1])))
+            )
+
+        self._mark_range(block, is_free)
+
+    # Mark many blocks in one pass.  blocks is a list of ((start, end), mark)
+    # sorted by start with no overlaps, like a compiled patch bundle.  The
+    # result is the same as calling mark_block on each.
+    def mark_blocks(self, blocks):
+        ranges = []
+        for ((start, end), mark) in blocks:
+            if mark == FSWriteType.NO_MARK:
+                continue
+
+            start, end = max(start, 0), min(end, self.end)
+            if end > start:
+                ranges.append((start, end, mark == FSWriteType.MARK_FREE))
+
+        if self.journal:
+            for (start, end, is_free) in ranges:
+                self.journal[-1].append(
+                    (_UndoType.MARK, start, end,
+                     list(self.get_free_blocks(start, end)))
+                )
+
+        self._mark_ranges(ranges)
+
+    # Does the work of mark_blocks.  ranges is a sorted list of
+    # (start, end, is_free).  Rather than inserting into the marker list
+    # once per range, the new marker list is built in a single sweep.
+    def _mark_ranges(self, ranges):
+        if not ranges:
+            return
+
+        # (start, end, is_free) pieces covering the whole buffer in order
+        pieces = []
+
+        def add_old_pieces(start, end):
+            ind = max(0, bisect_right(self.markers, start) - 1)
+            for x in range(ind, len(self.markers)-1):
+                block_st = max(start, self.markers[x])
+                block_end = min(end, self.markers[x+1])
+
+                if block_st >= end:
+                    break
+
+                pieces.append((block_st, block_end, self.__is_free(x)))
+
+        pos = 0
+        for (start, end, is_free) in ranges:
+            add_old_pieces(pos, start)
+            pieces.append((start, end, is_free))
+            pos = end
+
+        add_old_pieces(pos, self.end)
+
+        markers = [0]
+        first_free = None
+        last_free = None
+        for (start, end, is_free) in pieces:
+            if end <= start:
+                continue
+
+            if first_free is None:
+                first_free = is_free
+            elif is_free != last_free:
+                markers.append(start)
+
+            last_free = is_free
+
+        markers.append(self.end)
+
+        self.markers = markers
+        self.first_free = first_free
+
+    # Does the work of mark_block once the block is cleaned up.
+    # is_free is a bool here.
+    def _mark_range(self, block: Tuple[int, int], is_free: bool):
+
         left_blk = self.__search(0, len(self.markers)-2, block[0])
         right_blk = self.__search(0, len(self.markers)-2, block[1])
 
@@ -100,6 +273,12 @@ class FreeSpace():
     # End of mark_block
 
     def extend_end_marker(self, new_end, is_free):
+        if self.journal:
+            self.journal[-1].append((_UndoType.EXTEND, self.end, None, None))
+
+        self._extend_end(new_end, is_free)
+
+    def _extend_end(self, new_end, is_free):
         last_free = self.__is_free(len(self.markers)-2)
 
         # print(f"{new_end:06X}, {is_free}")
@@ -108,6 +287,40 @@ class FreeSpace():
         else:
             self.markers.append(new_end)
 
+    # Shrink the map back to end.  Only used to undo extend_end_marker.
+    def _truncate(self, end):
+        self._mark_range((end, self.end), False)
+
+        while len(self.markers) > 2 and self.markers[-2] >= end:
+            self.markers.pop()
+
+        self.markers[-1] = end
+
+    # Start a transaction.  Every mark_block and extend_end_marker from here
+    # on can be undone by rollback().  Transactions can be nested.
+    def begin(self):
+        self.journal.append([])
+
+    # Keep the changes made since the matching begin().  If this was a
+    # nested transaction, the outer transaction can still undo them.
+    def commit(self):
+        changes = self.journal.pop()
+
+        if self.journal:
+            self.journal[-1].extend(changes)
+
+    # Undo the changes made since the matching begin().
+    def rollback(self):
+        changes = self.journal.pop()
+
+        for (undo_type, start, end, free_blocks) in reversed(changes):
+            if undo_type == _UndoType.MARK:
+                self._mark_range((start, end), False)
+                for block in free_blocks:
+                    self._mark_range(block, True)
+            else:
+                self._truncate(start)
+
     def __is_free(self, ind):
         return ((ind % 2 == 0) == self.first_free)
 
@@ -147,59 +360,48 @@ class FreeSpace():
 
             return ret
 
-    # Sometimes data needs the same bank, so
-    def get_same_bank_free_addrs(self, sizes: list[int],
-                                 hint: int = 0) -> list[int]:
-
-        if not sizes:
-            return []
-
-        tries = [0 for x in sizes]
-        perm = [i for i in range(len(sizes))]
-
-        # going to assign in sorted order.
-        # Should discard heavily used blocks more quickly.
-        # Save the permutation to recover the original order
-        sort_sizes, perm = zip(*sorted(zip(sizes, perm), reverse=True))
+    # Free blocks that intersect [start, end), clipped to that range, in
+    # address order.
+    def get_free_blocks(self, start: int, end: int):
+        ind = max(0, bisect_right(self.markers, start) - 1)
 
-        start = hint
+        for x in range(ind, len(self.markers)-1):
+            block_st, block_end = self.markers[x], self.markers[x+1]
 
-        while True:
-            tries[0] = self.get_free_addr(sort_sizes[0], start)
-            self.mark_block((tries[0], tries[0]+sort_sizes[0]), False)
-
-            first_bank = (tries[0] >> 16) << 16
+            if block_st >= end:
+                break
 
-            success = True
+            if self.__is_free(x) and block_end > block_st:
+                yield (max(block_st, start), min(block_end, end))
 
-            for i in range(1, len(sort_sizes)):
-                tries[i] = self.get_free_addr(sort_sizes[i], first_bank)
-                this_bank = (tries[i] >> 16) << 16
+    # Sometimes data needs the same bank, so find room for all of the sizes
+    # in a single bank.  The map itself is not changed.  Mark the returned
+    # blocks when writing to them.
+    def get_same_bank_free_addrs(self, sizes: list[int],
+                                 hint: int = 0,
+                                 rules: BankRules = None) -> list[int]:
 
-                if this_bank != first_bank:
-                    success = False
-                    start = this_bank
+        if not sizes:
+            return []
 
-                    # undo previous markings
-                    for j in range(0, i):
-                        self.mark_block((tries[j], tries[j]+sort_sizes[j]),
-                                        True)
-                else:
-                    # Mark and proceed to next
-                    self.mark_block((tries[i], tries[i]+sort_sizes[i]), False)
+        if rules is None:
+            rules = BankRules()
 
-            if success:
-                break
+        bank_size = rules.bank_size
 
-        # Undo markings.  This is sort of ugly.  It would be nice to separate
-        # the buffer from the freespace checker so that we can copy the
-        # freespace checker and mess with that while finding addresses.
-        for i in range(len(tries)):
-            self.mark_block((tries[i], tries[i]+sort_sizes[i]), True)
+        for bank_st in range((hint // bank_size)*bank_size, self.end,
+                             bank_size):
+            runs = rules.get_bank_runs(self, bank_st, max(bank_st, hint))
+            addrs = best_fit_pack(runs, sizes, bank_st + bank_size)
 
-        perm, tries = zip(*sorted(zip(perm, tries)))
+            if addrs is not None:
+                return addrs
 
-        return list(tries)
+        print("Error: Not enough free space in a single bank.")
+        print('sizes: ' + ', '.join(f"{x:06X}" for x in sizes) +
+              f", hint: {hint:06X}")
+        self.print_blocks()
+        exit()
 
     '''
     # writes data into the buffer.  The write can introduce free space, such
@@ -334,11 +536,428 @@ class FreeSpace():
             return self.__search(start_ind, search_ind-1, addr)
 
 
+# Node of IndexedFreeSpace's treap.  Each node is a maximal free block
+# [start, end).  Nodes are ordered by start and heap ordered by priority.
+class _FreeBlock:
+    __slots__ = ('start', 'end', 'priority', 'left', 'right',
+                 'capacity', 'max_capacity')
+
+    def __init__(self, start, end, priority):
+        self.start = start
+        self.end = end
+        self.priority = priority
+        self.left = None
+        self.right = None
+
+        # get_free_addr only places data at the start of a block, and the
+        # data must not run into the next bank.  So the biggest write a block
+        # can take is limited by its size and by the room left in the bank.
+        self.capacity = min(end - start, 0xFFFF - start % 0x10000)
+        self.max_capacity = self.capacity
+
+    def update(self):
+        max_capacity = self.capacity
+        if self.left is not None and self.left.max_capacity > max_capacity:
+            max_capacity = self.left.max_capacity
+        if self.right is not None and self.right.max_capacity > max_capacity:
+            max_capacity = self.right.max_capacity
+
+        self.max_capacity = max_capacity
+
+
+# Split a treap into (blocks with start < key, blocks with start >= key)
+def _split(node, key):
+    if node is None:
+        return None, None
+
+    if node.start < key:
+        node.right, right = _split(node.right, key)
+        node.update()
+        return node, right
+    else:
+        left, node.left = _split(node.left, key)
+        node.update()
+        return left, node
+
+
+# Join two treaps where every start in left is less than every start in right
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        right.update()
+        return right
+
+
+def _last_block(node):
+    if node is None:
+        return None
+
+    while node.right is not None:
+        node = node.right
+
+    return node
+
+
+# First block (by address) with start >= min_start that can hold size bytes
+def _first_fit(node, min_start, size):
+    if node is None or node.max_capacity < size:
+        return None
+
+    if node.start < min_start:
+        return _first_fit(node.right, min_start, size)
+
+    ret = _first_fit(node.left, min_start, size)
+    if ret is not None:
+        return ret
+    elif node.capacity >= size:
+        return node
+    else:
+        return _first_fit(node.right, min_start, size)
+
+
+# Blocks intersecting [start, end) in address order.  Blocks are disjoint,
+# so ordering by start also orders by end, and whole subtrees can be skipped.
+def _iter_range(node, start, end):
+    if node is None:
+        return
+
+    if node.end > start:
+        yield from _iter_range(node.left, start, end)
+
+        if node.start < end:
+            yield node
+
+    if node.start < end:
+        yield from _iter_range(node.right, start, end)
+
+
+def _iter_blocks(node):
+    stack = []
+    while stack or node is not None:
+        if node is not None:
+            stack.append(node)
+            node = node.left
+        else:
+            node = stack.pop()
+            yield node
+            node = node.right
+
+
+# Drop-in replacement for FreeSpace that only stores the free blocks.  They
+# are kept in a treap keyed on the start address where each node also knows
+# the largest write its subtree can take.  Marking a block and finding a
+# free address are both O(log n) instead of walking/editing the marker list.
+#
+# Behavior matches FreeSpace except that empty or reversed blocks are
+# ignored after the error message instead of leaving zero length blocks in
+# the map.
+class IndexedFreeSpace(FreeSpace):
+
+    def __init__(self, num_bytes, is_free):
+        self.num_bytes = num_bytes
+        self.buf_end = num_bytes
+
+        # Private generator so that building the treap never touches the
+        # global random state that the randomizer is seeded with.
+        self.rng = random.Random(num_bytes)
+
+        self.journal = []
+
+        self.root = None
+        if is_free and num_bytes > 0:
+            self.root = self.__new_block(0, num_bytes)
+
+    @property
+    def end(self):
+        return self.buf_end
+
+    # The marker list that FreeSpace would have.  Only for inspection.
+    @property
+    def markers(self):
+        markers = [0]
+        for block in _iter_blocks(self.root):
+            if block.start != markers[-1]:
+                markers.append(block.start)
+            markers.append(block.end)
+
+        if markers[-1] != self.buf_end:
+            markers.append(self.buf_end)
+
+        return markers
+
+    @property
+    def first_free(self):
+        first = _iter_blocks(self.root)
+        block = next(first, None)
+        return block is not None and block.start == 0
+
+    def __new_block(self, start, end):
+        return _FreeBlock(start, end, self.rng.random())
+
+    def _mark_range(self, block: Tuple[int, int], is_free: bool):
+        if block[1] <= block[0]:
+            return
+
+        if is_free:
+            self.__mark_free(block[0], block[1])
+        else:
+            self.__mark_used(block[0], block[1])
+
+    # Each range is already a logarithmic update, so there is nothing to
+    # gain from rebuilding the tree.
+    def _mark_ranges(self, ranges):
+        for (start, end, is_free) in ranges:
+            self._mark_range((start, end), is_free)
+
+    def __mark_used(self, start, end):
+        left, right = _split(self.root, start)
+
+        # A block starting before start may run into the marked block
+        tail = None
+        prev = _last_block(left)
+        if prev is not None and prev.end > start:
+            left, _ = _split(left, prev.start)
+            left = _merge(left, self.__new_block(prev.start, start))
+
+            if prev.end > end:
+                tail = self.__new_block(end, prev.end)
+
+        # Blocks starting inside the marked block are removed.  The last one
+        # may extend past the end.
+        middle, right = _split(right, end)
+        last = _last_block(middle)
+        if last is not None and last.end > end:
+            tail = self.__new_block(end, last.end)
+
+        self.root = _merge(_merge(left, tail), right)
+
+    def __mark_free(self, start, end):
+        left, right = _split(self.root, start)
+
+        # Absorb a block that touches or overlaps the start
+        prev = _last_block(left)
+        if prev is not None and prev.end >= start:
+            left, _ = _split(left, prev.start)
+            start = prev.start
+            end = max(end, prev.end)
+
+        # Absorb blocks starting in [start, end].  The +1 catches a block
+        # starting exactly at end so that the free blocks stay maximal.
+        middle, right = _split(right, end+1)
+        last = _last_block(middle)
+        if last is not None:
+            end = max(end, last.end)
+
+        self.root = _merge(_merge(left, self.__new_block(start, end)), right)
+
+    def get_free_blocks(self, start: int, end: int):
+        for block in _iter_range(self.root, start, end):
+            yield (max(block.start, start), min(block.end, end))
+
+    def _extend_end(self, new_end, is_free):
+        last = _last_block(self.root)
+        last_free = last is not None and last.end == self.buf_end
+
+        # Same rule as FreeSpace: the new area matches the last block only
+        # when is_free compares equal to the last block's type.
+        if last_free == is_free:
+            new_free = last_free
+        else:
+            new_free = not last_free
+
+        old_end = self.buf_end
+        self.buf_end = new_end
+
+        if new_free:
+            self.__mark_free(old_end, new_end)
+
+    def _truncate(self, end):
+        self.__mark_used(end, self.buf_end)
+        self.buf_end = end
+
+    # First fit.  Location must be after hint
+    def get_free_addr(self, size, hint=0):
+        left, right = _split(self.root, hint+1)
+        prev = _last_block(left)
+        self.root = _merge(left, right)
+
+        if prev is not None and prev.start <= hint < prev.end:
+            return hint
+
+        # FreeSpace clamps a hint past the end to the last block.
+        min_start = hint
+        if prev is not None and hint >= self.buf_end and \
+           prev.end == self.buf_end:
+            min_start = prev.start
+
+        block = _first_fit(self.root, min_start, size)
+
+        if block is None:
+            print("Error: Not enough free space.")
+            print(f"size: {size:06X}, hint: {hint:06X}")
+            self.print_blocks()
+            exit()
+
+        return block.start
+
+    def print_blocks(self):
+
+        print('Free blocks: ')
+        for block in _iter_blocks(self.root):
+            print('[%6.6X, %6.6X)\t %X bytes'
+                  % (block.start, block.end, (block.end-block.start)))
+
+        print('Used blocks: ')
+        pos = 0
+        for block in _iter_blocks(self.root):
+            if block.start > pos:
+                print('[%6.6X, %6.6X)\t %X bytes'
+                      % (pos, block.start, (block.start-pos)))
+            pos = block.end
+
+        if pos < self.buf_end:
+            print('[%6.6X, %6.6X)\t %X bytes'
+                  % (pos, self.buf_end, (self.buf_end-pos)))
+
+
+# Coalesced set of [start, end) ranges.  FSRom uses this to remember which
+# parts of the buffer have been written.  Touching ranges are merged.
+class DirtyRanges:
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start: int, end: int):
+        if end <= start:
+            return
+
+        # Ranges [i, j) overlap or touch [start, end)
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+
 class FSRom(BytesIO):
 
-    def __init__(self, rom: bytes, is_free=False):
+    def __init__(self, rom: bytes, is_free=False,
+                 space_manager_type=IndexedFreeSpace):
         super().__init__(rom)
-        self.space_manager = FreeSpace(len(rom), is_free)
+        self.space_manager = space_manager_type(len(rom), is_free)
+
+        # Every write() is recorded here.  Changes made through getbuffer()
+        # are not unless the writer calls mark_dirty, so patches of the
+        # whole rom are made by comparing against base_rom instead.  See
+        # ipswriter.write_fsrom_patch.
+        self.base_rom = bytes(rom)
+        self.dirty_ranges = DirtyRanges()
+
+        # Stack of open transactions.  Each is (position at begin, list of
+        # (start, overwritten bytes, buffer length before the write)).
+        self.journal = []
+
+        # A stringowners.StringOwners for the location events in the rom.
+        # When set, freeing a script (ctevent.free_event,
+        # ScriptManager.free_script) also frees the strings that no other
+        # script uses.
+        self.string_owners = None
+
+    # Transactions cover both the bytes written with write() and the free
+    # space markings.  Changes made directly through getbuffer() are not
+    # journaled.  Rolling back only copies back the bytes that were
+    # overwritten, so it is cheap no matter the size of the rom.
+    def begin(self):
+        self.journal.append((self.tell(), []))
+        self.space_manager.begin()
+
+    def commit(self):
+        (pos, changes) = self.journal.pop()
+
+        if self.journal:
+            self.journal[-1][1].extend(changes)
+
+        self.space_manager.commit()
+
+    def rollback(self):
+        (pos, changes) = self.journal.pop()
+
+        for (start, old_bytes, old_len) in reversed(changes):
+            self.seek(start)
+            BytesIO.write(self, old_bytes)
+
+            if self.getbuffer().nbytes > old_len:
+                self.truncate(old_len)
+
+        self.seek(pos)
+        self.space_manager.rollback()
+
+    # Everything needed to bring another FSRom built from the same base rom
+    # to this one's current state.  Used by basesnapshot to skip the start
+    # up patching.
+    def get_state(self):
+        if self.journal:
+            print('Error: Can not save state during a transaction.')
+            exit()
+
+        return (self.getvalue(), self.space_manager, self.dirty_ranges)
+
+    # The state should come from get_state() on an FSRom with the same
+    # base rom.  The state's objects are used directly, not copied.
+    def set_state(self, state):
+        (image, space_manager, dirty_ranges) = state
+
+        self.seek(0)
+        self.truncate()
+        BytesIO.write(self, image)
+        self.seek(0)
+
+        self.space_manager = space_manager
+        self.dirty_ranges = dirty_ranges
+        self.journal = []
+
+    # For changes made directly to getbuffer() that write() never saw.
+    def mark_dirty(self, start: int, end: int):
+        self.dirty_ranges.add(start, end)
+
+    # Run a block of code in a transaction.  It's committed if the block
+    # finishes and rolled back if it raises.
+    #     with fsrom.transaction():
+    #         ...
+    @contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        else:
+            self.commit()
 
     # Apply one of Anskiy's .txt patches and mark free space
     # Code copied from patcher.py with few modifications.
@@ -405,6 +1024,51 @@ class FSRom(BytesIO):
             self.seek(addr)
             self.write(payload, mark_set)
 
+    # Apply a patchbundle.PatchBundle.  The records are sorted and do not
+    # overlap, so the free space map is updated in one go and each payload
+    # is copied straight into the buffer.
+    def apply_bundle(self, bundle):
+        records = bundle.records
+        if not records:
+            return
+
+        spaceman = self.space_manager
+
+        self.seek(0, 2)
+        buf_end = self.tell()
+
+        last = max(records, key=lambda rec: rec[0]+rec[1])
+        new_end = last[0] + last[1]
+
+        if new_end > buf_end:
+            if last[3] == FSWriteType.NO_MARK:
+                print('Error: Bundle extended buffer with NO_MARK set')
+                exit()
+
+            spaceman.extend_end_marker(new_end, last[3])
+
+        spaceman.mark_blocks([((addr, addr+length), mark)
+                              for (addr, length, offset, mark) in records])
+
+        if self.journal:
+            buf = self.getbuffer()
+            for (addr, length, offset, mark) in records:
+                old_bytes = bytes(buf[addr:min(addr+length, buf_end)])
+                self.journal[-1][1].append((addr, old_bytes, buf_end))
+            del(buf)
+
+        if new_end > buf_end:
+            BytesIO.write(self, bytes(new_end-buf_end))
+
+        buf = self.getbuffer()
+        payload = bundle.payload
+        for (addr, length, offset, mark) in records:
+            buf[addr:addr+length] = payload[offset:offset+length]
+            self.dirty_ranges.add(addr, addr+length)
+        del(buf)
+
+        self.seek(records[-1][0] + records[-1][1])
+
     def write(self, payload,
               write_mark: FSWriteType = FSWriteType.NO_MARK):
         # avoid long names
@@ -425,6 +1089,12 @@ class FSRom(BytesIO):
 
         spaceman.mark_block((start, end), write_mark)
 
+        if self.journal:
+            old_bytes = bytes(self.getbuffer()[start:min(end, buf_end)])
+            self.journal[-1][1].append((start, old_bytes, buf_end))
+
+        self.dirty_ranges.add(start, end)
+
         self.seek(start)
         return BytesIO.write(self, payload)
 
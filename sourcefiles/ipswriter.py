@@ -1,6 +1,8 @@
 import struct as st
 from os import stat
-from byteops import get_value_from_bytes_be
+import zlib
+
+from byteops import get_value_from_bytes_be, to_little_endian
 
 
 def tenthousands_digit(digit):
@@ -115,6 +117,220 @@ def write_patch_alt(patch, outfile):
         write_patch_objs(p, f)
 
 
+# Patch creation.  Given the data before (source) and after (target) a set
+# of changes plus the ranges that may have changed, write a patch.  The
+# ranges usually come from get_diff_ranges.  Bytes in the ranges that ended
+# up unchanged are left out.
+
+# IPS can't put a record at 0x454F46 since it reads as "EOF".
+ips_eof_addr = 0x454F46
+
+# Runs of one byte at least this long get an RLE record.  Anything shorter
+# is cheaper to leave in a normal record.
+ips_min_rle_len = 0x10
+
+
+# The blocks of target that differ from source, merged into [start, end)
+# ranges.  Anything past the end of source counts as changed.  Comparing
+# whole blocks is fast, and only the changed blocks need a byte by byte
+# look in get_changed_runs.
+def get_diff_ranges(source, target, block_size=0x1000):
+    ranges = []
+    common_len = min(len(source), len(target))
+
+    with memoryview(source) as src, memoryview(target) as tgt:
+        for start in range(0, common_len, block_size):
+            end = min(start+block_size, common_len)
+            if src[start:end] == tgt[start:end]:
+                continue
+
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+
+    if len(target) > common_len:
+        if ranges and ranges[-1][1] == common_len:
+            ranges[-1][1] = len(target)
+        else:
+            ranges.append([common_len, len(target)])
+
+    return [tuple(x) for x in ranges]
+
+
+# Split the target into the runs in ranges that differ from the source.
+# Unchanged gaps shorter than merge_gap are kept inside a run since a new
+# record would cost more than the gap.
+def get_changed_runs(source, target, ranges, merge_gap=0):
+    runs = []
+    source_len = len(source)
+    target_len = len(target)
+
+    for (start, end) in ranges:
+        end = min(end, target_len)
+
+        pos = start
+        while pos < end:
+            # Skip bytes that match the source
+            while pos < end and pos < source_len and \
+                  source[pos] == target[pos]:
+                pos += 1
+
+            if pos == end:
+                break
+
+            run_st = pos
+            while pos < end and (pos >= source_len or
+                                 source[pos] != target[pos]):
+                pos += 1
+
+            if runs and run_st - runs[-1][1] <= merge_gap:
+                runs[-1][1] = pos
+            else:
+                runs.append([run_st, pos])
+
+    return [tuple(x) for x in runs]
+
+
+def _ips_record(addr, payload):
+    return (to_little_endian(addr, 3)[::-1] +
+            to_little_endian(len(payload), 2)[::-1] +
+            payload)
+
+
+def _ips_rle_record(addr, length, value):
+    return (to_little_endian(addr, 3)[::-1] + b'\x00\x00' +
+            to_little_endian(length, 2)[::-1] + bytes([value]))
+
+
+# Split [start, end) of data into (start, end, is_rle) segments where the
+# RLE segments are runs of a single byte.
+def _split_rle(data, start, end):
+    segments = []
+    literal_st = start
+
+    pos = start
+    while pos < end:
+        run_end = pos+1
+        while run_end < end and data[run_end] == data[pos]:
+            run_end += 1
+
+        if run_end - pos >= ips_min_rle_len:
+            if literal_st < pos:
+                segments.append((literal_st, pos, False))
+            segments.append((pos, run_end, True))
+            literal_st = run_end
+
+        pos = run_end
+
+    if literal_st < end:
+        segments.append((literal_st, end, False))
+
+    return segments
+
+
+def make_ips_patch(source, target, ranges) -> bytearray:
+    patch = bytearray(b'PATCH')
+
+    for (start, end) in get_changed_runs(source, target, ranges, 5):
+        for (seg_st, seg_end, is_rle) in _split_rle(target, start, end):
+            # Leave a byte of room in each record for the EOF fix below
+            for pos in range(seg_st, seg_end, 0xFFFE):
+                rec_end = min(pos+0xFFFE, seg_end)
+
+                if pos == ips_eof_addr:
+                    if is_rle:
+                        # Rewrite the byte before along with the first byte
+                        patch += _ips_record(pos-1,
+                                             bytes(target[pos-1:pos+1]))
+                        pos += 1
+                        if pos == rec_end:
+                            continue
+                    else:
+                        pos -= 1
+
+                if is_rle:
+                    patch += _ips_rle_record(pos, rec_end-pos, target[pos])
+                else:
+                    patch += _ips_record(pos, bytes(target[pos:rec_end]))
+
+    patch += b'EOF'
+    return patch
+
+
+# BPS numbers are a variable length encoding, 7 bits per byte.
+def _bps_number(value):
+    ret = bytearray()
+    while True:
+        x = value & 0x7F
+        value >>= 7
+        if value == 0:
+            ret.append(0x80 | x)
+            return ret
+        ret.append(x)
+        value -= 1
+
+
+def make_bps_patch(source, target, ranges) -> bytearray:
+    source_read, target_read = 0, 1
+
+    patch = bytearray(b'BPS1')
+    patch += _bps_number(len(source))
+    patch += _bps_number(len(target))
+    patch += _bps_number(0)  # no metadata
+
+    def action(command, length):
+        return _bps_number(((length-1) << 2) | command)
+
+    # Everything outside the changed runs is read from the source.  Past the
+    # end of the source there is nothing to read, so treat it as changed.
+    runs = get_changed_runs(source, target, ranges, 2)
+    if len(target) > len(source):
+        tail_st = len(source)
+        while runs and runs[-1][1] >= tail_st:
+            tail_st = min(tail_st, runs[-1][0])
+            runs.pop()
+
+        runs.append((tail_st, len(target)))
+
+    pos = 0
+    for (start, end) in runs:
+        if start > pos:
+            patch += action(source_read, start-pos)
+
+        patch += action(target_read, end-start)
+        patch += target[start:end]
+        pos = end
+
+    if pos < len(target):
+        patch += action(source_read, len(target)-pos)
+
+    patch += to_little_endian(zlib.crc32(source), 4)
+    patch += to_little_endian(zlib.crc32(target), 4)
+    patch += to_little_endian(zlib.crc32(patch), 4)
+
+    return patch
+
+
+# Write out a patch taking an FSRom's original data to its current data.
+# Use a filename ending in .bps for a bps patch.  Otherwise ips is used.
+# The whole image is compared against the base rom.  Plenty of writers
+# change the rom through getbuffer(), which fsrom.dirty_ranges never sees.
+def write_fsrom_patch(fsrom, filename):
+    target = fsrom.getbuffer()
+    ranges = get_diff_ranges(fsrom.base_rom, target)
+
+    if filename.endswith('.bps'):
+        patch = make_bps_patch(fsrom.base_rom, target, ranges)
+    else:
+        patch = make_ips_patch(fsrom.base_rom, target, ranges)
+
+    del(target)
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(patch)
+
+
 if __name__ == "__main__":
     with open("ct_vanilla.sfc", "rb") as infile:
         rom = infile.read()
@@ -35,6 +35,7 @@ class GameConfig:
         self.initLocations()
         self.initKeyItems()
         self.initGame()
+        self.compileLogic()
 
     #
     # Subclasses will override this method to
@@ -57,6 +58,17 @@ class GameConfig:
     def initGame(self):
         raise NotImplementedError()
 
+    #
+    # Compile the access rules of the LocationGroups and the character
+    # recruit spots for the Game object.  The rules above stay the
+    # definitions.  The compiled versions test the Game's state mask (see
+    # logictypes.compileAccessRule).
+    #
+    def compileLogic(self):
+        self.game.compileCharacterRules()
+        for locationGroup in self.locationGroups:
+            locationGroup.compileRule(self.game)
+
     #
     # Update the key item list based on the current state of the game.
     # Example: Chronosanity removes key item bias after some items are placed
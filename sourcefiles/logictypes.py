@@ -1,5 +1,7 @@
 from __future__ import annotations
+import copy
 
+from weightedsampler import WeightedSampler
 from ctenums import ItemID, CharID, RecruitID, TreasureID
 from treasurewriter import TreasureLocTier
 import randosettings as rset
@@ -30,6 +32,19 @@ class Game:
         # In case we need to look something else up
         self.settings = settings
 
+        # The key items and characters are also kept as bits of one integer
+        # so that compiled access rules (see compileAccessRule) can test
+        # them with a few ANDs.  Bits are handed out as items and
+        # characters are first seen.
+        self.stateBits = dict()
+        self.keyItemMask = 0
+        self.characterMask = 0
+
+        # CompiledRules for the recruit spots in the order that
+        # updateAvailableCharacters checks them.  Set by
+        # compileCharacterRules.
+        self.characterRules = None
+
     #
     # Get the number of key items that have been acquired by the player.
     #
@@ -96,6 +111,7 @@ class Game:
     #
     def addCharacter(self, character):
         self.characters.add(character)
+        self.characterMask |= self.getStateBit(('char', character))
 
     #
     # Remove a character from the set of characters acquired
@@ -104,6 +120,7 @@ class Game:
     #
     def removeCharacter(self, character):
         self.characters.discard(character)
+        self.characterMask &= ~self.getStateBit(('char', character))
 
     #
     # Check if the player has a given key item.
@@ -121,6 +138,7 @@ class Game:
     #
     def addKeyItem(self, item):
         self.keyItems.add(item)
+        self.keyItemMask |= self.getStateBit(('item', item))
 
     #
     # Remove a key item from the set of key items acquired
@@ -129,6 +147,67 @@ class Game:
     #
     def removeKeyItem(self, item):
         self.keyItems.discard(item)
+        self.keyItemMask &= ~self.getStateBit(('item', item))
+
+    #
+    # Get the bit used for a key item or character in the state mask.
+    #
+    # param: stateVar - ('item', ItemID) or ('char', CharID)
+    # return: An integer with only that bit set
+    #
+    def getStateBit(self, stateVar):
+        if stateVar not in self.stateBits:
+            self.stateBits[stateVar] = 1 << len(self.stateBits)
+        return self.stateBits[stateVar]
+
+    #
+    # Get the key items and characters the player has as one integer.
+    # Characters are as of the last updateAvailableCharacters.
+    #
+    # return: The state mask
+    #
+    def getStateMask(self):
+        return self.keyItemMask | self.characterMask
+
+    #
+    # Get the recruit spots and the rules for when they are available in
+    # the order updateAvailableCharacters checks them.
+    #
+    # return: A list of (RecruitID, access rule) tuples
+    #
+    def getRecruitRules(self):
+        return [
+            # The first four characters are always available.
+            (RecruitID.STARTER_1, lambda game: True),
+            (RecruitID.STARTER_2, lambda game: True),
+            (RecruitID.CATHEDRAL, lambda game: True),
+            (RecruitID.CASTLE, lambda game: True),
+            # The remaining three characters are progression gated.
+            (RecruitID.PROTO_DOME, lambda game: game.canAccessFuture()),
+            (RecruitID.DACTYL_NEST,
+             lambda game: game.canAccessDactylCharacter()),
+            (RecruitID.FROGS_BURROW, lambda game: game.hasMasamune()),
+        ]
+
+    #
+    # Compile the recruit spot rules so that updateAvailableCharacters can
+    # work on the state mask.  If any rule does not compile, the characters
+    # keep being found through the Game methods.
+    #
+    def compileCharacterRules(self):
+        characterRules = []
+        for (recruitID, rule) in self.getRecruitRules():
+            compiledRule = compileAccessRule(rule, self)
+            if compiledRule is None:
+                self.characterRules = None
+                return
+
+            character = self.charLocations[recruitID].held_char
+            characterRules.append(
+                (compiledRule, self.getStateBit(('char', character)))
+            )
+
+        self.characterRules = characterRules
 
     #
     # Determine which characters are available based on what key items/time
@@ -141,29 +220,31 @@ class Game:
         # from ctenums.RecruitID.  The corresponding value gives the held
         # character in a held_char field
 
+        if self.characterRules is not None:
+            # Check the compiled rules against the state mask.  Rules see
+            # the characters added before them, like the loop below.
+            mask = self.keyItemMask
+            for (compiledRule, characterBit) in self.characterRules:
+                if compiledRule.test(mask):
+                    mask |= characterBit
+
+            characterMask = mask & ~self.keyItemMask
+            if characterMask != self.characterMask:
+                self.characterMask = characterMask
+                self.characters = {
+                    stateVar[1] for (stateVar, bit) in self.stateBits.items()
+                    if stateVar[0] == 'char' and bit & characterMask
+                }
+            return
+
         # Empty the set just in case the placement algorithm had to
         # backtrack and a character is no longer available.
         self.characters.clear()
+        self.characterMask = 0
 
-        # The first four characters are always available.
-        self.addCharacter(self.charLocations[RecruitID.STARTER_1].held_char)
-        self.addCharacter(self.charLocations[RecruitID.STARTER_2].held_char)
-        self.addCharacter(self.charLocations[RecruitID.CATHEDRAL].held_char)
-        self.addCharacter(self.charLocations[RecruitID.CASTLE].held_char)
-
-        # The remaining three characters are progression gated.
-        if self.canAccessFuture():
-            self.addCharacter(
-                self.charLocations[RecruitID.PROTO_DOME].held_char
-            )
-        if self.canAccessDactylCharacter():
-            self.addCharacter(
-                self.charLocations[RecruitID.DACTYL_NEST].held_char
-            )
-        if self.hasMasamune():
-            self.addCharacter(
-                self.charLocations[RecruitID.FROGS_BURROW].held_char
-            )
+        for (recruitID, rule) in self.getRecruitRules():
+            if rule(self):
+                self.addCharacter(self.charLocations[recruitID].held_char)
     # end updateAvailableCharacters function
 
     #
@@ -397,6 +478,10 @@ class LocationGroup:
         self.weightDecay = weightDecay
         self.weightStack = []
 
+        # The accessRule compiled for one Game (see compileRule)
+        self.compiledRule = None
+        self.compiledGame = None
+
     #
     # Return whether or not this location group is accessible.
     #
@@ -404,8 +489,24 @@ class LocationGroup:
     # return: True if this location is accessible, false if not
     #
     def canAccess(self, game):
+        if game is self.compiledGame:
+            return self.compiledRule.test(game.getStateMask())
         return self.accessRule(game)
 
+    #
+    # Compile the access rule of this group for a Game so that canAccess
+    # with that Game only tests its state mask.  The rule keeps being
+    # called if it does not compile.
+    #
+    # param: game - The Game object canAccess will be called with
+    #
+    def compileRule(self, game):
+        self.compiledRule = compileAccessRule(self.accessRule, game)
+        if self.compiledRule is None:
+            self.compiledGame = None
+        else:
+            self.compiledGame = game
+
     #
     # Get the name of this location.
     #
@@ -489,3 +590,292 @@ class LocationGroup:
     def getLocations(self):
         return self.locations.copy()
 # End LocationGroup class
+
+
+#
+# This class keeps track of which LocationGroups are accessible and still
+# have locations while key items are placed and taken back.
+#
+# Each group's compiled access rule only looks at a few bits of the Game's
+# state mask.  The groups are indexed by those bits, so when the state
+# changes only the groups that look at a changed bit are tested again.
+# Groups whose rules did not compile are tested every time.
+#
+class LocationAvailability:
+    #
+    # param: locationGroups - List of LocationGroups to track
+    # param: game - The Game object the placement is using
+    #
+    def __init__(self, locationGroups, game):
+        self.locationGroups = list(locationGroups)
+        self.game = game
+
+        self.groupIndex = {id(group): ind
+                           for (ind, group) in enumerate(self.locationGroups)}
+
+        # state bit -> indices of the groups whose rules look at it
+        self.groupDeps = dict()
+        self.uncompiledGroups = []
+        for (ind, group) in enumerate(self.locationGroups):
+            if group.compiledGame is not game:
+                self.uncompiledGroups.append(ind)
+                continue
+
+            ruleBits = 0
+            for mask in group.compiledRule.masks:
+                ruleBits |= mask
+
+            for bit in iterateBits(ruleBits):
+                self.groupDeps.setdefault(bit, []).append(ind)
+
+        # The key item bits that the recruit rules look at
+        self.characterDeps = 0
+        if game.characterRules is not None:
+            for (compiledRule, characterBit) in game.characterRules:
+                for mask in compiledRule.masks:
+                    self.characterDeps |= mask
+
+        # The state the available groups were found for
+        self.keyItemMask = None
+        self.stateMask = None
+
+        # Indices of the accessible groups with locations left
+        self.available = set()
+
+        # The weights of the available groups.  Other groups weigh 0.
+        self.groupWeights = WeightedSampler([0]*len(self.locationGroups))
+
+        # Indices of the groups whose locations changed since the last
+        # refresh
+        self.changedGroups = set()
+
+    #
+    # Get the accessible LocationGroups that still have locations, in the
+    # order they were given.
+    #
+    # return: List of LocationGroups
+    #
+    def getAvailableGroups(self):
+        self.refresh()
+        return [self.locationGroups[ind] for ind in sorted(self.available)]
+
+    #
+    # Get the sum of the weights of the available LocationGroups.
+    #
+    # return: The total weight, 0 if no group is available
+    #
+    def getTotalWeight(self):
+        self.refresh()
+        return self.groupWeights.get_total()
+
+    #
+    # Pick an available LocationGroup by weight.  The groups are laid out
+    # in order, each taking up as much room as its weight.
+    #
+    # param: target - A value in [0, getTotalWeight())
+    # return: The LocationGroup whose room holds target
+    #
+    def findGroup(self, target):
+        self.refresh()
+        return self.locationGroups[self.groupWeights.find(target)]
+
+    #
+    # Test a group again after locations were removed from or added to it
+    # or its weight changed.
+    #
+    # param: group - The LocationGroup that changed
+    #
+    def updateGroup(self, group):
+        self.changedGroups.add(self.groupIndex[id(group)])
+
+    #
+    # Bring the available groups up to date with the Game.
+    #
+    def refresh(self):
+        game = self.game
+
+        if self.stateMask is None:
+            game.updateAvailableCharacters()
+            changedGroups = range(len(self.locationGroups))
+        else:
+            changedItems = game.keyItemMask ^ self.keyItemMask
+            if changedItems and (game.characterRules is None or
+                                 changedItems & self.characterDeps):
+                game.updateAvailableCharacters()
+
+            changedGroups = self.changedGroups
+            changedGroups.update(self.uncompiledGroups)
+            changedState = game.getStateMask() ^ self.stateMask
+            for bit in iterateBits(changedState):
+                changedGroups.update(self.groupDeps.get(bit, []))
+
+        self.keyItemMask = game.keyItemMask
+        self.stateMask = game.getStateMask()
+
+        for ind in changedGroups:
+            self.testGroup(ind)
+        self.changedGroups = set()
+
+    def testGroup(self, ind):
+        group = self.locationGroups[ind]
+        if group.getAvailableLocationCount() > 0 and \
+           group.canAccess(self.game):
+            self.available.add(ind)
+            self.groupWeights.set_weight(ind, group.getWeight())
+        else:
+            self.available.discard(ind)
+            self.groupWeights.set_weight(ind, 0)
+# End LocationAvailability class
+
+
+#
+# Get each set bit of an integer.
+#
+# param: mask - A non-negative integer
+# return: Generator of integers with one bit set, lowest first
+#
+def iterateBits(mask):
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+
+#
+# An access rule compiled to a list of masks over Game.getStateMask().
+# The rule holds when every bit of at least one mask is set.  An empty list
+# never holds and a 0 mask always holds.
+#
+class CompiledRule:
+    def __init__(self, masks):
+        self.masks = masks
+
+    #
+    # Check the rule against a state mask.
+    #
+    # param: stateMask - Key items and characters as from Game.getStateMask
+    # return: True if the rule holds, false if not
+    #
+    def test(self, stateMask):
+        for mask in self.masks:
+            if stateMask & mask == mask:
+                return True
+        return False
+# End CompiledRule class
+
+
+# Rules asking about more key items and characters than this are not
+# compiled.
+maxCompiledRuleVars = 12
+
+# (rule code, Game class, Game flags) -> the terms getRuleTerms found.  The
+# lambdas in logicfactory are made again for every GameConfig, but rules
+# with the same code and flags have the same terms.
+ruleTermCache = dict()
+
+
+#
+# Compile an access rule (a function of a Game, like the lambdas in
+# logicfactory) for one Game.
+#
+# param: rule - Function taking a Game and returning whether access is given
+# param: game - The Game object the compiled rule will be used with
+#
+# return: A CompiledRule or None if the rule can not be compiled
+#
+def compileAccessRule(rule, game):
+    cacheKey = None
+    if getattr(rule, '__closure__', True) is None:
+        cacheKey = (rule.__code__, type(game), game.earlyPendant,
+                    game.lockedChars, game.lostWorlds)
+
+    if cacheKey in ruleTermCache:
+        terms = ruleTermCache[cacheKey]
+    else:
+        terms = getRuleTerms(rule, game)
+        if cacheKey is not None:
+            ruleTermCache[cacheKey] = terms
+
+    if terms is None:
+        return None
+
+    return CompiledRule(
+        [sum(game.getStateBit(x) for x in term) for term in terms]
+    )
+
+
+#
+# Find the sets of key items and characters for which an access rule holds.
+#
+# The rule is run against copies of the Game whose hasKeyItem and
+# hasCharacter answer from a list of made up answers.  Trying every
+# sequence of answers gives the sets of key items and characters for which
+# the rule holds.  Game settings like locked characters are read as they
+# are in the Game, so they are built into the result.
+#
+# The result is only exact if having more key items or characters never
+# makes a rule fail.  It is checked against the rule for every combination
+# of the key items and characters the rule asks about.
+#
+# param: rule - Function taking a Game and returning whether access is given
+# param: game - The Game object whose settings the rule is run with
+#
+# return: A list of frozensets of ('item', ItemID) and ('char', CharID).
+#         The rule holds when everything in one of the sets is had.  None if
+#         the rule can not be compiled.
+#
+def getRuleTerms(rule, game):
+    probe = copy.copy(game)
+
+    # The answers for this run and the ones still to be tried
+    answers = dict()
+    forcedAnswers = []
+    pending = [()]
+
+    def ask(stateVar):
+        if stateVar not in answers:
+            # Answer the first questions as forced, the rest with False and
+            # try True for them in a later run.
+            ind = len(answers)
+            if ind < len(forcedAnswers):
+                answers[stateVar] = forcedAnswers[ind]
+            else:
+                answers[stateVar] = False
+                pending.append(tuple(answers.values())[:ind] + (True,))
+        return answers[stateVar]
+
+    probe.hasKeyItem = lambda item: ask(('item', item))
+    probe.hasCharacter = lambda character: ask(('char', character))
+
+    stateVars = set()
+    terms = []
+    while len(pending) > 0:
+        forcedAnswers = pending.pop()
+        answers.clear()
+
+        result = rule(probe)
+        stateVars.update(answers.keys())
+        if len(stateVars) > maxCompiledRuleVars:
+            return None
+
+        if result:
+            terms.append(frozenset(x for (x, answer) in answers.items()
+                                   if answer))
+
+    # Drop terms that need more than another term.
+    terms = [term for term in set(terms)
+             if not any(other < term for other in terms)]
+
+    # Check the terms against the rule itself.
+    stateVars = list(stateVars)
+    for combination in range(1 << len(stateVars)):
+        haveVars = {x for (ind, x) in enumerate(stateVars)
+                    if combination & (1 << ind)}
+        probe.hasKeyItem = lambda item: ('item', item) in haveVars
+        probe.hasCharacter = lambda character: ('char', character) in haveVars
+
+        holds = any(term <= haveVars for term in terms)
+        if bool(rule(probe)) != holds:
+            return None
+
+    return terms
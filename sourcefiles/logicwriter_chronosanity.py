@@ -24,6 +24,12 @@ import randosettings as rset
 # Script variables
 locationGroups = []
 
+# PlacementStats of the last determineKeyItemPlacement
+placementStats = None
+
+# LocationAvailability for locationGroups during determineKeyItemPlacement
+locationAvailability = None
+
 #
 # Get a list of LocationGroups that are available for key item placement.
 #
@@ -32,6 +38,12 @@ locationGroups = []
 # return: List of all available LocationGroups
 #
 def getAvailableLocations(game: logictypes.Game) -> list[logictypes.Location]:
+  # During placement only the groups affected by the last change are
+  # tested again.
+  if locationAvailability is not None and \
+     locationAvailability.game is game:
+    return locationAvailability.getAvailableGroups()
+
   # Have the game object update what characters are available based on the
   # currently available items and time periods.
   game.updateAvailableCharacters()
@@ -47,15 +59,28 @@ def getAvailableLocations(game: logictypes.Game) -> list[logictypes.Location]:
   
 # end getAvailableLocations
 
+#
+# Let getAvailableLocations know that locations were removed from or added
+# to a LocationGroup.
+#
+# param: locationGroup - The LocationGroup that changed
+#
+def updateGroupAvailability(locationGroup):
+  if locationAvailability is not None:
+    locationAvailability.updateGroup(locationGroup)
+
+# end updateGroupAvailability
+
 #
 # Given a list of LocationGroups, get a random location.
 #
 # param: groups - List of LocationGroups
+# param: rng - random.Random (or the random module) to draw with
 #
 # return: The LocationGroup the Location was chosen from
 # return: A Location randomly chosen from the groups list
 #
-def getRandomLocation(groups):
+def getRandomLocation(groups, rng=rand):
   # get the max rand value from the combined weightings of the location groups
   # This will be used to help select a location group
   weightTotal = 0
@@ -63,7 +88,7 @@ def getRandomLocation(groups):
     weightTotal = weightTotal + group.getWeight()
   
   # Select a location group
-  locationChoice = rand.randint(1, weightTotal)
+  locationChoice = rng.randint(1, weightTotal)
   counter = 0
   chosenGroup = None
   for group in groups:
@@ -73,31 +98,61 @@ def getRandomLocation(groups):
       break
     
   # Select a random location from the chosen location group.
-  location = rand.choice(chosenGroup.getLocations())
+  location = rng.choice(chosenGroup.getLocations())
   
   return chosenGroup, location
 # end getRandomLocation
 
+#
+# Get a random location that is available for key item placement.  This
+# makes the same choice as getRandomLocation(getAvailableLocations(game)).
+#
+# param: game - Game object used to determine location access
+# param: rng - random.Random (or the random module) to draw with
+#
+# return: The LocationGroup the Location was chosen from
+# return: A Location randomly chosen from the available groups
+#         Both are None if no location is available
+#
+def getRandomAvailableLocation(game: logictypes.Game, rng=rand):
+  if locationAvailability is None or locationAvailability.game is not game:
+    availableLocations = getAvailableLocations(game)
+    if len(availableLocations) == 0:
+      return None, None
+    return getRandomLocation(availableLocations, rng)
+
+  # The group weights are kept up to date as the placement goes, so only
+  # the draw is left to do.
+  weightTotal = locationAvailability.getTotalWeight()
+  if weightTotal == 0:
+    return None, None
+
+  locationChoice = rng.randint(1, weightTotal)
+  chosenGroup = locationAvailability.findGroup(locationChoice - 1)
+  location = rng.choice(chosenGroup.getLocations())
+
+  return chosenGroup, location
+# end getRandomAvailableLocation
+
 #
 # Given a weighted list of key items, get a shuffled
 # version of the list with only a single copy of each item.
 #
 # param: weightedList - Weighted key item list
+# param: rng - random.Random (or the random module) to draw with
 #
 # return: Shuffled list of key items with duplicates removed
 #
-def getShuffledKeyItemList(weightedList):
+def getShuffledKeyItemList(weightedList, rng=rand):
   tempList = weightedList.copy()
 
   # In the shuffle, higher weighted items have a better chance of appearing
   # before lower weighted items.
-  rand.shuffle(tempList)
-  
-  keyItemList = []
-  for keyItem in tempList:
-    if not (keyItem in keyItemList):
-      keyItemList.append(keyItem)
+  rng.shuffle(tempList)
   
+  # Keep the first copy of each key item.
+  keyItemList = list(dict.fromkeys(tempList))
+
   return keyItemList
 # end getShuffledKeyItemList
 
@@ -106,39 +161,88 @@ def getShuffledKeyItemList(weightedList):
 #
 # param: gameConfig A GameConfig object with the configuration information
 #                   necessary to place keys for the selected game type
+# param: rng - random.Random (or the random module) to draw with
 #
 # return: A tuple containing:
 #             A Boolean indicating whether or not key item placement was successful
 #             A list of locations with key items assigned
 #
-def determineKeyItemPlacement(gameConfig):
-  global locationGroups
+def determineKeyItemPlacement(gameConfig, rng=rand):
+  global locationGroups, locationAvailability
   locationGroups = gameConfig.getLocations()
   # game = gameConfig.getGame()
   remainingKeyItems = gameConfig.getKeyItemList()
   chosenLocations = []
-  return determineKeyItemPlacement_impl(chosenLocations,
-                                        remainingKeyItems, gameConfig)
+
+  locationAvailability = \
+    logictypes.LocationAvailability(locationGroups, gameConfig.getGame())
+  try:
+    return determineKeyItemPlacement_impl(chosenLocations,
+                                          remainingKeyItems, gameConfig, rng)
+  finally:
+    locationAvailability = None
 # end place_key_items
 
 
+#
+# Counters for a run of determineKeyItemPlacement.
+#   nodes - placement states whose locations were looked at
+#   backtracks - chosen locations that no key item could be placed in
+#   pruned - states skipped because they were already known to fail
+#
+class PlacementStats:
+  def __init__(self):
+    self.nodes = 0
+    self.backtracks = 0
+    self.pruned = 0
+
+  def __str__(self):
+    return (f"{self.nodes} nodes explored, {self.backtracks} backtracks, "
+            f"{self.pruned} pruned")
+# end PlacementStats class
+
+#
+# One level of the placement search: the location chosen at that level and
+# the key items left to try in it.
+#
+class PlacementFrame:
+  def __init__(self, stateKey, remainingKeyItems, locationGroup, location,
+               keyItemList):
+    self.stateKey = stateKey
+    self.remainingKeyItems = remainingKeyItems
+    self.locationGroup = locationGroup
+    self.location = location
+    self.keyItemList = keyItemList
+    self.nextKeyItem = 0
+    self.placedKeyItem = None
+# end PlacementFrame class
+
 #
 # NOTE: Do not call this function directly. This will be called
 #       by determineKeyItemPlacement after setting up the parameters
 #       needed by this function.
 #
-# This function will recursively determine key item locations
-# such that a seed can be 100% completed.  This uses a weighted random
-# approach to placement and will only consider logically accessible locations.
+# This function will determine key item locations such that a seed can be
+# 100% completed.  This uses a weighted random approach to placement and
+# will only consider logically accessible locations.
 #
-# The algorithm for determining locations - For each recursion:
-#   If there are no key items remaining, unwind the recursion, otherwise
+# The algorithm for determining locations - For each level:
+#   If there are no key items remaining, we're done, otherwise
 #     Get a list of logically accessible locations
 #     Choose a location randomly (locations are weighted)
 #     Get a shuffled list of the remaining key items
 #     Loop through the key item list, trying each one in the chosen location
-#       Recurse and try the next location/key item
-#     
+#       Go down a level and try the next location/key item
+#
+# The levels are kept on an explicit stack instead of the call stack.
+#
+# Every access rule only gets more permissive as key items are added.  So if
+# a state can be completed at all, it can be completed with any accessible
+# location filled next.  A failed state (the key items owned plus the
+# locations used) is a dead end no matter which locations were drawn, and
+# it is skipped if the search comes back to it.  Skipping only saves the
+# random draws the doomed search would have made, so placements come from
+# the same distribution as before.
 #
 # param: chosenLocations - List of locations already chosen for key items
 # param: remainingKeyItems - List of key items remaining to be placed
@@ -148,6 +252,7 @@ def determineKeyItemPlacement(gameConfig):
 #                     items may change over time.
 # TODO:  Should this pass two parameters? Game and updateKeyItems function?
 #        It's weird using the Game member of GameConfig.
+# param: rng - random.Random (or the random module) to draw with
 #
 # return: A tuple containing:
 #             A Boolean indicating whether or not key item placement was
@@ -157,61 +262,87 @@ def determineKeyItemPlacement(gameConfig):
 #
 def determineKeyItemPlacement_impl(chosenLocations,
                                    remainingKeyItems,
-                                   gameConfig):
-  if len(remainingKeyItems) == 0:
-    # We've placed all key items.  This is our breakout condition
-    return True, chosenLocations
-  else:
-    # We still have key items to place.
-    availableLocations = getAvailableLocations(gameConfig.getGame())
-    if len(availableLocations) == 0:
-      # This item configuration is not completable. 
-      return False, chosenLocations
+                                   gameConfig,
+                                   rng=rand):
+  global placementStats
+  placementStats = PlacementStats()
+
+  game = gameConfig.getGame()
+  deadEnds = set()
+  stack = []
+
+  while True:
+    # Start a new level with the current remainingKeyItems.
+    if len(remainingKeyItems) == 0:
+      # We've placed all key items.  This is our breakout condition
+      return True, chosenLocations
+
+    stateKey = (frozenset(game.keyItems), frozenset(chosenLocations))
+    if stateKey in deadEnds:
+      placementStats.pruned += 1
     else:
-      # Continue placing key items.
-      keyItemConfirmed = False
-      returnedChosenLocations = None
-      
+      placementStats.nodes += 1
+
       # Choose a random location
-      locationGroup, location = getRandomLocation(availableLocations)
-      locationGroup.removeLocation(location)
-      locationGroup.decayWeight()
-      chosenLocations.append(location)
-      
-      # Sometimes key item bias is removed after N checks
-      gameConfig.updateKeyItems(remainingKeyItems)
-
-      # Use the weighted key item list to get a list of key items
-      # that we can loop through and attempt to place.
-      localKeyItemList = getShuffledKeyItemList(remainingKeyItems)
-      for keyItem in localKeyItemList:
-        # Try placing this key item and then recurse
-        location.setKeyItem(keyItem)
-        gameConfig.getGame().addKeyItem(keyItem)
-        
-        newKeyItemList = [x for x in remainingKeyItems if x != keyItem]
-        # recurse and try to place the next key item.
-        keyItemConfirmed, returnedChosenLocations = \
-            determineKeyItemPlacement_impl(chosenLocations,
-                                           newKeyItemList,
-                                           gameConfig)
-        
-        if keyItemConfirmed:
-          # We're unwinding the recursion here, all key items are placed.
-          return keyItemConfirmed, returnedChosenLocations
-        else:
-          gameConfig.getGame().removeKeyItem(keyItem)
-      # end keyItem loop
-      
-      # If we get here, we failed to place an item.  Undo location modifications
-      locationGroup.addLocation(location)
-      locationGroup.undoWeightDecay()
-      chosenLocations.remove(location)
-      location.unsetKeyItem()
-      
-      return False, chosenLocations
-
-# end determineKeyItemPlacement_impl recursive function
+      locationGroup, location = getRandomAvailableLocation(game, rng)
+
+      if location is None:
+        # This item configuration is not completable.
+        deadEnds.add(stateKey)
+      else:
+        locationGroup.removeLocation(location)
+        locationGroup.decayWeight()
+        chosenLocations.append(location)
+        updateGroupAvailability(locationGroup)
+
+        # Sometimes key item bias is removed after N checks
+        gameConfig.updateKeyItems(remainingKeyItems)
+
+        # Use the weighted key item list to get a list of key items
+        # that we can loop through and attempt to place.
+        stack.append(
+          PlacementFrame(stateKey, remainingKeyItems, locationGroup,
+                         location,
+                         getShuffledKeyItemList(remainingKeyItems, rng))
+        )
+
+    # Try the next key item of the deepest level that has one left.
+    while True:
+      if len(stack) == 0:
+        return False, chosenLocations
+
+      frame = stack[-1]
+      if frame.placedKeyItem is not None:
+        # The last key item tried here failed.
+        game.removeKeyItem(frame.placedKeyItem)
+        frame.placedKeyItem = None
+
+      if frame.nextKeyItem < len(frame.keyItemList):
+        keyItem = frame.keyItemList[frame.nextKeyItem]
+        frame.nextKeyItem += 1
+
+        # Try placing this key item and then go down a level
+        frame.location.setKeyItem(keyItem)
+        game.addKeyItem(keyItem)
+        frame.placedKeyItem = keyItem
+
+        remainingKeyItems = [x for x in frame.remainingKeyItems
+                             if x != keyItem]
+        break
+
+      # We failed to place an item.  Undo location modifications
+      frame.locationGroup.addLocation(frame.location)
+      frame.locationGroup.undoWeightDecay()
+      chosenLocations.remove(frame.location)
+      frame.location.unsetKeyItem()
+      updateGroupAvailability(frame.locationGroup)
+
+      deadEnds.add(frame.stateKey)
+      placementStats.backtracks += 1
+      stack.pop()
+    # end key item loop
+
+# end determineKeyItemPlacement_impl function
 
 #
 # Write out the spoiler log.
@@ -244,9 +375,11 @@ def writeSpoilerLog(chosenLocations, charLocations):
 #
 # param: settings - randomizer settings including gameflags (rset.Settings)
 # param: config - currently determined randomizer output (cfg.RandoConfig)
+# param: rng - random.Random (or the random module) to draw with
 #
 def commitKeyItems(settings: rset.Settings,
-                   config: cfg.RandoConfig):
+                   config: cfg.RandoConfig,
+                   rng=rand):
 
     charLocations = config.char_assign_dict
 
@@ -254,10 +387,11 @@ def commitKeyItems(settings: rset.Settings,
     gameConfig = logicfactory.getGameConfig(settings, config)
 
     # Determine placements for the key items
-    success, chosenLocations = determineKeyItemPlacement(gameConfig)
+    success, chosenLocations = determineKeyItemPlacement(gameConfig, rng)
 
     if not success:
         print("Unable to place key items.")
+        print(f"Key item placement: {placementStats}")
         return
 
     # Write key items to the config
@@ -275,7 +409,7 @@ def commitKeyItems(settings: rset.Settings,
                 # Assign a piece of treasure.
                 dist = treasure.get_treasure_distribution(settings,
                                                           location.lootTier)
-                treasureCode = dist.get_random_item()
+                treasureCode = dist.get_random_item(rng)
                 location.writeTreasure(treasureCode, config)
 
     config.key_item_locations = chosenLocations
@@ -293,6 +427,7 @@ def main():
     config.logic_config = logicfactory.getGameConfig(settings, config)
 
     commitKeyItems(settings, config)
+    print(f"Key item placement: {placementStats}")
 
     key_item_dict = {(loc, config.treasure_assign_dict[loc].held_item)
                      for loc in config.treasure_assign_dict.keys()
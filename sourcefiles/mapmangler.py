@@ -2,7 +2,7 @@ from __future__ import annotations
 from dataclasses import dataclass
 from byteops import get_value_from_bytes, to_file_ptr, to_little_endian,\
     update_ptrs, print_bytes
-from freespace import FreeSpace as FS
+from freespace import FreeSpace as FS, FSWriteType
 
 
 # Location Data (above):
@@ -241,6 +241,7 @@ class LocExits:
 
     def write_to_fsrom(self, fsrom: FS):
 
+        spaceman = fsrom.space_manager
         rom = fsrom.getbuffer()
 
         # Get the existing data's bounds
@@ -271,7 +272,8 @@ class LocExits:
 
             # Free the leftovers
             if num_exits > self.num_records:
-                fsrom.mark_block((out_data_st+len(self.data), last_ptr), True)
+                spaceman.mark_block((out_data_st+len(self.data), last_ptr),
+                                    FSWriteType.MARK_FREE)
         else:
             # Insufficient space, need a new start
             # Ptrs and data need to live in the same bank.  FS won't allow a
@@ -279,26 +281,30 @@ class LocExits:
             # ptr block and data block are in the same bank.
 
             # Free the old space
-            fsrom.mark_block((exit_ptr_st, exit_ptr_st+0x400), True)
-            fsrom.mark_block((first_ptr, first_ptr+7*num_exits), True)
+            spaceman.mark_block((exit_ptr_st, exit_ptr_st+0x400),
+                                FSWriteType.MARK_FREE)
+            spaceman.mark_block((first_ptr, first_ptr+7*num_exits),
+                                FSWriteType.MARK_FREE)
 
             # Get new starts
-            starts = fsrom.get_same_bank_free_addrs([len(self.data),
-                                                     2*len(self.ptrs)])
+            starts = spaceman.get_same_bank_free_addrs([len(self.data),
+                                                        2*len(self.ptrs)])
             out_data_st = starts[0]
             out_ptr_st = starts[1]
 
         # annoying part of dealing with getbuffer()
         del(rom)
 
+        # get_same_bank_free_addrs does not mark anything, so mark the
+        # space here.
         fsrom.seek(out_data_st)
-        fsrom.write(self.data)
+        fsrom.write(self.data, FSWriteType.MARK_USED)
 
         ptr_offset = out_data_st % 0x10000
         ptr_bytes = b''.join(to_little_endian(x+ptr_offset, 2)
                              for x in self.ptrs)
         fsrom.seek(out_ptr_st)
-        fsrom.write(ptr_bytes)
+        fsrom.write(ptr_bytes, FSWriteType.MARK_USED)
 
         ptr_refs = [0x00A69E, 0x00A6A6]
         data_refs = [0x00A6B9, 0x00A6C2, 0x009CF6, 0x009D10, 0x009D1E,
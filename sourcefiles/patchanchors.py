@@ -0,0 +1,525 @@
+from __future__ import annotations
+from enum import Enum
+import hashlib
+from io import BytesIO
+import os
+import pickle
+
+from ctevent import Event
+from eventcommand import EventCommand as EC, get_command, \
+    get_command_length
+
+
+# Patch points in location scripts.
+# The boss and treasure writers find the bytes they change by searching the
+# scripts: the LoadEnemy (0x83) of a boss object, the n-th item text/AddItem
+# pair of a treasure, a marker command to show extra boss parts after.
+# Those places are the same for every seed made from one base image, so an
+# AnchorTable finds them once and the writers poke the bytes directly.
+#
+# An anchor is the location, the object and function that the search starts
+# in, the offset of the found command from that function's start, and which
+# bytes of the command are the field.  Function starts are kept up to date
+# by Event's editing methods, so anchors still work after a writer adds or
+# removes objects.
+#
+# Before an anchor is used, the bytes of its function up to the command are
+# checked against a digest taken when it was found.  If they are the same,
+# the search would find the same command, since it starts at the function
+# start too.  Writers change the fields of other anchors in the same
+# function (earlier items of a treasure function, a LoadEnemy before a
+# show position), so those bytes are left out of the digest.  The command
+# itself has to start there (per the script's CommandIndex) with the same
+# id and length.  If any check fails the writer falls back to searching.
+#
+# Tables are pickled per base image like basesnapshot does.  find_drift
+# finds the anchors again in a rom and reports any that moved, which is how
+# to check a patch that changes scripts.  load_anchor_table runs it on a
+# saved table when asked to (Randomizer does when it builds a snapshot).
+anchor_version = 3
+
+
+class AnchorType(Enum):
+    LOAD_ENEMY = 0  # The enemy id and slot of a boss object's LoadEnemy
+    SHOW_POS = 1    # Where to show a boss's extra parts (insertion point)
+    ITEM_MEM = 2    # The item byte of a treasure's item text assignment
+    ADD_ITEM = 3    # The item of a treasure's AddItem
+
+
+class Anchor:
+
+    def __init__(self, anchor_type: AnchorType, loc_id: int, obj_id: int,
+                 func_id: int, offset: int, command: int, length: int,
+                 field_st: int, width: int, masked: tuple[int] = (),
+                 digest: bytes = None):
+        self.anchor_type = anchor_type
+        self.loc_id = loc_id
+        self.obj_id = obj_id
+        self.func_id = func_id
+
+        # From the start of the function
+        self.offset = offset
+
+        # The command found there, its length and where the field is in
+        # the command.  Insertion points have width 0.
+        self.command = command
+        self.length = length
+        self.field_st = field_st
+        self.width = width
+
+        # Offsets (from the function start) of the bytes before the command
+        # that the digest leaves out and the digest of the rest.  An anchor
+        # without a digest is never used.
+        self.masked = tuple(masked)
+        self.digest = digest
+
+    def __eq__(self, other):
+        return isinstance(other, Anchor) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return (
+            f"Anchor({self.anchor_type.name}, loc={self.loc_id:03X}, "
+            f"obj={self.obj_id:02X}, func={self.func_id:02X}, "
+            f"offset={self.offset:04X}, command={self.command:02X}, "
+            f"length={self.length}, "
+            f"field_st={self.field_st}, width={self.width})"
+        )
+
+    # The digest of the function's bytes before the command in script (see
+    # the top of the file).
+    def get_prefix_digest(self, script: Event) -> bytes:
+        start = script.get_function_start(self.obj_id, self.func_id)
+        prefix = bytearray(script.data[start:start+self.offset])
+
+        for offset in self.masked:
+            prefix[offset] = 0
+
+        return hashlib.sha1(prefix).digest()
+
+    # The position of the command in the script or None if the script no
+    # longer has the command there.  The function has to be the same as
+    # when the anchor was found up to the command, the position has to be
+    # the start of a command in the script, and the whole command has to
+    # fit the field.
+    def get_command_pos(self, script: Event) -> int:
+        if self.obj_id >= script.num_objects or self.digest is None:
+            return None
+
+        if self.field_st + self.width > self.length:
+            return None
+
+        pos = script.get_function_start(self.obj_id, self.func_id) + \
+            self.offset
+
+        if pos + self.length > len(script.data) or \
+           self.get_prefix_digest(script) != self.digest:
+            return None
+
+        index = script.get_command_index()
+        ind = index.find(pos)
+
+        if ind is None or script.data[pos] != self.command:
+            return None
+
+        # The index's length is from when the command was found.  The
+        # data's is for what is there now.  Both have to match.
+        if index.lengths[ind] != self.length or \
+           get_command_length(script.data, pos) != self.length:
+            return None
+
+        return pos
+
+    # The position of the field in the script or None (see above)
+    def get_field_pos(self, script: Event) -> int:
+        pos = self.get_command_pos(script)
+
+        if pos is None:
+            return None
+
+        return pos + self.field_st
+
+
+# The searches the writers do.  They return the position of the found
+# command or None.
+
+# The first LoadEnemy in an object's startup function.  Forward jumps are
+# skipped so that the commands of conditional blocks are not seen.
+def find_load_enemy(script: Event, obj_id: int,
+                    ignore_jumps: bool = True) -> int:
+    start = script.get_object_start(obj_id)
+    end = script.get_function_end(obj_id, 0)
+
+    pos = start
+    while pos < end:
+        cmd = get_command(script.data, pos)
+
+        if cmd.command in EC.fwd_jump_commands and ignore_jumps:
+            pos += (cmd.args[-1] - 1)
+        elif cmd.command == 0x83:
+            return pos
+
+        pos += len(cmd)
+
+    return None
+
+
+# The marker commands that one spot boss writers insert the commands to
+# show extra parts before.  location -> (object, function, marker).  The
+# search starts at the start of the function.
+show_pos_markers = {
+    # Flea's spot - 'Mem.7F020C = 01'
+    0xAD: (0xC, 0, EC.generic_one_arg(0x75, 0x06)),
+    # Slash's spot
+    0xA9: (0xB, 1, EC.generic_one_arg(0xE8, 0x8D)),
+    # Golem's spot - play anim 5 after the golem comes down
+    0x14E: (0xA, 3, EC.generic_one_arg(0xAA, 0x5)),
+}
+
+
+def find_show_pos(script: Event, loc_id: int) -> int:
+    (obj_id, func_id, marker) = show_pos_markers[loc_id]
+    return script.find_exact_command(marker,
+                                     script.get_function_start(obj_id,
+                                                               func_id))
+
+
+# The item text assignment (0x4F to 0x7F0200) and AddItem (0xCA) of the
+# item_num-th item given out by a function.  Returns (assignment position,
+# AddItem position) or None.
+def find_treasure_commands(script: Event, obj_id: int, func_id: int,
+                           item_num: int) -> tuple[int, int]:
+    pos = script.get_function_start(obj_id, func_id)
+    end = script.get_function_end(obj_id, func_id)
+
+    num_add_item = 0
+    num_set_item_mem = 0
+
+    # 0x4F is setting memory, 0xCA is adding item
+    cmd_ids = [0x4F, 0xCA]
+
+    # Loop until we find exactly the right number of item display and
+    # item add commands
+    while (num_add_item != item_num+1 or
+           num_set_item_mem != item_num+1):
+
+        pos, cmd = script.find_command(cmd_ids, pos, end)
+
+        if pos is None:
+            return None
+
+        if cmd.command == 0x4F:
+            # Item text location is 0x7F0200.  In the command, this is
+            # the last argument.
+            if cmd.args[-1] == 0x00:
+                num_set_item_mem += 1
+                set_item_mem_pos = pos
+        elif cmd.command == 0xCA:
+            num_add_item += 1
+            add_item_pos = pos
+
+        pos += len(cmd)
+
+    return (set_item_mem_pos, add_item_pos)
+
+
+# Positions of the bytes to write a treasure's item to (see above)
+def find_treasure_fields(script: Event, obj_id: int, func_id: int,
+                         item_num: int) -> tuple[int, int]:
+    found = find_treasure_commands(script, obj_id, func_id, item_num)
+
+    if found is None:
+        return None
+
+    (set_item_mem_pos, add_item_pos) = found
+    return (set_item_mem_pos + 2, add_item_pos + 1)  # cmd, val, mem
+
+
+# Field position and width of each anchor type in its command
+_anchor_fields = {
+    AnchorType.LOAD_ENEMY: (1, 2),  # cmd, enemy, slot
+    AnchorType.SHOW_POS: (0, 0),
+    AnchorType.ITEM_MEM: (2, 1),    # cmd, val, mem
+    AnchorType.ADD_ITEM: (1, 1),    # cmd, item
+}
+
+
+def _make_anchor(script: Event, anchor_type: AnchorType, loc_id: int,
+                 obj_id: int, func_id: int, pos: int) -> Anchor:
+    offset = pos - script.get_function_start(obj_id, func_id)
+    (field_st, width) = _anchor_fields[anchor_type]
+
+    return Anchor(anchor_type, loc_id, obj_id, func_id, offset,
+                  script.data[pos], get_command_length(script.data, pos),
+                  field_st, width)
+
+
+# Set the digests of a location's anchors.  Each leaves out the fields of
+# the anchors before it in its function.
+def set_digests(script: Event, anchors):
+    anchors = list(anchors)
+
+    fields = []
+    for anchor in anchors:
+        pos = script.get_function_start(anchor.obj_id, anchor.func_id) + \
+            anchor.offset + anchor.field_st
+        fields.extend(range(pos, pos+anchor.width))
+
+    for anchor in anchors:
+        start = script.get_function_start(anchor.obj_id, anchor.func_id)
+        anchor.masked = tuple(sorted(
+            x - start for x in set(fields)
+            if start <= x < start + anchor.offset
+        ))
+        anchor.digest = anchor.get_prefix_digest(script)
+
+
+# The locations and objects of the boss writers' LoadEnemy commands.  Only
+# objects that exist in the base scripts are here.  Objects the writers add
+# are always searched.  So are Heckran's and Yakra XIII's spots (0xC0 and
+# 0xC1) since bossrandoevent.duplicate_maps writes those scripts.
+boss_objects = {
+    0x60: [0x8, 0x9],              # Elder Spawn
+    0x87: [0xB, 0xC],              # Zombor
+    0x97: [0x14],                  # Masa & Mune
+    0xA1: [0xE, 0xF, 0x10],        # Retinite
+    0xA9: [0xB, 0xC],              # Slash
+    0xAD: [0xC],                   # Flea
+    0xB7: [0x9],                   # Flea Plus
+    0xB8: [0x9],                   # Super Slash
+    0xC5: [0x9],                   # Rust Tyrano
+    0xC6: [0xA],                   # Yakra
+    0xFB: [0xB, 0xC, 0xD, 0xE, 0xF],  # Son of Sun
+    0x121: [0x9],                  # Nizbel
+    0x130: [0x8],                  # Nizbel II
+    0x143: [0xE, 0xF],             # Giga Mutant
+    0x145: [0xF, 0x10],            # Terra Mutant
+    0x14E: [0xA],                  # Golem
+    0x19E: [0xA, 0xB],             # Twin Golem
+    0x1EF: [0x9, 0xA],             # Lavos Spawn
+}
+
+
+# The anchors of one location
+class LocationAnchors:
+
+    def __init__(self, loc_id: int):
+        self.loc_id = loc_id
+
+        # key -> Anchor.  Keys are
+        #   (LOAD_ENEMY, obj_id)
+        #   (SHOW_POS,)
+        #   (ITEM_MEM or ADD_ITEM, obj_id, func_id, item_num)
+        self.anchors = dict()
+
+    def __get_field_pos(self, script: Event, key) -> int:
+        anchor = self.anchors.get(key)
+
+        if anchor is None:
+            return None
+
+        return anchor.get_field_pos(script)
+
+    # Position of the LoadEnemy of an object or None if there's no usable
+    # anchor for it.
+    def get_load_enemy_pos(self, script: Event, obj_id: int) -> int:
+        pos = self.__get_field_pos(script, (AnchorType.LOAD_ENEMY, obj_id))
+
+        if pos is None:
+            return None
+
+        return pos - 1
+
+    def get_show_pos(self, script: Event) -> int:
+        return self.__get_field_pos(script, (AnchorType.SHOW_POS,))
+
+    # Positions of the bytes to write a treasure's item to or None
+    def get_treasure_fields(self, script: Event, obj_id: int, func_id: int,
+                         item_num: int) -> tuple[int, int]:
+        key = (obj_id, func_id, item_num)
+        mem_pos = self.__get_field_pos(script, (AnchorType.ITEM_MEM,) + key)
+        add_pos = self.__get_field_pos(script, (AnchorType.ADD_ITEM,) + key)
+
+        if mem_pos is None or add_pos is None:
+            return None
+
+        return (mem_pos, add_pos)
+
+
+class AnchorTable:
+
+    def __init__(self):
+        self.version = anchor_version
+
+        # location -> LocationAnchors
+        self.locations = dict()
+
+        # The script treasures the table was made for as
+        # (location, object, function, item number)
+        self.treasures = []
+
+    # Find every anchor in the scripts of rom.  treasures are the
+    # randoconfig.ScriptTreasures to find anchors for.  Scripts are read
+    # through event_cache (an eventcache.EventCache) if one is given.
+    @classmethod
+    def from_rom(cls, rom, treasures=(), event_cache=None) -> AnchorTable:
+        table = cls()
+        table.treasures = [
+            (int(x.location), x.object_id, x.function_id, x.item_num)
+            for x in treasures
+        ]
+        table.__find_anchors(rom, event_cache)
+
+        return table
+
+    def __find_anchors(self, rom, event_cache):
+        scripts = dict()
+
+        def get_script(loc_id):
+            if loc_id not in scripts:
+                scripts[loc_id] = \
+                    Event.from_rom_location(rom, loc_id, True, event_cache)
+
+            return scripts[loc_id]
+
+        def add_anchor(anchor_type, loc_id, obj_id, func_id, pos, key):
+            if pos is None:
+                print(f"Warning: No {anchor_type.name} anchor found in "
+                      f"location {loc_id:03X} for {key}")
+                return
+
+            anchor = _make_anchor(get_script(loc_id), anchor_type, loc_id,
+                                  obj_id, func_id, pos)
+            self.get_location(loc_id).anchors[key] = anchor
+
+        for (loc_id, obj_ids) in boss_objects.items():
+            script = get_script(loc_id)
+            for obj_id in obj_ids:
+                if obj_id >= script.num_objects:
+                    print(f"Warning: Location {loc_id:03X} has no object "
+                          f"{obj_id:02X}")
+                    continue
+
+                add_anchor(AnchorType.LOAD_ENEMY, loc_id, obj_id, 0,
+                           find_load_enemy(script, obj_id),
+                           (AnchorType.LOAD_ENEMY, obj_id))
+
+        for (loc_id, (obj_id, func_id, marker)) in show_pos_markers.items():
+            add_anchor(AnchorType.SHOW_POS, loc_id, obj_id, func_id,
+                       find_show_pos(get_script(loc_id), loc_id),
+                       (AnchorType.SHOW_POS,))
+
+        for (loc_id, obj_id, func_id, item_num) in self.treasures:
+            script = get_script(loc_id)
+            found = find_treasure_commands(script, obj_id, func_id, item_num)
+            if found is None:
+                found = (None, None)
+
+            key = (obj_id, func_id, item_num)
+            add_anchor(AnchorType.ITEM_MEM, loc_id, obj_id, func_id,
+                       found[0], (AnchorType.ITEM_MEM,) + key)
+            add_anchor(AnchorType.ADD_ITEM, loc_id, obj_id, func_id,
+                       found[1], (AnchorType.ADD_ITEM,) + key)
+
+        # The digests need every anchor's field to be known.
+        for (loc_id, location) in self.locations.items():
+            if location.anchors:
+                set_digests(get_script(loc_id), location.anchors.values())
+
+    # The anchors of a location.  Locations without anchors get an empty
+    # LocationAnchors.
+    def get_location(self, loc_id: int) -> LocationAnchors:
+        loc_id = int(loc_id)
+
+        if loc_id not in self.locations:
+            self.locations[loc_id] = LocationAnchors(loc_id)
+
+        return self.locations[loc_id]
+
+    # Find the anchors again in rom (e.g. after changing a patch) and
+    # compare.  Returns (location, key, old anchor, new anchor) for every
+    # anchor that is different.  Missing anchors are None.
+    def find_drift(self, rom, event_cache=None):
+        if isinstance(rom, BytesIO):
+            rom = rom.getvalue()
+
+        new_table = AnchorTable()
+        new_table.treasures = list(self.treasures)
+        new_table.__find_anchors(rom, event_cache)
+
+        drift = []
+        loc_ids = sorted(set(self.locations) | set(new_table.locations))
+        for loc_id in loc_ids:
+            old_anchors = self.get_location(loc_id).anchors
+            new_anchors = new_table.get_location(loc_id).anchors
+
+            for key in list(dict.fromkeys(list(old_anchors) +
+                                          list(new_anchors))):
+                old = old_anchors.get(key)
+                new = new_anchors.get(key)
+
+                if old != new:
+                    drift.append((loc_id, key, old, new))
+
+        return drift
+
+
+def get_table_filename(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.anchors')
+
+
+# Get the anchor table of a base image, reading it from cache_dir if it was
+# made before (for the same treasures) and otherwise finding the anchors in
+# rom and saving the table there.  key identifies the base image (see
+# basesnapshot.get_snapshot_key).  rom may be an FSRom.
+#
+# With check set a saved table is compared against rom with find_drift
+# first.  Any drift is printed and the table is found again.
+def load_anchor_table(cache_dir: str, key: str, rom, treasures=(),
+                      event_cache=None, check: bool = False) -> AnchorTable:
+    filename = get_table_filename(cache_dir, key)
+    treasure_keys = [
+        (int(x.location), x.object_id, x.function_id, x.item_num)
+        for x in treasures
+    ]
+
+    if isinstance(rom, BytesIO):
+        rom = rom.getvalue()
+
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as infile:
+                table = pickle.load(infile)
+        except (OSError, pickle.UnpicklingError, EOFError,
+                AttributeError, ImportError):
+            table = None
+
+        if isinstance(table, AnchorTable) and \
+           table.version == anchor_version and \
+           table.treasures == treasure_keys:
+            drift = table.find_drift(rom, event_cache) if check else []
+
+            if not drift:
+                return table
+
+            for (loc_id, drift_key, old, new) in drift:
+                print(f"Warning: Anchor {drift_key} of location "
+                      f"{loc_id:03X} moved: {old} -> {new}")
+
+        print(f"Warning: Ignoring unusable anchor table {filename}")
+
+    table = AnchorTable.from_rom(rom, treasures, event_cache)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated table behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            pickle.dump(table, outfile, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_filename, filename)
+    except (OSError, pickle.PicklingError) as err:
+        print(f"Warning: Unable to save anchor table {filename}: {err}")
+
+    return table
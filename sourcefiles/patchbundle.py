@@ -0,0 +1,172 @@
+from __future__ import annotations
+import hashlib
+import mmap
+import os
+import struct as st
+
+from freespace import FSRom, FSWriteType
+
+
+# Precompiled patch bundles.
+# Applying a .txt or .ips patch means parsing it and doing a seek, write and
+# free space update per record.  A bundle holds the net effect of a list of
+# patches applied in order as sorted, non-overlapping records of
+# (address, payload, write type).  FSRom.apply_bundle puts them all in place
+# at once.
+#
+# Bundle file layout (little endian):
+#   header:  'CTPB', version (1 byte), sha1 of the source patches (20 bytes),
+#            record count (4 bytes)
+#   records: address (4 bytes), length (4 bytes), payload offset (4 bytes),
+#            write type (1 byte)
+#   payload: every record's data back to back.  Offsets are from the start
+#            of the payload.
+bundle_magic = b'CTPB'
+bundle_version = 1
+
+_header = st.Struct('<4sB20sI')
+_record = st.Struct('<IIIB')
+
+
+class PatchBundle:
+
+    def __init__(self, digest: bytes, records, payload):
+        self.digest = digest
+
+        # list of (address, length, payload offset, FSWriteType)
+        self.records = records
+
+        # Anything supporting the buffer protocol.  For a bundle read from a
+        # file this is a view of the mmap.
+        self.payload = memoryview(payload)
+
+        self.__views = []
+        self.__mmap = None
+
+    # Read a bundle file.  The payload is not copied.  It stays mapped until
+    # close() is called.
+    @classmethod
+    def from_file(cls, filename: str) -> PatchBundle:
+        with open(filename, 'rb') as infile:
+            mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, digest, count) = _header.unpack_from(mapped, 0)
+
+        if magic != bundle_magic or version != bundle_version:
+            mapped.close()
+            return None
+
+        records = []
+        pos = _header.size
+        for x in range(count):
+            (addr, length, offset, mark) = _record.unpack_from(mapped, pos)
+            records.append((addr, length, offset, FSWriteType(mark)))
+            pos += _record.size
+
+        view = memoryview(mapped)
+        bundle = cls(digest, records, view[pos:])
+        bundle.__views = [bundle.payload, view]
+        bundle.__mmap = mapped
+
+        return bundle
+
+    def to_file(self, filename: str):
+        data = bytearray(_header.pack(bundle_magic, bundle_version,
+                                      self.digest, len(self.records)))
+
+        for (addr, length, offset, mark) in self.records:
+            data += _record.pack(addr, length, offset, mark.value)
+
+        data += self.payload
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated bundle behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            outfile.write(data)
+
+        os.replace(tmp_filename, filename)
+
+    def close(self):
+        if self.__mmap is not None:
+            for view in self.__views:
+                view.release()
+
+            self.__views = []
+            self.__mmap.close()
+            self.__mmap = None
+
+
+# Hash of the names and contents of the patches in order.  A bundle is
+# stale if this changes.
+def get_patches_digest(filenames: list[str]) -> bytes:
+    digest = hashlib.sha1()
+    for filename in filenames:
+        digest.update(os.path.basename(filename).encode('utf-8') + b'\0')
+        with open(filename, 'rb') as infile:
+            digest.update(infile.read())
+
+    return digest.digest()
+
+
+# Apply the patches to an empty FSRom with the normal FSRom.patch_* code
+# so that bundles always agree with applying the patches directly.  Every
+# byte written ends up in exactly one record with the last write type used
+# on it.
+def compile_patches(filenames: list[str]) -> PatchBundle:
+    fsrom = FSRom(bytes(), False)
+
+    for filename in filenames:
+        if filename.endswith('.ips'):
+            fsrom.patch_ips_file(filename)
+        else:
+            fsrom.patch_txt_file(filename)
+
+    spaceman = fsrom.space_manager
+    buf = fsrom.getbuffer()
+
+    records = []
+    payload = bytearray()
+
+    def add_record(start, end, mark):
+        if end > start:
+            records.append((start, end-start, len(payload), mark))
+            payload.extend(buf[start:end])
+
+    for (start, end) in fsrom.dirty_ranges:
+        pos = start
+        for (free_st, free_end) in spaceman.get_free_blocks(start, end):
+            add_record(pos, free_st, FSWriteType.MARK_USED)
+            add_record(free_st, free_end, FSWriteType.MARK_FREE)
+            pos = free_end
+
+        add_record(pos, end, FSWriteType.MARK_USED)
+
+    del(buf)
+
+    return PatchBundle(get_patches_digest(filenames), records, payload)
+
+
+# Get a bundle for the patches, reusing bundle_filename if it was compiled
+# from the same patches.  Otherwise the patches are compiled and the result
+# saved to bundle_filename for next time.
+def load_bundle(filenames: list[str], bundle_filename: str) -> PatchBundle:
+    digest = get_patches_digest(filenames)
+
+    if os.path.exists(bundle_filename):
+        bundle = PatchBundle.from_file(bundle_filename)
+        if bundle is not None and bundle.digest == digest:
+            return bundle
+
+        if bundle is not None:
+            bundle.close()
+
+    bundle = compile_patches(filenames)
+
+    try:
+        bundle.to_file(bundle_filename)
+    except OSError:
+        # Read-only install.  Still fine to use the compiled bundle.
+        print(f"Warning: Unable to save patch bundle {bundle_filename}")
+
+    return bundle
@@ -13,6 +13,7 @@ from ctenums import ItemID, LocID, TreasureID as TID, CharID, ShopID, \
 import techdb
 # from ctevent import ScriptManager as SM, Event
 from ctrom import CTRom
+from patchanchors import find_treasure_fields
 from freespace import FSWriteType  # Only for the test main() code
 import enemystats
 import statcompute
@@ -448,43 +449,25 @@ class ScriptTreasure(Treasure):
         script_manager = ctrom.script_manager
         script = script_manager.get_script(self.location)
 
-        pos = script.get_function_start(self.object_id,
-                                        self.function_id)
-        end = script.get_function_end(self.object_id,
-                                      self.function_id)
-
-        num_add_item = 0
-        num_set_item_mem = 0
-
-        # 0x4F is setting memory, 0xCA is adding item
-        cmd_ids = [0x4F, 0xCA]
-
-        # Loop until we find exactly the right number of item display and
-        # item add commands
-        while (num_add_item != self.item_num+1 or
-               num_set_item_mem != self.item_num+1):
-
-            pos, cmd = script.find_command(cmd_ids, pos, end)
-
-            if pos is None:
-                print('Error setting item:\n\t', end='')
-                print(self)
-                exit()
-
-            if cmd.command == 0x4F:
-                # Item text location is 0x7F0200.  In the command, this is
-                # the last argument.
-                if cmd.args[-1] != 0x00:
-                    continue
-                else:
-                    num_set_item_mem += 1
-                    set_item_mem_addr = pos + 2  # cmd, val, mem
-            elif cmd.command == 0xCA:
-                num_add_item += 1
-                add_item_addr = pos + 1  # cmd, item
-
-            pos += len(cmd)
+        # The bytes to change are usually known ahead of time.  Otherwise
+        # look for the item_num-th item text and AddItem of the function.
+        fields = None
+        anchors = ctrom.get_location_anchors(self.location)
+        if anchors is not None:
+            fields = anchors.get_treasure_fields(script, self.object_id,
+                                                 self.function_id,
+                                                 self.item_num)
+
+        if fields is None:
+            fields = find_treasure_fields(script, self.object_id,
+                                          self.function_id, self.item_num)
+
+        if fields is None:
+            print('Error setting item:\n\t', end='')
+            print(self)
+            exit()
 
+        (set_item_mem_addr, add_item_addr) = fields
         script.data[set_item_mem_addr] = int(self.held_item)
         script.data[add_item_addr] = int(self.held_item)
 
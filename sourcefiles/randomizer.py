@@ -1,3 +1,5 @@
+from __future__ import annotations
+import multiprocessing
 from shutil import copyfile
 import struct as st
 import os
@@ -32,44 +34,130 @@ import enemyrewards
 from freespace import FSWriteType
 import randoconfig as cfg
 import randosettings as rset
+import patchbundle
+import basesnapshot
+import eventcache
+import stringowners
+import patchanchors
+import randostreams
+
+
+# Patches applied to every seed, in order
+base_patch_files = [
+    './patch.ips',
+    './patches/patch_codebase.txt',
+    './patches/fast_overworld_walk_patch.txt',
+    './patches/faster_epoch_patch.txt',
+    './patches/faster_menu_dpad.txt',
+]
+base_bundle_file = './patches/base_patches.bundle'
+
+# Where the front ends have Randomizer keep snapshots of the rom after its
+# start up patching.
+default_snapshot_dir = './snapshots'
 
 
 class Randomizer:
 
-    def __init__(self, rom: bytearray, settings: rset.Settings):
+    def __init__(self, rom: bytearray, settings: rset.Settings,
+                 snapshot_dir: str = None):
 
         self.ctrom = CTRom(rom)
         self.settings = settings
-        flags = self.settings.gameflags
 
-        # Apply the patches that always are applied
-        self.ctrom.rom_data.patch_ips_file('./patch.ips')
-        self.ctrom.rom_data.patch_txt_file('./patches/patch_codebase.txt')
+        # The start up patching only depends on the rom and which patches
+        # get applied, so it can come from a snapshot of an earlier run.
+        # Snapshots are only used when a snapshot_dir is given.  Otherwise
+        # the work is always done and nothing is written to disk.
+        snapshot = None
+        built_snapshot = False
+        if snapshot_dir is not None:
+            key = basesnapshot.get_snapshot_key(
+                rom, base_patch_files + self.get_flag_patch_files()
+            )
+            snapshot = basesnapshot.load_snapshot(snapshot_dir, key)
+
+        if snapshot is not None:
+            self.ctrom.rom_data.set_state(snapshot.rom_state)
+            self.config = snapshot.config
+        else:
+            self.apply_base_patches()
+
+            if snapshot_dir is not None:
+                snapshot = basesnapshot.BaseSnapshot(
+                    self.ctrom.rom_data.get_state(), self.config
+                )
+                basesnapshot.save_snapshot(snapshot_dir, key, snapshot)
+                built_snapshot = True
+
+        # The scripts of the patched image are the same for every seed with
+        # this key too.  Keep them decoded next to the snapshot.
+        # So are the strings each script uses.  Knowing them lets rewritten
+        # scripts give back strings that no other script needs.
+        if snapshot_dir is not None:
+            rom_data = self.ctrom.rom_data
+            event_cache = eventcache.load_event_cache(snapshot_dir, key,
+                                                      rom_data)
+            self.ctrom.script_manager.event_cache = event_cache
+            rom_data.string_owners = \
+                stringowners.load_string_owners(snapshot_dir, key, rom_data,
+                                                event_cache)
+
+            # The commands the boss and treasure writers patch are found
+            # once per base image too.  When the snapshot was just built,
+            # a saved table is checked against the new image first.
+            treasures = [
+                treasure
+                for treasure in self.config.treasure_assign_dict.values()
+                if isinstance(treasure, cfg.ScriptTreasure)
+            ]
+            self.ctrom.patch_anchors = \
+                patchanchors.load_anchor_table(snapshot_dir, key, rom_data,
+                                               treasures, event_cache,
+                                               built_snapshot)
+
+    # The patches that __init__ applies on top of base_patch_files because
+    # of the settings, in order.
+    def get_flag_patch_files(self) -> list[str]:
+        flags = self.settings.gameflags
+        patch_files = []
 
-        # I verified that the following convenience patches which are now
-        # always applied are disjoint from the glitch fix patches, so it's
-        # safe to move them here.
-        rom_data = self.ctrom.rom_data
-        rom_data.patch_txt_file('./patches/fast_overworld_walk_patch.txt')
-        rom_data.patch_txt_file('./patches/faster_epoch_patch.txt')
-        rom_data.patch_txt_file('./patches/faster_menu_dpad.txt')
-        
         if rset.GameFlags.ZEAL_END in flags:
-            rom_data.patch_txt_file('./patches/zeal_end_boss.txt')
+            patch_files.append('./patches/zeal_end_boss.txt')
 
         if rset.GameFlags.LOST_WORLDS in flags:
-            rom_data.patch_ips_file('./patches/lost.ips')
+            patch_files.append('./patches/lost.ips')
 
         if rset.GameFlags.FAST_PENDANT in flags:
-            rom_data.patch_txt_file('./patches/fast_charge_pendant.txt')
+            patch_files.append('./patches/fast_charge_pendant.txt')
 
         # Omitting fast magic for now.  Trying to keep rom editing to
         # after the config's been written.
 
         # We want to write the hard mode enemies out so that config's
         # enemy_dict is correct
-        if settings.enemy_difficulty == rset.Difficulty.HARD:
-            rom_data.patch_ips_file('./patches/hard.ips')
+        if self.settings.enemy_difficulty == rset.Difficulty.HARD:
+            patch_files.append('./patches/hard.ips')
+
+        return patch_files
+
+    # Apply the patches every seed needs and build the initial config.
+    def apply_base_patches(self):
+        # Apply the patches that always are applied.  They are compiled
+        # into a bundle once and reused for every seed after that.
+        # I verified that the convenience patches which are now always
+        # applied are disjoint from the glitch fix patches, so it's safe to
+        # move them here.
+        rom_data = self.ctrom.rom_data
+        bundle = patchbundle.load_bundle(base_patch_files, base_bundle_file)
+        rom_data.apply_bundle(bundle)
+        bundle.close()
+
+        for filename in self.get_flag_patch_files():
+            if filename.endswith('.ips'):
+                rom_data.patch_ips_file(filename)
+            else:
+                rom_data.patch_txt_file(filename)
 
         # It should be safe to move the robo's ribbon code here since it
         # also doesn't depend on flags and should be applied prior to anything
@@ -80,38 +168,74 @@ class Randomizer:
         # applied.
         self.config = cfg.RandoConfig(bytearray(rom_data.getvalue()))
 
+    # The locations whose scripts randomize edits: those of the script
+    # treasures.  Recruit spots and boss spots are written elsewhere.
+    def get_script_loc_ids(self) -> list[ctenums.LocID]:
+        return list(dict.fromkeys(
+            treasure.location
+            for treasure in self.config.treasure_assign_dict.values()
+            if isinstance(treasure, cfg.ScriptTreasure)
+        ))
+
+    # Load every script randomize will edit at once so that it doesn't stop
+    # to read them one by one.  With workers > 1 the scripts the event cache
+    # doesn't have are read in a process pool.  randomize calls this once
+    # its rom patches are in.
+    def preload_scripts(self, workers: int = 1):
+        self.ctrom.script_manager.preload(self.get_script_loc_ids(), workers)
+
+    # The parts of write_config as (name, names of the parts that must run
+    # first, function).  Each function is given the random.Random of its
+    # own stream (see randostreams).
+    def get_config_stages(self):
+        settings = self.settings
+        config = self.config
+
+        def write_bosses(rng):
+            bossrando.write_assignment_to_config(settings, config, rng)
+            bossrando.scale_bosses_given_assignment(settings, config)
+
+        return [
+            # Character config.  Includes tech randomization.
+            ('characters', [],
+             lambda rng: charrando.write_pcs_to_config(settings, config,
+                                                       rng)),
+            ('techs', ['characters'],
+             lambda rng: techrandomizer.write_tech_order_to_config(
+                 settings, config, rng)),
+            ('treasures', [],
+             lambda rng: treasurewriter.write_treasures_to_config(
+                 settings, config, rng)),
+            ('enemy_rewards', [],
+             lambda rng: enemyrewards.write_enemy_rewards_to_config(
+                 settings, config, rng)),
+            # Important that this goes after treasures because otherwise the
+            # treasurewriter can overwrite key items placed by Chronosanity
+            ('key_items', ['characters', 'treasures'],
+             lambda rng: logicwriter.commitKeyItems(settings, config, rng)),
+            ('shops', [],
+             lambda rng: shopwriter.write_shops_to_config(settings, config,
+                                                          rng)),
+            ('prices', [],
+             lambda rng: shopwriter.write_item_prices_to_config(
+                 settings, config, rng)),
+            # Boss scaling rewrites whole enemies, drops included, so it
+            # goes after enemy rewards.
+            ('boss_assignment', ['enemy_rewards'], write_bosses),
+            # Boss power depends on where the key items and bosses went.
+            ('boss_power', ['key_items', 'boss_assignment'],
+             lambda rng: bossscaler.set_boss_power(settings, config)),
+        ]
+
     # Given the settings passed to the randomizer, write the RandoConfig
     # object.
+    # With workers > 1 the stages that do not depend on each other run on
+    # that many threads.  The config is the same either way.
     # Use a verb other than write?
-    def write_config(self):
-        # Character config.  Includes tech randomization.
-        charrando.write_pcs_to_config(self.settings, self.config)
-        techrandomizer.write_tech_order_to_config(self.settings,
-                                                  self.config)
-
-        # Treasure config.
-        treasurewriter.write_treasures_to_config(self.settings, self.config)
-
-        # Enemy rewards
-        enemyrewards.write_enemy_rewards_to_config(self.settings, self.config)
-
-        # Key item config.  Important that this goes after treasures because
-        # otherwise the treasurewriter can overwrite key items placed by
-        # Chronosanity
-        logicwriter.commitKeyItems(self.settings, self.config)
-
-        # Shops
-        shopwriter.write_shops_to_config(self.settings, self.config)
-
-        # Item Prices
-        shopwriter.write_item_prices_to_config(self.settings, self.config)
-
-        # Boss Rando
-        bossrando.write_assignment_to_config(self.settings, self.config)
-        bossrando.scale_bosses_given_assignment(self.settings, self.config)
-
-        # Boss scaling (done after boss rando)
-        bossscaler.set_boss_power(self.settings, self.config)
+    def write_config(self, workers: int = 1):
+        master_seed = randostreams.get_master_seed(self.settings)
+        randostreams.run_stages(self.get_config_stages(), master_seed,
+                                workers)
 
     def write_spoiler_log(self, filename):
         with open(filename, 'w') as outfile:
@@ -291,7 +415,9 @@ class Randomizer:
 
         file_object.write('\n')
 
-    def randomize(self):
+    # workers is passed on to preload_scripts.  Front ends that use more
+    # than one must call multiprocessing.freeze_support first.
+    def randomize(self, workers: int = 1):
 
         Flags = rset.GameFlags
         gameflags = self.settings.gameflags
@@ -312,6 +438,10 @@ class Randomizer:
         if Flags.UNLOCKED_MAGIC in gameflags:
             fastmagic.process_ctrom(self.ctrom, self.settings, self.config)
 
+        # The rom patches above can change scripts, so the scripts are only
+        # read now.
+        self.preload_scripts(workers)
+
         tabwriter.process_ctrom(self.ctrom, self.settings, self.config)
         treasurewriter.process_ctrom(self.ctrom, self.settings, self.config)
         enemyrewards.process_ctrom(self.ctrom, self.settings, self.config)
@@ -755,10 +885,13 @@ def main():
     settings = rset.Settings.get_race_presets()
     settings.gameflags |= rset.GameFlags.DUPLICATE_CHARS
     settings.gameflags |= rset.GameFlags.BOSS_SCALE
-    rando = Randomizer(rom, settings)
+    rando = Randomizer(rom, settings, default_snapshot_dir)
     rando.write_config()
     rando.write_spoiler_log('spoiler_log.txt')
 
 
 if __name__ == "__main__":
+    # randomize with workers > 1 reads scripts in a process pool, which a
+    # frozen executable can only start with this.
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import random as rand
+
+import randosettings as rset
+
+
+# Each part of write_config (characters, treasures, key items, ...) draws
+# from its own random.Random.  A stream's seed comes from the master seed
+# and the stream's name only, so what one part draws does not depend on
+# how many numbers the parts before it drew or on the order the parts run
+# in.  Parts that do not depend on each other can then run at the same
+# time and still give the same seed.
+
+
+# The seed of the named stream.  The first 8 bytes of a sha256 so that it
+# is the same in every process (str hashes are not).
+def get_stream_seed(master_seed: str, stream_name: str) -> int:
+    digest = hashlib.sha256(f"{master_seed}/{stream_name}".encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+def get_stream(master_seed: str, stream_name: str) -> rand.Random:
+    return rand.Random(get_stream_seed(master_seed, stream_name))
+
+
+# The seed the streams come from.  settings.seed if it was given.  Otherwise
+# one is drawn from the random module, which the front ends seed with the
+# seed name before randomizing.
+def get_master_seed(settings: rset.Settings) -> str:
+    if settings.seed:
+        return str(settings.seed)
+
+    return str(rand.getrandbits(64))
+
+
+# Run write stages, each with its own stream.  stages is a list of
+# (name, names of the stages it needs to run after, function of the
+# stream), like Randomizer.get_config_stages.  With workers > 1 the stages
+# that do not depend on each other run on that many threads.  What each
+# stage draws is the same either way.
+def run_stages(stages, master_seed: str, workers: int = 1):
+    def run_stage(stage):
+        (name, deps, write) = stage
+        write(get_stream(master_seed, name))
+
+    if workers is None or workers <= 1:
+        for stage in stages:
+            run_stage(stage)
+        return
+
+    # Run the stages in waves.  Each wave is every stage whose
+    # dependencies have all finished.
+    done = set()
+    remaining = list(stages)
+    with ThreadPoolExecutor(workers) as executor:
+        while remaining:
+            wave = [stage for stage in remaining
+                    if all(dep in done for dep in stage[1])]
+            if not wave:
+                print('Error: write_config stages have a cycle.')
+                exit()
+
+            # list() so that an exception in a stage is raised here
+            list(executor.map(run_stage, wave))
+
+            done.update(stage[0] for stage in wave)
+            remaining = [stage for stage in remaining
+                         if stage[0] not in done]
@@ -101,8 +101,10 @@ alvlitems = [0xBB,0x0E,0x53,0x54,0x55,0x28,0x39,0x91,0x86,0x8F,0x6C,0x7A,0x6D,0x
 alvlconsumables = [0xC3,0xC5]
 
 
+# rng is the random.Random (or the random module) to draw with.
 def write_shops_to_config(settings: rset.Settings,
-                          config: cfg.RandoConfig):
+                          config: cfg.RandoConfig,
+                          rng=rand):
     regular_dist = tw.TreasureDist(
         (6, low_lvl_consumables + passable_lvl_consumables),
         (4, passable_lvl_items + mid_lvl_items)
@@ -125,7 +127,7 @@ def write_shops_to_config(settings: rset.Settings,
 
     shop_manager = config.shop_manager
     shop_manager.set_shop_items(ShopID.MELCHIOR_FAIR,
-                                get_melchior_shop_items())
+                                get_melchior_shop_items(rng))
 
     shop_types = [regular_shop_ids, good_shop_ids,
                   good_lapis_shop_ids, best_shop_ids]
@@ -137,7 +139,7 @@ def write_shops_to_config(settings: rset.Settings,
         for shop in shop_types[i]:
             guaranteed = shop_guaranteed[i]
             dist = shop_dists[i]
-            items = get_shop_items(guaranteed, dist)
+            items = get_shop_items(guaranteed, dist, rng)
 
             shop_manager.set_shop_items(shop, items)
 
@@ -149,7 +151,8 @@ def write_shops_to_config(settings: rset.Settings,
 
 
 def write_item_prices_to_config(settings: rset.Settings,
-                                config: cfg.RandoConfig):
+                                config: cfg.RandoConfig,
+                                rng=rand):
     items_to_modify = list(ItemID)
 
     # Set up the list of items to randomize
@@ -165,14 +168,14 @@ def write_item_prices_to_config(settings: rset.Settings,
     for item in items_to_modify:
         if settings.shopprices in (rset.ShopPrices.FULLY_RANDOM,
                                    rset.ShopPrices.MOSTLY_RANDOM):
-            price = getRandomPrice()
+            price = getRandomPrice(rng)
         elif settings.shopprices == rset.ShopPrices.FREE:
             price = 0
 
         config.price_manager.set_price(item, price)
 
 
-def get_melchior_shop_items():
+def get_melchior_shop_items(rng=rand):
 
     swords = [ItemID.FLASHBLADE, ItemID.PEARL_EDGE,
               ItemID.RUNE_BLADE, ItemID.DEMON_HIT]
@@ -182,11 +185,11 @@ def get_melchior_shop_items():
     katanas = [ItemID.FLINT_EDGE, ItemID.DARK_SABER, ItemID.AEON_BLADE]
 
     item_list = [
-        rand.choice(swords),
-        rand.choice(robo_arms),
-        rand.choice(guns),
-        rand.choice(bows),
-        rand.choice(katanas),
+        rng.choice(swords),
+        rng.choice(robo_arms),
+        rng.choice(guns),
+        rng.choice(bows),
+        rng.choice(katanas),
         ItemID.REVIVE,
         ItemID.SHELTER
     ]
@@ -194,18 +197,18 @@ def get_melchior_shop_items():
     return item_list
 
 
-def get_shop_items(guaranteed_items: list[ItemID], item_dist):
+def get_shop_items(guaranteed_items: list[ItemID], item_dist, rng=rand):
     shop_items = guaranteed_items[:]
 
     # potentially shop size should be passed in.  Keep the random isolated.
-    item_count = rand.randrange(3, 9) - len(shop_items)
+    item_count = rng.randrange(3, 9) - len(shop_items)
 
     for item_index in range(item_count):
-        item = item_dist.get_random_item()
+        item = item_dist.get_random_item(rng)
 
         # Avoid duplicate items.
         while item in shop_items:
-            item = item_dist.get_random_item()
+            item = item_dist.get_random_item(rng)
 
         shop_items.append(item)
 
@@ -290,9 +293,9 @@ def randomize_shops(outfile):
 # Get a random price from 1-65000.  This function tends to 
 # bias lower numbers to avoid everything being prohibitively expensive.
 #
-def getRandomPrice():
-  r1 = rand.uniform(0, 1)
-  r2 = rand.uniform(0, 1)
+def getRandomPrice(rng=rand):
+  r1 = rng.uniform(0, 1)
+  r2 = rng.uniform(0, 1)
   return math.floor(abs(r1 - r2) * 65000 + 1)
    
 #
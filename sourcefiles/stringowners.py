@@ -0,0 +1,258 @@
+from __future__ import annotations
+from bisect import bisect_left, insort
+import hashlib
+import os
+import struct as st
+from io import BytesIO
+
+from byteops import get_value_from_bytes, to_file_ptr
+from ctevent import Event, get_loc_event_id
+
+
+# Which location events use which strings.
+# Location events don't own their strings.  An event has a string index, a
+# table of 2 byte pointers to its strings, and many events share a table or
+# point into each other's tables.  So when an event is rewritten with new
+# strings the old ones can only be freed once no other event uses them.
+#
+# StringOwners maps the regions of the rom holding string pointers and
+# strings to the events (entries in the event pointer table at 0x3CF9F0)
+# that use them.  Releasing an event gives back the regions that no other
+# event uses anymore.  Finding the owners means reading every location
+# event, so the result is saved per base image like the event cache.
+#
+# Releases are not undone by FSRom.rollback.
+#
+# File layout (little endian):
+#   header:  'CTSO', version (1 byte), sha1 of the key (20 bytes),
+#            event count (4 bytes)
+#   events:  event id (2 bytes), region count (2 bytes), then per region
+#            start (4 bytes) and length (2 bytes)
+owners_magic = b'CTSO'
+owners_version = 1
+
+_header = st.Struct('<4sB20sI')
+_event = st.Struct('<HH')
+_region = st.Struct('<IH')
+
+# Location ids run from 0x000 to 0x1EF
+num_locations = 0x1F0
+
+
+class StringOwners:
+
+    def __init__(self, key_digest: bytes):
+        self.key_digest = key_digest
+
+        # event id -> list of (start, end) regions the event uses
+        self.event_regions = dict()
+
+        # (start, end) -> set of event ids using the region
+        self.region_owners = dict()
+
+        # Regions with owners sorted by start, for finding overlaps.  Some
+        # strings are the tail of another string.
+        self.__sorted_regions = []
+        self.__max_region_len = 0
+
+    # Read every location's event and record the strings it uses.  The
+    # events are read through event_cache (an eventcache.EventCache) if
+    # one is given.
+    @classmethod
+    def from_rom(cls, rom, key_digest: bytes,
+                 event_cache=None) -> StringOwners:
+        owners = cls(key_digest)
+
+        for loc_id in range(num_locations):
+            event_id = get_loc_event_id(rom, loc_id)
+
+            if event_id not in owners.event_regions:
+                event = Event.from_rom_location(rom, loc_id,
+                                                cache=event_cache)
+                owners.add_event(event_id, get_event_regions(rom, event))
+
+        return owners
+
+    # Read a file written by to_file.  Returns None if the file isn't one.
+    @classmethod
+    def from_file(cls, filename: str) -> StringOwners:
+        with open(filename, 'rb') as infile:
+            data = infile.read()
+
+        if len(data) < _header.size:
+            return None
+
+        (magic, version, key_digest, count) = _header.unpack_from(data, 0)
+
+        if magic != owners_magic or version != owners_version:
+            return None
+
+        owners = cls(key_digest)
+
+        pos = _header.size
+        for i in range(count):
+            (event_id, num_regions) = _event.unpack_from(data, pos)
+            pos += _event.size
+
+            regions = []
+            for j in range(num_regions):
+                (start, length) = _region.unpack_from(data, pos)
+                regions.append((start, start+length))
+                pos += _region.size
+
+            owners.add_event(event_id, regions)
+
+        return owners
+
+    def to_file(self, filename: str):
+        data = bytearray(_header.pack(owners_magic, owners_version,
+                                      self.key_digest,
+                                      len(self.event_regions)))
+
+        for (event_id, regions) in sorted(self.event_regions.items()):
+            data += _event.pack(event_id, len(regions))
+            for (start, end) in regions:
+                data += _region.pack(start, end-start)
+
+        # Write to a temp file first so that a killed process never leaves
+        # a truncated file behind.
+        tmp_filename = filename + f".{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as outfile:
+            outfile.write(data)
+
+        os.replace(tmp_filename, filename)
+
+    # Record that an event uses the given regions (e.g. after writing new
+    # strings for it).
+    def add_event(self, event_id: int, regions: list[tuple[int, int]]):
+        event_regions = self.event_regions.setdefault(event_id, [])
+
+        for region in regions:
+            if region in event_regions:
+                continue
+
+            event_regions.append(region)
+
+            if region not in self.region_owners:
+                self.region_owners[region] = set()
+                insort(self.__sorted_regions, region)
+                self.__max_region_len = \
+                    max(self.__max_region_len, region[1]-region[0])
+
+            self.region_owners[region].add(event_id)
+
+    # The event no longer uses its strings.  Returns the (start, end) blocks
+    # that no event uses now.  These can be marked free.
+    def release_event(self, event_id: int) -> list[tuple[int, int]]:
+        unowned = []
+        for region in self.event_regions.pop(event_id, []):
+            owners = self.region_owners[region]
+            owners.discard(event_id)
+
+            if not owners:
+                del self.region_owners[region]
+                del self.__sorted_regions[
+                    bisect_left(self.__sorted_regions, region)
+                ]
+                unowned.append(region)
+
+        # Merge touching regions and then cut out anything still in use.
+        blocks = []
+        for (start, end) in sorted(unowned):
+            if blocks and start <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            else:
+                blocks.append([start, end])
+
+        free_blocks = []
+        for (start, end) in blocks:
+            pos = start
+            for (used_st, used_end) in self.__get_overlaps(start, end):
+                if used_st > pos:
+                    free_blocks.append((pos, used_st))
+                pos = max(pos, used_end)
+
+            if pos < end:
+                free_blocks.append((pos, end))
+
+        return free_blocks
+
+    # Regions with owners that overlap [start, end), sorted by start
+    def __get_overlaps(self, start: int, end: int):
+        ind = bisect_left(self.__sorted_regions,
+                          (start - self.__max_region_len,))
+
+        overlaps = []
+        while ind < len(self.__sorted_regions):
+            (region_st, region_end) = self.__sorted_regions[ind]
+            if region_st >= end:
+                break
+
+            if region_end > start:
+                overlaps.append((region_st, region_end))
+
+            ind += 1
+
+        return overlaps
+
+
+# The (start, end) regions of rom holding the string pointers and strings
+# that an event uses.
+def get_event_regions(rom, event: Event) -> list[tuple[int, int]]:
+    str_index = event.orig_str_index
+    if str_index is None:
+        return []
+
+    bank = to_file_ptr((str_index >> 16) << 16)
+
+    regions = []
+    for (x, string) in zip(event.orig_str_indices, event.strings):
+        ptr_st = to_file_ptr(str_index + 2*x)
+        str_st = get_value_from_bytes(rom[ptr_st:ptr_st+2]) + bank
+
+        regions.append((ptr_st, ptr_st+2))
+        regions.append((str_st, str_st+len(string)))
+
+    return regions
+
+
+def get_key_digest(key: str) -> bytes:
+    return hashlib.sha1(key.encode('utf-8')).digest()
+
+
+def get_owners_filename(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.strings')
+
+
+# Get the string owners of a base image, reading them from cache_dir if
+# they were found before and otherwise reading every location event of rom
+# and saving the result there.  key identifies the base image (see
+# basesnapshot.get_snapshot_key).  rom may be an FSRom.
+def load_string_owners(cache_dir: str, key: str, rom,
+                       event_cache=None) -> StringOwners:
+    filename = get_owners_filename(cache_dir, key)
+    key_digest = get_key_digest(key)
+
+    if os.path.exists(filename):
+        try:
+            owners = StringOwners.from_file(filename)
+        except (OSError, st.error):
+            owners = None
+
+        if owners is not None and owners.key_digest == key_digest:
+            return owners
+
+        print(f"Warning: Ignoring unusable string owners {filename}")
+
+    if isinstance(rom, BytesIO):
+        rom = rom.getvalue()
+
+    owners = StringOwners.from_rom(rom, key_digest, event_cache)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        owners.to_file(filename)
+    except OSError as err:
+        print(f"Warning: Unable to save string owners {filename}: {err}")
+
+    return owners
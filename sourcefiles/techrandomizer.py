@@ -21,7 +21,8 @@ freqs = [[8, 7, 6, 4, 3, 5, 1, 2],  # Crono
 # This needs to be done after char duplicate assignments since balanced tech
 # distribution varies by character.
 def write_tech_order_to_config(settings: rset.Settings,
-                               config: cfg.RandoConfig):
+                               config: cfg.RandoConfig,
+                               rng=random):
 
     global freqs
 
@@ -29,10 +30,11 @@ def write_tech_order_to_config(settings: rset.Settings,
     tech_order = settings.techorder
     for char_id in range(7):
         if tech_order == rset.TechOrder.FULL_RANDOM:
-            perm = generate_permutation_freq([1 for i in range(8)])
+            perm = generate_permutation_freq([1 for i in range(8)], rng)
         elif tech_order == rset.TechOrder.BALANCED_RANDOM:
             assigned_id = char_man.pcs[char_id].assigned_char
-            perm = generate_permutation_freq(freqs[assigned_id])
+            # Copy the frequencies.  They get reordered.
+            perm = generate_permutation_freq(freqs[assigned_id][:], rng)
         else:
             perm = [i for i in range(8)]
 
@@ -46,7 +48,8 @@ def write_tech_order_to_config(settings: rset.Settings,
 # generate a random permutation where each object has a different probability
 # of being drawn.
 # Uniform distribution is [1,1,1,....,1]
-def generate_permutation_freq(rel_freqs):
+# rng is the random.Random (or the random module) to draw with.
+def generate_permutation_freq(rel_freqs, rng=random):
 
     perm = [0]*len(rel_freqs)
     for i in range(len(rel_freqs)):
@@ -54,7 +57,7 @@ def generate_permutation_freq(rel_freqs):
 
     for start in range(0, len(rel_freqs)-1):
         N = sum(rel_freqs[start:])
-        x = random.randrange(1, N+1)
+        x = rng.randrange(1, N+1)
 
         for i in range(start, len(rel_freqs)):
             x -= rel_freqs[i]
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules live in sourcefiles and open files relative to it
+# (./pickles, ./patches), so run the tests from there.
+sourcefiles = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sourcefiles)
+os.chdir(sourcefiles)
@@ -0,0 +1,42 @@
+from compresscache import CompressionCache
+from ctdecompress import compress, decompress, CompressMode
+
+
+def test_get_key_through_instance():
+    cache = CompressionCache()
+    source = b'abcabcabc'
+
+    assert cache.get_key(source, CompressMode.GREEDY) == \
+        CompressionCache.get_key(source, CompressMode.GREEDY)
+    assert cache.get_key(source, CompressMode.GREEDY) != \
+        cache.get_key(source, CompressMode.OPTIMAL)
+
+
+def test_hits_match_compress(tmp_path):
+    source = bytes(range(64))*8
+
+    cache = CompressionCache(cache_dir=str(tmp_path))
+    first = cache.compress(source)
+    second = cache.compress(source)
+
+    assert first == second == compress(source)
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    # The returned packets are copies.
+    first[0] ^= 0xFF
+    assert cache.compress(source) == second
+
+    # A new cache over the same directory reads the packet from disk.
+    disk_cache = CompressionCache(cache_dir=str(tmp_path))
+    assert decompress(disk_cache.compress(source), 0) == source
+    assert disk_cache.disk_hits == 1
+
+
+def test_lru_limit():
+    cache = CompressionCache(max_entries=2)
+    for value in range(3):
+        cache.compress(bytes([value])*32)
+
+    assert len(cache.entries) == 2
+    cache.compress(bytes([0])*32)
+    assert cache.misses == 4
@@ -0,0 +1,72 @@
+import random
+
+import pytest
+
+from ctdecompress import compress, decompress, decompress_into, \
+    decompress_bytewise, CompressMode
+
+
+def get_test_data(seed: int, length: int) -> bytes:
+    rng = random.Random(seed)
+    # Few symbols so that there are plenty of matches, some overlapping.
+    return bytes(rng.choice(b'abcab\x00\x00') for i in range(length))
+
+
+@pytest.mark.parametrize('mode', list(CompressMode))
+@pytest.mark.parametrize('length', [1, 2, 7, 8, 9, 100, 3000, 0x3000])
+def test_round_trip(mode, length):
+    data = get_test_data(length, length)
+    packet = compress(data, mode)
+
+    assert decompress(packet, 0) == data
+    assert decompress_bytewise(packet, 0) == data
+
+
+def test_optimal_not_larger():
+    for seed in range(20):
+        data = get_test_data(seed, 2000)
+        greedy = compress(data, CompressMode.GREEDY)
+        optimal = compress(data, CompressMode.OPTIMAL)
+
+        assert len(optimal) <= len(greedy)
+
+
+def test_decompress_at_offset_with_reused_buffer():
+    out_buffer = bytearray(0x10000)
+    for seed in range(10):
+        data = get_test_data(seed, 500 + seed*100)
+        rom = bytes(seed) + compress(data)
+
+        out_len = decompress_into(rom, seed, out_buffer)
+        assert out_buffer[:out_len] == data
+
+
+# Copies with an offset of 0 or from before the start of the data aren't
+# valid, but decompress gives the same bytes as decompress_bytewise for
+# them even with a buffer holding other data.
+@pytest.mark.parametrize('packet', [
+    # One copy with offset 0 at the start of the data
+    bytes([0x03, 0x00, 0x01, 0x00, 0x00, 0x00]),
+    # One literal and a copy reaching 0x10 bytes back
+    bytes([0x04, 0x00, 0x02, 0x41, 0x10, 0x00, 0x00]),
+    # Two literals and a copy of 5 from 4 back, half before the start
+    bytes([0x05, 0x00, 0x04, 0x41, 0x42, 0x04, 0x20, 0x00]),
+    # A literal, then a copy of 4 with offset 0 after it
+    bytes([0x04, 0x00, 0x02, 0x41, 0x00, 0x10, 0x00]),
+])
+def test_invalid_copy_offset(packet):
+    expected = decompress_bytewise(packet, 0)
+    assert decompress(packet, 0) == expected
+
+    out_buffer = bytearray(b'\xFF'*0x10000)
+    out_len = decompress_into(packet, 0, out_buffer)
+    assert out_buffer[:out_len] == expected
+
+
+# Runs of 8 literals are copied at once and must not grow the buffer.
+def test_literal_overflow():
+    body = bytes(9)*5  # 40 bytes of literals
+    packet = len(body).to_bytes(2, 'little') + body + bytes(1)
+
+    with pytest.raises(SystemExit):
+        decompress_into(packet, 0, bytearray(0x20))
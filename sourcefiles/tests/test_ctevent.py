@@ -0,0 +1,386 @@
+import os
+import random
+import struct
+
+import pytest
+
+# ctstrings (imported by ctevent) reads a table that is made from a rom.
+if not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+from ctdecompress import compress, get_compressed_length  # noqa: E402
+from ctenums import LocID  # noqa: E402
+from ctevent import Event, EventEdits, CommandIndex, ScriptManager, \
+    get_loc_event_ptr, get_compressed_event_length  # noqa: E402
+from freespace import FSRom, FSWriteType  # noqa: E402
+from stringowners import StringOwners  # noqa: E402
+
+
+# (id, length) of plain commands to fill functions with
+PLAIN_COMMANDS = [(0xB1, 1), (0xBA, 1), (0xAD, 2), (0x84, 2), (0x8B, 3),
+                  (0x4F, 3), (0x48, 5)]
+JUMP_FWD, JUMP_BACK = 0x10, 0x11
+
+
+def make_plain_command(rng):
+    (cmd_id, length) = rng.choice(PLAIN_COMMANDS)
+    return bytearray([cmd_id] + [rng.randrange(1, 0x40)
+                                 for i in range(length-1)])
+
+
+# A function of plain commands with some jumps between its commands.
+# Returns the function bytes.
+def make_function(rng, last_cmd):
+    cmds = [make_plain_command(rng) for i in range(rng.randrange(4, 14))]
+
+    # Reserve slots for jumps, then fill in their distances once every
+    # command's position is known.
+    jump_slots = []
+    for i in range(rng.randrange(0, 3)):
+        slot = rng.randrange(0, len(cmds)+1)
+        cmds.insert(slot, bytearray([JUMP_FWD, 0]))
+        jump_slots.append(slot)
+    cmds.append(bytearray([last_cmd]))
+
+    positions = []
+    pos = 0
+    for cmd in cmds:
+        positions.append(pos)
+        pos += len(cmd)
+
+    for (i, cmd) in enumerate(cmds):
+        if cmd[0] != JUMP_FWD:
+            continue
+
+        target_ind = rng.randrange(len(cmds))
+        if target_ind > i:
+            cmd[1] = positions[target_ind] - positions[i] - 1
+        else:
+            cmd[0] = JUMP_BACK
+            cmd[1] = positions[i] + 1 - positions[target_ind]
+
+    return b''.join(cmds)
+
+
+def make_event(seed) -> Event:
+    rng = random.Random(seed)
+    num_objects = rng.randrange(1, 4)
+
+    functions = []
+    for obj_id in range(num_objects):
+        num_funcs = rng.randrange(1, 4)
+        for func_id in range(16):
+            if func_id < num_funcs:
+                last_cmd = 0xB2 if func_id == 0 else 0x00
+                functions.append(make_function(rng, last_cmd))
+            else:
+                functions.append(b'')
+
+    starts = []
+    pos = 32*num_objects
+    for func in functions:
+        starts.append(pos)
+        pos += len(func)
+
+    event = Event()
+    event.num_objects = num_objects
+    event.data = bytearray(struct.pack(f"<{len(starts)}H", *starts) +
+                           b''.join(functions))
+    return event
+
+
+def copy_event(event: Event) -> Event:
+    ret = Event()
+    ret.num_objects = event.num_objects
+    ret.data = bytearray(event.data)
+    return ret
+
+
+def get_protected(event: Event):
+    index = event.get_command_index()
+    data = event.data
+
+    protected = set(event.get_function_start(obj_id, func_id)
+                    for obj_id in range(event.num_objects)
+                    for func_id in range(16))
+    for pos in index.jumps:
+        protected.add(pos)
+        if data[pos] == JUMP_FWD:
+            protected.add(pos + 1 + data[pos+1])
+        else:
+            protected.add(pos + 1 - data[pos+1])
+
+    return protected
+
+
+# Random edits on command boundaries that stay away from jumps, their
+# targets and function starts, as (pos, inserted commands or None,
+# delete end or None).
+def make_edits(event: Event, rng):
+    index = event.get_command_index()
+    protected = get_protected(event)
+
+    edits = []
+    used = set()
+    for ind in rng.sample(range(len(index.offsets)),
+                          min(8, len(index.offsets))):
+        pos = index.offsets[ind]
+        end = pos + index.lengths[ind]
+        if pos in used:
+            continue
+
+        if rng.random() < 0.5:
+            new_cmds = b''.join(make_plain_command(rng)
+                                for i in range(rng.randrange(1, 4)))
+            edits.append((pos, new_cmds, None))
+            used.add(pos)
+        elif pos not in protected and end not in used and \
+                event.data[pos] not in (0x00, 0xB2, JUMP_FWD, JUMP_BACK):
+            edits.append((pos, None, end))
+            used.update((pos, end))
+
+    return sorted(edits, key=lambda x: x[0])
+
+
+@pytest.mark.parametrize('seed', range(60))
+def test_batch_edits_match_single_edits(seed):
+    rng = random.Random(seed)
+    event = make_event(seed)
+    edit_list = make_edits(event, rng)
+
+    batch = copy_event(event)
+    edits = EventEdits()
+    for (pos, new_cmds, end) in edit_list:
+        if new_cmds is None:
+            edits.delete(pos, end)
+        else:
+            edits.insert(pos, new_cmds)
+    batch.apply_edits(edits)
+
+    # One at a time from the back so that positions stay valid
+    single = copy_event(event)
+    for (pos, new_cmds, end) in reversed(edit_list):
+        if new_cmds is None:
+            single.delete_commands(pos, 1)
+        else:
+            single.insert_commands(new_cmds, pos)
+
+    assert batch.data == single.data
+
+
+@pytest.mark.parametrize('seed', range(60))
+def test_index_kept_current(seed):
+    rng = random.Random(seed)
+    event = make_event(seed)
+
+    for round_num in range(3):
+        with event.edit() as editor:
+            for (pos, new_cmds, end) in make_edits(event, rng):
+                if new_cmds is None:
+                    editor.delete_commands(pos, 1)
+                else:
+                    editor.insert_commands(new_cmds, pos)
+
+        index = event.get_command_index()
+        fresh = CommandIndex(event.data, event.get_object_start(0))
+
+        assert index.offsets == fresh.offsets
+        assert index.lengths == fresh.lengths
+        assert index.jumps == fresh.jumps
+
+
+def get_jumps(event: Event):
+    data = event.data
+    jumps = []
+    for pos in event.get_command_index().jumps:
+        if data[pos] == JUMP_FWD:
+            jumps.append((pos, pos + 1 + data[pos+1]))
+        else:
+            jumps.append((pos, pos + 1 - data[pos+1]))
+
+    return jumps
+
+
+# Jumps land where their target went.  When commands were inserted at the
+# target, that is the first of the inserted commands.
+@pytest.mark.parametrize('seed', range(60))
+def test_jumps_follow_targets(seed):
+    rng = random.Random(seed)
+    event = make_event(seed)
+
+    edits = EventEdits()
+    for (pos, new_cmds, end) in make_edits(event, rng):
+        if new_cmds is None:
+            edits.delete(pos, end)
+        else:
+            edits.insert(pos, new_cmds)
+
+    before = get_jumps(event)
+    event.apply_edits(edits)
+
+    assert get_jumps(event) == \
+        [(edits.get_new_pos(pos, True), edits.get_new_pos(target))
+         for (pos, target) in before]
+
+
+def test_edit_helpers():
+    edits = EventEdits()
+    edits.insert(10, b'\xB1\xB1')
+    edits.delete(20, 25)
+    edits.insert(30, b'\xBA')
+
+    assert edits.get_new_pos(10) == 10
+    assert edits.get_new_pos(10, True) == 12
+    assert edits.get_new_pos(25) == 22
+    assert edits.get_new_pos(30, True) == 28
+    assert edits.is_deleted(20) and edits.is_deleted(24)
+    assert not edits.is_deleted(25)
+
+    data = bytearray(range(40))
+    new_data = edits.apply(data)
+    assert new_data == data[:10] + b'\xB1\xB1' + data[10:20] + \
+        data[25:30] + b'\xBA' + data[30:]
+
+
+# A rom with one event at 0x2000 whose one string is at 0x1010 (pointer
+# table at 0x1000).
+def make_string_rom() -> bytearray:
+    body = bytes([0xB8, 0x00, 0x10, 0xC0,  # string index 0xC01000
+                  0xBB, 0x00,              # textbox with string 0
+                  0xB2])
+    data = struct.pack('<16H', *[32]*16) + body
+
+    rom = bytearray(0x10000)
+    rom[0x1000:0x1002] = struct.pack('<H', 0x1010)
+    rom[0x1010:0x1013] = b'AB\x00'
+    packet = compress(bytes([1]) + data)
+    rom[0x2000:0x2000+len(packet)] = packet
+
+    return rom
+
+
+def test_lazy_strings_deferred_without_owners():
+    fsrom = FSRom(make_string_rom())
+    event = Event.from_rom(fsrom, 0x2000, True)
+
+    assert not event.strings_touched
+    assert event.strings == [bytearray(b'AB\x00')]
+
+
+# With string owners the string blocks can be freed and reused, so the
+# strings must be read before that can happen.
+def test_lazy_strings_read_with_owners():
+    fsrom = FSRom(make_string_rom())
+    fsrom.string_owners = StringOwners(bytes(20))
+    event = Event.from_rom(fsrom, 0x2000, True)
+
+    fsrom.getbuffer()[0x1010:0x1013] = b'XY\x00'
+
+    assert event.strings_touched
+    assert event.strings == [bytearray(b'AB\x00')]
+
+
+# Four locations that the shared rom below gives scripts to
+LOCS = list(LocID)[:4]
+
+
+# A rom for a ScriptManager.  Event 0 is used by LOCS[0] and LOCS[2].
+# Events 1 and 2 are different entries pointing at the same packet, used by
+# LOCS[1] and LOCS[3].  Every other location uses event 3.  The space from
+# 0x200000 on is free.
+def make_shared_rom():
+    rom = bytearray(0x400000)
+    packets = [compress(bytes([event.num_objects]) + event.data)
+               for event in (make_event(100), make_event(101),
+                             make_event(102))]
+
+    addrs = []
+    pos = 0x100000
+    for packet in packets:
+        rom[pos:pos+len(packet)] = packet
+        addrs.append(pos)
+        pos += len(packet)
+
+    for (event_id, addr) in enumerate([addrs[0], addrs[1], addrs[1],
+                                       addrs[2]]):
+        ptr_st = 0x3CF9F0 + 3*event_id
+        rom[ptr_st:ptr_st+3] = (addr + 0xC00000).to_bytes(3, 'little')
+
+    loc_events = {LOCS[0]: 0, LOCS[1]: 1, LOCS[2]: 0, LOCS[3]: 2}
+    for loc_id in range(0x1F0):
+        rec_st = 0x360000 + 14*loc_id + 8
+        rom[rec_st:rec_st+2] = loc_events.get(loc_id, 3).to_bytes(2, 'little')
+
+    fsrom = FSRom(bytes(rom))
+    fsrom.space_manager.mark_block((0x200000, 0x400000),
+                                   FSWriteType.MARK_FREE)
+
+    return (fsrom, addrs)
+
+
+def get_free_below(fsrom, end):
+    return list(fsrom.space_manager.get_free_blocks(0, end))
+
+
+def read_script(fsrom, loc_id) -> bytes:
+    event = Event.from_rom_location(fsrom.getvalue(), loc_id)
+    return bytes(event.get_bytearray())
+
+
+# A packet another event entry points at stays in use.
+def test_shared_packet_not_freed():
+    (fsrom, addrs) = make_shared_rom()
+    script_man = ScriptManager(fsrom, [])
+    before = read_script(fsrom, LOCS[3])
+
+    script = script_man.get_script(LOCS[1])
+    script.data += b'\xB1'
+    script_man.write_script_to_rom(LOCS[1])
+
+    assert get_free_below(fsrom, 0x200000) == []
+    assert read_script(fsrom, LOCS[3]) == before
+    assert get_loc_event_ptr(fsrom.getbuffer(), LOCS[1]) >= 0x200000
+
+
+# Locations with the same event id share the pointer, so the old packet is
+# free once one of them is written.  Writing the other one later frees the
+# packet that is there then, with its own length.
+def test_unshared_packet_freed():
+    (fsrom, addrs) = make_shared_rom()
+    script_man = ScriptManager(fsrom, [])
+    old_len = get_compressed_length(fsrom.getbuffer(), addrs[0])
+
+    script_man.get_script(LOCS[2])
+    script_man.get_script(LOCS[0]).data += b'\xB1'*0x40
+    script_man.write_script_to_rom(LOCS[0])
+
+    assert get_free_below(fsrom, 0x200000) == \
+        [(addrs[0], addrs[0] + old_len)]
+
+    # Only the packet written last is used in the free space.  The packet
+    # from LOCS[0] is bigger than what LOCS[2] read, so freeing it with the
+    # length LOCS[2] read would leave some of it used.
+    script_man.write_script_to_rom(LOCS[2])
+    new_len = get_compressed_event_length(fsrom.getbuffer(), LOCS[2])
+    free = list(fsrom.space_manager.get_free_blocks(0x200000, 0x400000))
+    used = 0x200000 - sum(end-start for (start, end) in free)
+
+    # get_compressed_length can leave out the last byte of a packet (see
+    # Event.from_rom), so each packet may be a byte longer than it says.
+    assert new_len <= used <= new_len + 2
+
+def test_set_script_and_strings_reset():
+    (fsrom, addrs) = make_shared_rom()
+    script_man = ScriptManager(fsrom, [])
+
+    script_man.set_script(make_event(5), LOCS[3])
+    assert script_man.orig_len_dict[LOCS[3]] == \
+        get_compressed_event_length(fsrom.getbuffer(), LOCS[3])
+
+    script = script_man.get_script(LOCS[3])
+    script.strings = [bytearray(b'AB\x00')]
+    script.modified_strings = True
+    script_man.write_script_to_rom(LOCS[3])
+
+    assert not script.modified_strings
@@ -0,0 +1,146 @@
+import os
+import pickle
+import random
+
+import pytest
+
+# ctstrings (imported by ctevent) reads a table that is made from a rom.
+if not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+from ctdecompress import compress  # noqa: E402
+from ctevent import Event  # noqa: E402
+from eventquery import EventQueryIndex, load_query_index, \
+    num_locations  # noqa: E402
+from test_ctevent import make_event  # noqa: E402
+
+
+CHANGE_LOC_CMDS = [0xDC, 0xDD, 0xDE, 0xDF, 0xE0, 0xE1]
+NUM_SCRIPTS = 40
+
+
+# A generated script with some ChangeLocations (location in the low 9 bits
+# of the first arg, flags above that) between its commands.
+def make_query_event(seed) -> Event:
+    rng = random.Random(seed)
+    event = make_event(seed)
+
+    for i in range(rng.randrange(0, 4)):
+        index = event.get_command_index()
+        pos = rng.choice(index.offsets)
+        target = rng.randrange(0x10) | rng.choice([0, 0x200, 0x600])
+        cmd = bytes([rng.choice(CHANGE_LOC_CMDS), target & 0xFF,
+                     target >> 8, rng.randrange(0x40), rng.randrange(0x40)])
+        event.insert_commands(cmd, pos)
+
+    return event
+
+
+# A rom whose locations use NUM_SCRIPTS scripts.  Locations share scripts
+# like the real ones do.
+@pytest.fixture(scope='module')
+def query_rom():
+    rom = bytearray(0x400000)
+    pos = 0x100000
+    for script_id in range(NUM_SCRIPTS):
+        event = make_query_event(script_id)
+        packet = compress(bytes([event.num_objects]) + event.data)
+        rom[pos:pos+len(packet)] = packet
+
+        ptr_st = 0x3CF9F0 + 3*script_id
+        rom[ptr_st:ptr_st+3] = (pos + 0xC00000).to_bytes(3, 'little')
+        pos += len(packet)
+
+    rng = random.Random(0)
+    for loc_id in range(num_locations):
+        rec_st = 0x360000 + 14*loc_id + 8
+        rom[rec_st:rec_st+2] = \
+            rng.randrange(NUM_SCRIPTS).to_bytes(2, 'little')
+
+    return bytes(rom)
+
+
+@pytest.fixture(scope='module')
+def query_index(query_rom):
+    return EventQueryIndex.from_rom(query_rom)
+
+
+# Every command with one of cmd_ids in every location as (location,
+# offset, args), found with Event.find_command.
+def scan_locations(rom, cmd_ids, match=lambda cmd: True):
+    found = []
+    for loc_id in range(num_locations):
+        event = Event.from_rom_location(rom, loc_id, True)
+        pos = event.get_object_start(0)
+        while True:
+            (pos, cmd) = event.find_command(cmd_ids, pos)
+            if pos is None:
+                break
+
+            if match(cmd):
+                found.append((loc_id, pos, tuple(cmd.args)))
+            pos += len(cmd)
+
+    return found
+
+
+def get_found(hits):
+    return [(hit.loc_id, hit.offset, hit.args) for hit in hits]
+
+
+def test_change_location_queries_match_scan(query_rom, query_index):
+    for target in range(0x10):
+        scan = scan_locations(
+            query_rom, CHANGE_LOC_CMDS,
+            lambda cmd: cmd.args[0] & 0x1FF == target
+        )
+        hits = query_index.find(CHANGE_LOC_CMDS, {0: target}, {0: 0x1FF})
+
+        assert get_found(hits) == scan
+        assert query_index.find_locations(CHANGE_LOC_CMDS, {0: target},
+                                          {0: 0x1FF}) == \
+            list(dict.fromkeys(x[0] for x in scan))
+
+
+def test_command_queries_match_scan(query_rom, query_index):
+    for cmd_id in (0xB1, 0x8B, 0x48):
+        assert get_found(query_index.find(cmd_id)) == \
+            scan_locations(query_rom, [cmd_id])
+
+    # Two args at once, taken from a command that is there
+    (first, second) = scan_locations(query_rom, [0x8B])[0][2][:2]
+    scan = scan_locations(
+        query_rom, [0x8B],
+        lambda cmd: (cmd.args[0], cmd.args[1]) == (first, second)
+    )
+    assert scan
+    assert get_found(query_index.find(0x8B, {0: first, 1: second})) == scan
+
+
+# Hits are in the function that starts closest before them.
+def test_hit_functions(query_rom, query_index):
+    for hit in query_index.find(CHANGE_LOC_CMDS)[:50]:
+        event = Event.from_rom_location(query_rom, hit.loc_id, True)
+        start = event.get_function_start(hit.obj_id, hit.func_id)
+
+        assert start <= hit.offset
+        assert all(
+            not start < event.get_function_start(obj_id, func_id)
+            <= hit.offset
+            for obj_id in range(event.num_objects)
+            for func_id in range(16)
+        )
+
+
+def test_index_saved_and_loaded(query_rom, query_index, tmp_path):
+    reloaded = pickle.loads(pickle.dumps(query_index))
+    assert reloaded.hits == query_index.hits
+    assert reloaded.find(0xDC, {0: 3}, {0: 0x1FF}) == \
+        query_index.find(0xDC, {0: 3}, {0: 0x1FF})
+
+    built = load_query_index(str(tmp_path), 'key', query_rom)
+    assert os.path.exists(tmp_path / 'key.query')
+
+    loaded = load_query_index(str(tmp_path), 'key', b'')
+    assert loaded.hits == built.hits == query_index.hits
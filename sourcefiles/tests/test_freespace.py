@@ -0,0 +1,125 @@
+import random
+
+import pytest
+
+from freespace import FreeSpace, IndexedFreeSpace, FSWriteType, BankRules
+
+MARKS = [FSWriteType.MARK_USED, FSWriteType.MARK_FREE]
+
+
+def get_free(spaceman):
+    return list(spaceman.get_free_blocks(0, spaceman.end))
+
+
+def random_block(rng, size):
+    start = rng.randrange(0, size-1)
+    return (start, rng.randrange(start+1, min(size, start+0x800)+1))
+
+
+# Apply the same random markings to a FreeSpace and an IndexedFreeSpace and
+# check that they agree after every step.
+@pytest.mark.parametrize('seed', range(10))
+def test_indexed_matches_freespace(seed):
+    rng = random.Random(seed)
+    size = 0x40000
+    is_free = bool(seed % 2)
+
+    plain = FreeSpace(size, is_free)
+    indexed = IndexedFreeSpace(size, is_free)
+
+    for step in range(400):
+        action = rng.random()
+        if action < 0.6:
+            block = random_block(rng, size)
+            mark = rng.choice(MARKS)
+            plain.mark_block(block, mark)
+            indexed.mark_block(block, mark)
+        elif action < 0.7:
+            blocks = sorted(random_block(rng, size) for i in range(5))
+            runs = []
+            for block in blocks:
+                if not runs or block[0] >= runs[-1][0][1]:
+                    runs.append((block, rng.choice(MARKS)))
+            plain.mark_blocks(runs)
+            indexed.mark_blocks(runs)
+        elif action < 0.75:
+            new_end = plain.end + rng.randrange(1, 0x1000)
+            mark = rng.choice(MARKS)
+            plain.extend_end_marker(new_end, mark)
+            indexed.extend_end_marker(new_end, mark)
+        else:
+            free = get_free(plain)
+            if free:
+                largest = max(end - start for (start, end) in free)
+                # Stay well under the largest block so that the bank
+                # rule never makes the search fail.
+                need = rng.randrange(1, max(2, min(largest, 0x8000) // 2))
+                hint = rng.randrange(0, plain.end)
+                if any(end - max(start, hint) >= need*2
+                       for (start, end) in free):
+                    assert plain.get_free_addr(need, hint) == \
+                        indexed.get_free_addr(need, hint)
+
+        assert plain.end == indexed.end
+        assert get_free(plain) == get_free(indexed)
+
+        start, end = random_block(rng, plain.end)
+        assert list(plain.get_free_blocks(start, end)) == \
+            list(indexed.get_free_blocks(start, end))
+
+
+@pytest.mark.parametrize('spaceman_type', [FreeSpace, IndexedFreeSpace])
+def test_nested_rollback(spaceman_type):
+    rng = random.Random(1)
+    spaceman = spaceman_type(0x20000, True)
+    spaceman.mark_block((0x100, 0x2000), FSWriteType.MARK_USED)
+    before = get_free(spaceman)
+
+    spaceman.begin()
+    spaceman.mark_block((0x3000, 0x4000), FSWriteType.MARK_USED)
+    outer = get_free(spaceman)
+
+    spaceman.begin()
+    for i in range(50):
+        spaceman.mark_block(random_block(rng, 0x20000), rng.choice(MARKS))
+    spaceman.extend_end_marker(0x21000, FSWriteType.MARK_FREE)
+    spaceman.rollback()
+
+    assert get_free(spaceman) == outer
+    assert spaceman.end == 0x20000
+
+    spaceman.begin()
+    spaceman.mark_block((0x8000, 0x9000), FSWriteType.MARK_USED)
+    spaceman.commit()
+
+    spaceman.rollback()
+    assert get_free(spaceman) == before
+
+
+@pytest.mark.parametrize('spaceman_type', [FreeSpace, IndexedFreeSpace])
+def test_same_bank_free_addrs(spaceman_type):
+    spaceman = spaceman_type(0x30000, False)
+    spaceman.mark_block((0x08000, 0x08100), FSWriteType.MARK_FREE)
+    spaceman.mark_block((0x18000, 0x18100), FSWriteType.MARK_FREE)
+    spaceman.mark_block((0x1C000, 0x1C200), FSWriteType.MARK_FREE)
+    before = get_free(spaceman)
+
+    sizes = [0x100, 0x150, 0x80]
+    addrs = spaceman.get_same_bank_free_addrs(sizes)
+
+    # Only bank 1 has room for all three.
+    assert all(addr // 0x10000 == 1 for addr in addrs)
+    blocks = sorted(zip(addrs, sizes))
+    for ((addr, size), (next_addr, _)) in zip(blocks, blocks[1:]):
+        assert addr + size <= next_addr
+
+    # The map itself is not changed.
+    assert get_free(spaceman) == before
+
+
+def test_bank_end_rule():
+    spaceman = IndexedFreeSpace(0x20000, False)
+    spaceman.mark_block((0xFF00, 0x10000), FSWriteType.MARK_FREE)
+
+    assert spaceman.get_same_bank_free_addrs(
+        [0x100], rules=BankRules(allow_bank_end=True)) == [0xFF00]
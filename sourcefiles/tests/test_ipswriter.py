@@ -0,0 +1,121 @@
+from io import BytesIO
+import random
+import zlib
+
+import pytest
+
+from freespace import FSRom, FSWriteType
+from ipswriter import get_diff_ranges, make_ips_patch, make_bps_patch, \
+    write_fsrom_patch, ips_eof_addr
+
+
+def read_bps_number(patch, pos):
+    value, shift = 0, 1
+    while True:
+        x = patch[pos]
+        pos += 1
+        value += (x & 0x7F)*shift
+        if x & 0x80:
+            return value, pos
+        shift <<= 7
+        value += shift
+
+
+# Only the SourceRead and TargetRead actions that make_bps_patch uses.
+def apply_bps(source, patch):
+    assert patch[:4] == b'BPS1'
+    source_len, pos = read_bps_number(patch, 4)
+    target_len, pos = read_bps_number(patch, pos)
+    meta_len, pos = read_bps_number(patch, pos)
+    pos += meta_len
+
+    assert source_len == len(source)
+    assert int.from_bytes(patch[-4:], 'little') == zlib.crc32(patch[:-4])
+
+    target = bytearray()
+    while pos < len(patch) - 12:
+        data, pos = read_bps_number(patch, pos)
+        command, length = data & 3, (data >> 2) + 1
+        if command == 0:
+            target += source[len(target):len(target)+length]
+        else:
+            assert command == 1
+            target += patch[pos:pos+length]
+            pos += length
+
+    assert len(target) == target_len
+    return bytes(target)
+
+
+def apply_ips(source, patch):
+    fsrom = FSRom(source, False)
+    fsrom.patch_ips(BytesIO(patch))
+    return fsrom.getvalue()
+
+
+def get_test_rom(size=0x460000):
+    rng = random.Random(0)
+    return bytes(rng.randrange(4) for i in range(0x1000)) * (size // 0x1000)
+
+
+def change_rom(fsrom: FSRom):
+    rng = random.Random(1)
+
+    # Through write()
+    for i in range(20):
+        fsrom.seek(rng.randrange(0, 0x400000))
+        fsrom.write(bytes(rng.randrange(256) for j in range(40)))
+
+    # Straight through the buffer, like most of the writers
+    buf = fsrom.getbuffer()
+    buf[0x1234:0x1240] = bytes(range(12))
+    buf[ips_eof_addr-2:ips_eof_addr+0x40] = bytes(0x42)
+    buf[0x300000:0x300020] = bytes([0xAA])*0x20
+    del(buf)
+
+    # Past the end of the base rom
+    fsrom.seek(fsrom.getbuffer().nbytes)
+    fsrom.write(bytes(0x800) + b'end', FSWriteType.MARK_USED)
+
+
+def test_diff_ranges():
+    source = bytes(0x5000)
+    target = bytearray(source)
+    target[0x10] = 1
+    target[0x1FFF] = 1
+    target[0x2000] = 1
+    target[0x4800] = 1
+    target += b'tail'
+
+    assert get_diff_ranges(source, target) == \
+        [(0x0000, 0x3000), (0x4000, 0x5004)]
+    assert get_diff_ranges(source, source) == []
+
+
+@pytest.mark.parametrize('extension', ['.ips', '.bps'])
+def test_fsrom_patch_round_trip(tmp_path, extension):
+    base = get_test_rom()
+    fsrom = FSRom(base, False)
+    change_rom(fsrom)
+
+    filename = str(tmp_path / ('out' + extension))
+    write_fsrom_patch(fsrom, filename)
+
+    with open(filename, 'rb') as infile:
+        patch = infile.read()
+
+    if extension == '.bps':
+        assert apply_bps(base, patch) == fsrom.getvalue()
+    else:
+        assert apply_ips(base, patch) == fsrom.getvalue()
+
+
+def test_unchanged_bytes_left_out():
+    source = bytes(0x100)
+    target = bytearray(source)
+    target[0x80] = 5
+
+    patch = make_ips_patch(source, target, [(0, 0x100)])
+    assert len(patch) == len(b'PATCH') + 5 + 1 + len(b'EOF')
+    assert apply_bps(source, make_bps_patch(source, target, [(0, 0x100)])) \
+        == target
@@ -0,0 +1,209 @@
+import os
+import random
+
+import pytest
+
+# ctstrings (imported through randoconfig) reads a table that is made from
+# a rom.
+if not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+try:
+    import logicfactory
+except ValueError:
+    # enemystats' CTString defaults are rejected by dataclasses in 3.11+
+    pytest.skip('enemystats needs Python < 3.11', allow_module_level=True)
+
+from ctenums import CharID, ItemID, RecruitID  # noqa: E402
+import logicwriter_chronosanity as chronosanity  # noqa: E402
+from logictypes import compileAccessRule, LocationAvailability  # noqa: E402
+import randosettings as rset  # noqa: E402
+
+
+# The part of a RandoConfig that the logic reads: who is at each recruit
+# spot.
+class RecruitSpot:
+    def __init__(self, held_char: CharID):
+        self.held_char = held_char
+
+
+class FakeConfig:
+    def __init__(self, rng: random.Random):
+        chars = list(CharID)[:7]
+        rng.shuffle(chars)
+        self.char_assign_dict = {
+            recruit_id: RecruitSpot(char)
+            for (recruit_id, char) in zip(RecruitID, chars)
+        }
+
+
+FLAG_SETS = [
+    rset.GameFlags(0),
+    rset.GameFlags.LOCKED_CHARS,
+    rset.GameFlags.LOST_WORLDS,
+    rset.GameFlags.FAST_PENDANT | rset.GameFlags.LOCKED_CHARS,
+    rset.GameFlags.CHRONOSANITY,
+    rset.GameFlags.CHRONOSANITY | rset.GameFlags.LOCKED_CHARS,
+    rset.GameFlags.CHRONOSANITY | rset.GameFlags.LOST_WORLDS,
+]
+
+
+def make_game_config(flags, seed):
+    settings = rset.Settings()
+    settings.gameflags = flags
+
+    return logicfactory.getGameConfig(settings,
+                                      FakeConfig(random.Random(seed)))
+
+
+# Compiled and interpreted rules agree on the characters and the location
+# groups for random sets of key items.
+@pytest.mark.parametrize('flags', FLAG_SETS)
+@pytest.mark.parametrize('seed', range(4))
+def test_compiled_rules_match_rules(flags, seed):
+    rng = random.Random(seed)
+    game_config = make_game_config(flags, seed)
+    game = game_config.getGame()
+    groups = game_config.getLocations()
+
+    assert game.characterRules is not None
+    assert any(group.compiledGame is game for group in groups)
+
+    key_items = list(dict.fromkeys(game_config.getKeyItemList()))
+    for i in range(60):
+        for item in list(game.keyItems):
+            game.removeKeyItem(item)
+        for item in rng.sample(key_items, rng.randrange(len(key_items)+1)):
+            game.addKeyItem(item)
+
+        game.updateAvailableCharacters()
+        compiled_chars = set(game.characters)
+        compiled_access = [group.canAccess(game) for group in groups]
+
+        character_rules = game.characterRules
+        game.characterRules = None
+        game.updateAvailableCharacters()
+        game.characterRules = character_rules
+
+        assert compiled_chars == game.characters
+        assert compiled_access == [group.accessRule(game)
+                                   for group in groups]
+
+
+def test_compile_access_rule():
+    game = make_game_config(rset.GameFlags(0), 0).getGame()
+
+    def rule(game):
+        return game.hasKeyItem(ItemID.PENDANT) and \
+            (game.hasKeyItem(ItemID.DREAMSTONE) or
+             game.hasCharacter(CharID.ROBO))
+
+    compiled = compileAccessRule(rule, game)
+    pendant = game.getStateBit(('item', ItemID.PENDANT))
+    dreamstone = game.getStateBit(('item', ItemID.DREAMSTONE))
+    robo = game.getStateBit(('char', CharID.ROBO))
+
+    assert not compiled.test(0)
+    assert not compiled.test(pendant)
+    assert not compiled.test(dreamstone | robo)
+    assert compiled.test(pendant | dreamstone)
+    assert compiled.test(pendant | robo)
+
+    assert compileAccessRule(lambda game: True, game).test(0)
+    assert not compileAccessRule(lambda game: False, game).test(-1)
+
+
+# A rule that having more key items can make fail is not compiled.
+def test_non_monotone_rule_not_compiled():
+    game = make_game_config(rset.GameFlags(0), 0).getGame()
+
+    def rule(game):
+        return not game.hasKeyItem(ItemID.PENDANT)
+
+    assert compileAccessRule(rule, game) is None
+
+
+# What LocationAvailability should give, from a full getAvailableLocations
+# scan: the groups, their total weight and the group each target falls in.
+def rescan_groups(groups, game):
+    chronosanity.locationGroups = groups
+    available = chronosanity.getAvailableLocations(game)
+    total = sum(group.getWeight() for group in available)
+
+    targets = []
+    for group in available:
+        targets += [group]*group.getWeight()
+
+    return (available, total, targets)
+
+
+# LocationAvailability agrees with a full rescan through random placements,
+# weight decays and key item swaps, with backtracking undoing them again.
+@pytest.mark.parametrize('flags', FLAG_SETS)
+@pytest.mark.parametrize('seed', range(4))
+def test_location_availability_matches_rescan(flags, seed):
+    rng = random.Random(seed)
+    game_config = make_game_config(flags, seed)
+    game = game_config.getGame()
+    groups = game_config.getLocations()
+    key_items = list(dict.fromkeys(game_config.getKeyItemList()))
+
+    # Some groups keep calling their rules
+    for group in rng.sample(groups, max(1, len(groups)//4)):
+        group.compiledGame = None
+
+    availability = LocationAvailability(groups, game)
+    assert availability.uncompiledGroups
+
+    # (group, location, key item) for each level placed
+    stack = []
+    for i in range(400):
+        total = availability.getTotalWeight()
+        op = rng.random()
+        if op < 0.45 and total > 0:
+            # Place a key item in a random available location.
+            group = availability.findGroup(rng.randrange(total))
+            location = rng.choice(group.getLocations())
+            group.removeLocation(location)
+            group.decayWeight()
+            availability.updateGroup(group)
+
+            item = rng.choice([x for x in key_items
+                               if not game.hasKeyItem(x)] or [None])
+            if item is not None:
+                game.addKeyItem(item)
+            stack.append((group, location, item))
+        elif op < 0.65 and stack and stack[-1][2] is not None:
+            # Try another key item in the last location.
+            (group, location, item) = stack.pop()
+            game.removeKeyItem(item)
+            item = rng.choice([x for x in key_items
+                               if not game.hasKeyItem(x)])
+            game.addKeyItem(item)
+            stack.append((group, location, item))
+        elif stack:
+            # Back up a level, or several.
+            for j in range(rng.randrange(1, 4)):
+                if not stack:
+                    break
+                (group, location, item) = stack.pop()
+                if item is not None:
+                    game.removeKeyItem(item)
+                group.addLocation(location)
+                group.undoWeightDecay()
+                availability.updateGroup(group)
+
+        # LocationAvailability is asked first so that the rescan's
+        # character update can't help it.
+        groups_found = availability.getAvailableGroups()
+        total_found = availability.getTotalWeight()
+        targets_found = [availability.findGroup(target)
+                         for target in range(total_found)]
+
+        (available, total, targets) = rescan_groups(groups, game)
+        assert groups_found == available
+        assert total_found == total
+        assert targets_found == targets
+
+    chronosanity.locationGroups = []
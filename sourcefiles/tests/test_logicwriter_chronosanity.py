@@ -0,0 +1,237 @@
+import functools
+import os
+import random
+
+import pytest
+
+# ctstrings (imported through randoconfig) reads a table that is made from
+# a rom.
+if not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+try:
+    import logicfactory
+except ValueError:
+    # enemystats' CTString defaults are rejected by dataclasses in 3.11+
+    pytest.skip('enemystats needs Python < 3.11', allow_module_level=True)
+
+from ctenums import ItemID, TreasureID  # noqa: E402
+import logictypes  # noqa: E402
+import logicwriter_chronosanity as chronosanity  # noqa: E402
+import randosettings as rset  # noqa: E402
+from test_logictypes import FakeConfig  # noqa: E402
+
+
+KEY_ITEMS = [ItemID.PENDANT, ItemID.DREAMSTONE, ItemID.GATE_KEY,
+             ItemID.RUBY_KNIFE, ItemID.C_TRIGGER]
+
+
+# A rule that needs all of the items in one of the clauses.
+def make_rule(clauses):
+    def rule(game):
+        return any(all(game.hasKeyItem(item) for item in clause)
+                   for clause in clauses)
+
+    return rule
+
+
+#
+# A small made up mode: a handful of groups with one or two locations each,
+# opened by random sets of the key items.  With so few locations many
+# placements run out of room and have to back up.
+#
+class SyntheticGameConfig(logicfactory.GameConfig):
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        logicfactory.GameConfig.__init__(self)
+
+    def initLocations(self):
+        rng = self.rng
+        treasures = iter(TreasureID)
+        for i in range(rng.randrange(3, 6)):
+            if i == 0:
+                clauses = [[]]
+            else:
+                clauses = [rng.sample(KEY_ITEMS, rng.randrange(1, 3))
+                           for j in range(rng.randrange(1, 3))]
+
+            decay = rng.choice([None, lambda weight: weight // 2])
+            group = logictypes.LocationGroup(f'group {i}',
+                                             rng.randrange(1, 20),
+                                             make_rule(clauses), decay)
+            for j in range(rng.randrange(1, 3)):
+                group.addLocation(logictypes.Location(next(treasures)))
+
+            self.locationGroups.append(group)
+
+    def initKeyItems(self):
+        items = self.rng.sample(KEY_ITEMS, self.rng.randrange(2, 5))
+        # Weighted like the real modes, with some items listed twice
+        self.keyItemList = items + self.rng.sample(items, 1)
+
+    def initGame(self):
+        settings = rset.Settings()
+        settings.gameflags = rset.GameFlags(0)
+        self.game = logictypes.Game(settings, FakeConfig(self.rng))
+
+
+#
+# determineKeyItemPlacement_impl as it was before it kept its levels on a
+# stack, drawing from rng and finding the locations with a full scan.
+#
+def place_recursive(chosenLocations, remainingKeyItems, gameConfig, rng):
+    if len(remainingKeyItems) == 0:
+        return True, chosenLocations
+
+    availableLocations = \
+        chronosanity.getAvailableLocations(gameConfig.getGame())
+    if len(availableLocations) == 0:
+        return False, chosenLocations
+
+    locationGroup, location = \
+        chronosanity.getRandomLocation(availableLocations, rng)
+    locationGroup.removeLocation(location)
+    locationGroup.decayWeight()
+    chosenLocations.append(location)
+
+    gameConfig.updateKeyItems(remainingKeyItems)
+
+    localKeyItemList = \
+        chronosanity.getShuffledKeyItemList(remainingKeyItems, rng)
+    for keyItem in localKeyItemList:
+        location.setKeyItem(keyItem)
+        gameConfig.getGame().addKeyItem(keyItem)
+
+        newKeyItemList = [x for x in remainingKeyItems if x != keyItem]
+        keyItemConfirmed, returnedChosenLocations = \
+            place_recursive(chosenLocations, newKeyItemList, gameConfig, rng)
+
+        if keyItemConfirmed:
+            return keyItemConfirmed, returnedChosenLocations
+        else:
+            gameConfig.getGame().removeKeyItem(keyItem)
+
+    locationGroup.addLocation(location)
+    locationGroup.undoWeightDecay()
+    chosenLocations.remove(location)
+    location.unsetKeyItem()
+
+    return False, chosenLocations
+
+
+def run_recursive(seed, rng_seed):
+    game_config = SyntheticGameConfig(seed)
+    chronosanity.locationGroups = game_config.getLocations()
+    chronosanity.locationAvailability = None
+
+    result = place_recursive([], game_config.getKeyItemList(), game_config,
+                             random.Random(rng_seed))
+    return get_placement(result)
+
+
+def run_stack(seed, rng_seed):
+    game_config = SyntheticGameConfig(seed)
+    result = chronosanity.determineKeyItemPlacement(game_config,
+                                                    random.Random(rng_seed))
+    return get_placement(result)
+
+
+def get_placement(result):
+    (success, chosen_locations) = result
+    return (success, [(location.getName(), location.getKeyItem())
+                      for location in chosen_locations])
+
+
+#
+# Whether the key items of a fresh SyntheticGameConfig can be placed at
+# all, trying every order of locations and items.
+#
+def is_solvable(seed):
+    game_config = SyntheticGameConfig(seed)
+    game = game_config.getGame()
+    groups = game_config.getLocations()
+    key_items = frozenset(game_config.getKeyItemList())
+
+    @functools.lru_cache(maxsize=None)
+    def solve(owned, used):
+        if owned == key_items:
+            return True
+
+        for item in list(game.keyItems):
+            game.removeKeyItem(item)
+        for item in owned:
+            game.addKeyItem(item)
+        game.updateAvailableCharacters()
+
+        open_locations = [
+            location.getName()
+            for group in groups if group.canAccess(game)
+            for location in group.getLocations()
+            if location.getName() not in used
+        ]
+        return any(solve(owned | {item}, used | {location})
+                   for location in open_locations
+                   for item in key_items - owned)
+
+    return solve(frozenset(), frozenset())
+
+
+# Every placed item can be picked up, starting with nothing and taking what
+# is reachable until nothing new is.
+def is_completable(seed, placement):
+    game_config = SyntheticGameConfig(seed)
+    game = game_config.getGame()
+    placed = dict(placement)
+
+    while True:
+        game.updateAvailableCharacters()
+        found = {
+            placed[location.getName()]
+            for group in game_config.getLocations() if group.canAccess(game)
+            for location in group.getLocations()
+            if location.getName() in placed
+        } - game.keyItems
+        if not found:
+            break
+        for item in found:
+            game.addKeyItem(item)
+
+    return game.keyItems == set(game_config.getKeyItemList())
+
+
+# Without pruning the stack makes the same draws as the recursion, so it
+# picks the same locations and items.
+def test_stack_matches_recursive():
+    compared = 0
+    for seed in range(150):
+        for rng_seed in range(3):
+            stack_result = run_stack(seed, rng_seed)
+            if chronosanity.placementStats.pruned == 0:
+                assert stack_result == run_recursive(seed, rng_seed)
+                compared += 1
+
+    assert compared > 300
+
+
+# Pruned states really are dead ends: the stack places the items whenever
+# it can be done at all.
+def test_pruning_keeps_solvable_states():
+    pruned_runs = 0
+    failures = 0
+    for seed in range(150):
+        solvable = is_solvable(seed)
+        for rng_seed in range(3):
+            (success, placement) = run_stack(seed, rng_seed)
+            pruned_runs += chronosanity.placementStats.pruned > 0
+
+            assert success == solvable
+            assert run_recursive(seed, rng_seed)[0] == solvable
+            if success:
+                assert is_completable(seed, placement)
+            else:
+                failures += 1
+
+    # The configs cover both pruning and impossible placements.
+    assert pruned_runs > 0
+    assert failures > 0
@@ -0,0 +1,180 @@
+import os
+import random
+
+import pytest
+
+# ctstrings (imported by ctevent) reads a table that is made from a rom.
+if not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+from ctevent import Event  # noqa: E402
+from eventcommand import get_command_length  # noqa: E402
+import patchanchors  # noqa: E402
+from patchanchors import Anchor, AnchorTable, AnchorType, \
+    set_digests  # noqa: E402
+from test_ctevent import make_event, copy_event, \
+    make_plain_command  # noqa: E402
+
+
+LOAD_ENEMY = bytes([0x83, 0x12, 0x03])
+PREFIX = bytes([0xB1, 0xB1, 0xB1])
+
+
+# A generated script whose last object's startup function starts with
+# PREFIX and then a LoadEnemy.
+def make_boss_event(seed) -> Event:
+    event = make_event(seed)
+    obj_id = event.num_objects - 1
+    event.insert_commands(LOAD_ENEMY, event.get_object_start(obj_id))
+    event.insert_commands(PREFIX, event.get_object_start(obj_id))
+
+    return event
+
+
+def get_load_enemy_pos(event: Event) -> int:
+    return event.get_object_start(event.num_objects - 1) + len(PREFIX)
+
+
+def make_load_anchor(event: Event, **changes) -> Anchor:
+    obj_id = event.num_objects - 1
+    args = dict(anchor_type=AnchorType.LOAD_ENEMY, loc_id=0, obj_id=obj_id,
+                func_id=0, offset=len(PREFIX), command=0x83, length=3,
+                field_st=1, width=2)
+    args.update(changes)
+
+    anchor = Anchor(**args)
+    set_digests(event, [anchor])
+    return anchor
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_anchor_follows_other_objects_edits(seed):
+    rng = random.Random(seed)
+    event = make_boss_event(seed)
+    anchor = make_load_anchor(event)
+    obj_id = anchor.obj_id
+
+    # Commands added in front of the object move its functions.  Ones
+    # added after the LoadEnemy don't move it.
+    for i in range(3):
+        positions = [event.get_object_start(x) for x in range(obj_id)]
+        positions.append(get_load_enemy_pos(event) + len(LOAD_ENEMY))
+        event.insert_commands(make_plain_command(rng), rng.choice(positions))
+
+        pos = anchor.get_command_pos(event)
+        assert pos == get_load_enemy_pos(event)
+        assert event.data[pos:pos+3] == LOAD_ENEMY
+
+
+def test_anchor_needs_command_start():
+    event = make_boss_event(0)
+    pos = get_load_enemy_pos(event)
+
+    # A byte inside the command that happens to equal the anchor's id
+    event.data[pos+1] = 0x83
+    anchor = make_load_anchor(event, offset=len(PREFIX)+1)
+    assert event.data[pos+1] == anchor.command
+    assert anchor.get_command_pos(event) is None
+
+
+# Edits before the anchor in its function can put another LoadEnemy of the
+# same length at its offset.  That isn't the one the search would find, so
+# the anchor must not be used.
+def test_anchor_needs_same_function_prefix():
+    event = make_boss_event(2)
+    anchor = make_load_anchor(event)
+    start = event.get_object_start(anchor.obj_id)
+
+    event.delete_commands(start, len(PREFIX))  # One byte commands
+    event.insert_commands(bytes([0x83, 0x20, 0x01]), start)
+
+    pos = start + anchor.offset
+    assert event.get_command_index().find(pos) is not None
+    assert event.data[pos:pos+3] == LOAD_ENEMY
+    assert anchor.get_command_pos(event) is None
+
+
+# The fields of anchors before this one in the function are left out, so
+# writing them doesn't stop the anchor from being used.
+def test_anchor_ignores_earlier_fields():
+    event = make_boss_event(3)
+    obj_id = event.num_objects - 1
+    show_pos = get_load_enemy_pos(event) + len(LOAD_ENEMY)
+
+    first = Anchor(AnchorType.LOAD_ENEMY, 0, obj_id, 0, len(PREFIX), 0x83, 3,
+                   1, 2)
+    second = Anchor(AnchorType.SHOW_POS, 0, obj_id, 0,
+                    len(PREFIX) + len(LOAD_ENEMY), event.data[show_pos],
+                    get_command_length(event.data, show_pos), 0, 0)
+    set_digests(event, [first, second])
+
+    pos = first.get_field_pos(event)
+    event.data[pos:pos+2] = b'\x44\x05'
+    assert second.get_command_pos(event) == pos + 2
+
+    event.data[pos-2] = 0xBA  # A byte of PREFIX
+    assert second.get_command_pos(event) is None
+
+
+def test_anchor_checks_length_and_layout():
+    event = make_boss_event(1)
+
+    assert make_load_anchor(event).get_command_pos(event) is not None
+    assert make_load_anchor(event, length=4).get_command_pos(event) is None
+    assert make_load_anchor(event, width=3).get_command_pos(event) is None
+
+    # A command of another length written over the found one in place
+    pos = get_load_enemy_pos(event)
+    event.data[pos] = 0xB1
+    assert make_load_anchor(event).get_command_pos(event) is None
+
+
+# Scripts come from a dict of location -> Event instead of a rom.
+@pytest.fixture
+def dict_rom(monkeypatch):
+    def from_rom_location(rom, loc_id, lazy=False, cache=None):
+        return copy_event(rom[loc_id])
+
+    monkeypatch.setattr(Event, 'from_rom_location',
+                        staticmethod(from_rom_location))
+    monkeypatch.setattr(patchanchors, 'show_pos_markers', dict())
+
+    rom = {loc_id: make_boss_event(loc_id) for loc_id in range(4)}
+    monkeypatch.setattr(patchanchors, 'boss_objects',
+                        {loc_id: [event.num_objects - 1]
+                         for (loc_id, event) in rom.items()})
+    return rom
+
+
+def move_load_enemy(rom, loc_id):
+    event = rom[loc_id]
+    event.insert_commands(bytes([0xB1]),
+                          event.get_object_start(event.num_objects - 1))
+
+
+def test_find_drift(dict_rom):
+    table = AnchorTable.from_rom(dict_rom)
+    assert table.find_drift(dict_rom) == []
+
+    move_load_enemy(dict_rom, 2)
+    drift = table.find_drift(dict_rom)
+
+    assert len(drift) == 1
+    (loc_id, key, old, new) = drift[0]
+    assert loc_id == 2 and key[0] == AnchorType.LOAD_ENEMY
+    assert new.offset == old.offset + 1
+
+
+def test_load_anchor_table_check(dict_rom, tmp_path):
+    table = patchanchors.load_anchor_table(str(tmp_path), 'key', dict_rom)
+    move_load_enemy(dict_rom, 3)
+
+    # Without check the saved table is used as is
+    loaded = patchanchors.load_anchor_table(str(tmp_path), 'key', dict_rom)
+    assert loaded.locations[3].anchors == table.locations[3].anchors
+
+    checked = patchanchors.load_anchor_table(str(tmp_path), 'key', dict_rom,
+                                             check=True)
+    assert checked.find_drift(dict_rom) == []
+    assert checked.locations[3].anchors != table.locations[3].anchors
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import pickle
+import random
+
+import pytest
+
+# The Randomizer needs a rom, and ctstrings reads a table made from one.
+if not os.path.exists('./roms/ct.sfc') or \
+   not os.path.exists('./pickles/huffman_table.pickle'):
+    pytest.skip('needs ./roms/ct.sfc and ./pickles/huffman_table.pickle',
+                allow_module_level=True)
+
+import randosettings as rset  # noqa: E402
+from randomizer import Randomizer  # noqa: E402
+
+
+GameFlags = rset.GameFlags
+FLAG_SETS = [
+    GameFlags(0),
+    GameFlags.CHRONOSANITY | GameFlags.LOCKED_CHARS,
+    GameFlags.LOST_WORLDS | GameFlags.BOSS_RANDO,
+    GameFlags.BOSS_RANDO | GameFlags.BOSS_SCALE | GameFlags.DUPLICATE_CHARS,
+]
+
+
+@pytest.fixture(scope='module')
+def rom():
+    with open('./roms/ct.sfc', 'rb') as infile:
+        return infile.read()
+
+
+def get_config_hash(rom, flags, workers, global_seed):
+    settings = rset.Settings.get_race_presets()
+    settings.gameflags |= flags
+    settings.seed = 'streams'
+
+    # Draws from the global random module must not matter.
+    random.seed(global_seed)
+    rando = Randomizer(rom[:], settings)
+    rando.write_config(workers)
+
+    return hashlib.sha256(pickle.dumps(rando.config)).hexdigest()
+
+
+# The real write_config stages give the same RandoConfig whether they run
+# one at a time or in parallel.
+@pytest.mark.parametrize('flags', FLAG_SETS)
+def test_parallel_write_config_matches_serial(rom, flags):
+    serial_hash = get_config_hash(rom, flags, 1, 1)
+
+    for workers in (2, 4, 8):
+        assert get_config_hash(rom, flags, workers, workers) == serial_hash
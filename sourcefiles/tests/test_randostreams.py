@@ -0,0 +1,87 @@
+import hashlib
+import pickle
+import random
+import time
+
+import pytest
+
+import randostreams
+
+
+# Stages shaped like Randomizer.get_config_stages.  Each one draws from its
+# stream into a shared dict.  The later ones read what the stages they
+# depend on wrote, like key items reading treasures.  The sleeps (from the
+# global random module) shuffle the order threads finish in.
+def make_stages(config):
+    def draw(name, deps):
+        def write(rng):
+            time.sleep(random.random() / 500)
+            values = [rng.randrange(1000) for i in range(50)]
+            for dep in deps:
+                values += config[dep][:5]
+            rng.shuffle(values)
+            config[name] = values
+
+        return (name, deps, write)
+
+    return [
+        draw('characters', []),
+        draw('techs', ['characters']),
+        draw('treasures', []),
+        draw('enemy_rewards', []),
+        draw('key_items', ['characters', 'treasures']),
+        draw('shops', []),
+        draw('prices', []),
+        draw('boss_assignment', ['enemy_rewards']),
+        draw('boss_power', ['key_items', 'boss_assignment']),
+    ]
+
+
+def get_config_hash(master_seed, workers, global_seed):
+    random.seed(global_seed)
+    config = dict()
+    randostreams.run_stages(make_stages(config), master_seed, workers)
+
+    # Sorted so that the order the stages finished in doesn't count
+    return hashlib.sha256(pickle.dumps(sorted(config.items()))).hexdigest()
+
+
+@pytest.mark.parametrize('master_seed', ['race', 'abc123', '0'])
+def test_parallel_config_matches_serial(master_seed):
+    serial_hash = get_config_hash(master_seed, 1, 1)
+
+    for workers in (2, 4, 8):
+        for global_seed in range(3):
+            assert get_config_hash(master_seed, workers, global_seed) == \
+                serial_hash
+
+
+def test_master_seed_changes_config():
+    assert get_config_hash('race', 1, 0) != get_config_hash('Race', 1, 0)
+
+
+# Stages run after the stages they depend on.
+def test_stages_run_after_deps():
+    finished = []
+
+    def stage(name, deps):
+        return (name, deps, lambda rng: finished.append(name))
+
+    stages = [stage('c', ['a', 'b']), stage('b', ['a']), stage('a', [])]
+    randostreams.run_stages(stages, 'seed', 4)
+
+    assert finished == ['a', 'b', 'c']
+
+
+def test_stream_seeds():
+    seed = randostreams.get_stream_seed('race', 'treasures')
+
+    # The same in every process and every run, so pinned here
+    assert seed == 0x6b27281a44a9b6ec
+
+    names = ['characters', 'techs', 'treasures', 'key_items', 'shops']
+    seeds = {randostreams.get_stream_seed('race', name) for name in names}
+    assert len(seeds) == len(names)
+
+    assert randostreams.get_stream('race', 'shops').random() == \
+        randostreams.get_stream('race', 'shops').random()
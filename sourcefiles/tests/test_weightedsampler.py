@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+from weightedsampler import WeightedSampler
+
+
+# The linear scan that WeightedSampler.find replaces
+def linear_find(weights, target):
+    running = 0
+    for (ind, weight) in enumerate(weights):
+        running += weight
+        if running > target:
+            return ind
+
+    return None
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_find_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    weights = [rng.choice([0, 0, 1, 2, 5, 17, 100])
+               for i in range(rng.randrange(1, 70))]
+    weights[rng.randrange(len(weights))] += 1
+    sampler = WeightedSampler(weights)
+
+    assert sampler.get_total() == sum(weights)
+    for target in range(sampler.get_total()):
+        assert sampler.find(target) == linear_find(weights, target)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_set_weight_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    weights = [rng.randrange(0, 10) for i in range(rng.randrange(1, 40))]
+    sampler = WeightedSampler(weights)
+
+    for i in range(100):
+        ind = rng.randrange(len(weights))
+        weights[ind] = rng.randrange(0, 10)
+        sampler.set_weight(ind, weights[ind])
+
+        assert sampler.get_weight(ind) == weights[ind]
+        assert sampler.get_total() == sum(weights)
+
+        if sampler.get_total() > 0:
+            target = rng.randrange(sampler.get_total())
+            assert sampler.find(target) == linear_find(weights, target)
+
+
+# Drawing takes the same random numbers as the scans it replaces, so the
+# same seed gives the same indices.
+def test_draw_and_sample_match_linear_scan():
+    weights = [3, 0, 7, 1, 0, 12, 4]
+    total = sum(weights)
+    sampler = WeightedSampler(weights)
+
+    rng = random.Random(1234)
+    expected = [linear_find(weights, rng.randrange(0, total))
+                for i in range(200)]
+
+    rng = random.Random(1234)
+    assert [sampler.draw(rng) for i in range(200)] == expected
+
+    rng = random.Random(1234)
+    assert sampler.sample(200, rng) == expected
+
+
+def test_zero_weights_never_drawn():
+    sampler = WeightedSampler([0, 5, 0, 0, 2, 0])
+    rng = random.Random(0)
+
+    assert set(sampler.sample(500, rng)) == {1, 4}
+
+
+def test_negative_weights_rejected():
+    with pytest.raises(ValueError):
+        WeightedSampler([1, -1])
+
+    sampler = WeightedSampler([1, 2])
+    with pytest.raises(ValueError):
+        sampler.set_weight(0, -3)
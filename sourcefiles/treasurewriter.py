@@ -10,6 +10,7 @@ from ctevent import get_compressed_event_length, get_loc_event_ptr
 from ctrom import CTRom
 import randoconfig as cfg
 import randosettings as rset
+from weightedsampler import WeightedSampler
 
 TID = ctenums.TreasureID
 ItemID = ctenums.ItemID
@@ -338,18 +339,15 @@ class TreasureDist:
         # input()
         self.weight_item_pairs = weight_item_pairs
 
-    def get_random_item(self) -> ItemID:
-        target = rand.randrange(0, self.__total_weight)
+    # rng is the random.Random (or the random module) to draw with.
+    def get_random_item(self, rng=rand) -> ItemID:
+        ind = self.__sampler.find(rng.randrange(0, self.__total_weight))
+        return rng.choice(self.__weight_item_pairs[ind][1])
 
-        value = 0
-        for x in self.__weight_item_pairs:
-            value += x[0]
-
-            if value > target:
-                return rand.choice(x[1])
-
-        print("Error, no selection")
-        exit()
+    # Draw k items.  The same as calling get_random_item k times, so the
+    # random numbers are used in the same order.
+    def sample(self, k: int, rng=rand) -> list[ItemID]:
+        return [self.get_random_item(rng) for i in range(k)]
 
     @property
     def weight_item_pairs(self):
@@ -358,7 +356,8 @@ class TreasureDist:
     @weight_item_pairs.setter
     def weight_item_pairs(self, new_pairs: list[Tuple[int, list[ItemID]]]):
         self.__weight_item_pairs = new_pairs
-        self.__total_weight = sum(x[0] for x in new_pairs)
+        self.__sampler = WeightedSampler([x[0] for x in new_pairs])
+        self.__total_weight = self.__sampler.get_total()
 
 
 # Set up a big lookup table for distributions.
@@ -489,7 +488,8 @@ def get_treasure_distribution(settings: rset.Settings,
 
 
 def write_treasures_to_config(settings: rset.Settings,
-                              config: cfg.RandoConfig):
+                              config: cfg.RandoConfig,
+                              rng=rand):
 
     assign = config.treasure_assign_dict
 
@@ -498,8 +498,9 @@ def write_treasures_to_config(settings: rset.Settings,
         treasures = treasure_tiers[tier]
         dist = get_treasure_distribution(settings, tier)
 
-        for treasure in treasures:
-            assign[treasure].held_item = dist.get_random_item()
+        items = dist.sample(len(treasures), rng)
+        for (treasure, item) in zip(treasures, items):
+            assign[treasure].held_item = item
 
     # Now do special treasures.  These don't have complicated distributions.
     specials = [
@@ -524,7 +525,7 @@ def write_treasures_to_config(settings: rset.Settings,
     for i in range(len(specials)):
         treasure = specials[i]
         items = item_lists[i]
-        assign[treasure].held_item = rand.choice(items)
+        assign[treasure].held_item = rng.choice(items)
 
     # finally rocks
     rock_tids = [TID.DENADORO_ROCK, TID.GIANTS_CLAW_ROCK,
@@ -532,7 +533,7 @@ def write_treasures_to_config(settings: rset.Settings,
 
     rocks = [ItemID.GOLD_ROCK, ItemID.BLUE_ROCK,
              ItemID.SILVERROCK, ItemID.BLACK_ROCK, ItemID.WHITE_ROCK]
-    rand.shuffle(rocks)
+    rng.shuffle(rocks)
 
     for ind, tid in enumerate(rock_tids):
         assign[tid].held_item = rocks[ind]
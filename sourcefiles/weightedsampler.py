@@ -0,0 +1,87 @@
+from __future__ import annotations
+import random as rand
+
+
+# Weighted random choice over a list of weights.
+# The weights are kept in a Fenwick tree (binary indexed tree), so drawing
+# an index and changing a weight are both O(log n).  Scanning the weights
+# for every draw is O(n), which adds up when the weights change between
+# draws (location group decay) or when hundreds of draws come from the same
+# weights (treasure tiers).
+#
+# find(target) gives the same index as walking the weights in order and
+# stopping once the running total passes target.  So a draw takes the same
+# random numbers and gives the same result as the linear scans it replaces.
+class WeightedSampler:
+
+    def __init__(self, weights: list[int]):
+        self.__weights = list(weights)
+
+        for weight in self.__weights:
+            if weight < 0:
+                raise ValueError('Weights must not be negative.')
+
+        # tree[i] holds the sum of the weights (i - (i & -i), i].  It is
+        # 1-indexed, so tree[0] is unused.
+        size = len(self.__weights)
+        self.__tree = [0] + self.__weights
+        for ind in range(1, size+1):
+            parent = ind + (ind & -ind)
+            if parent <= size:
+                self.__tree[parent] += self.__tree[ind]
+
+        self.__total = sum(self.__weights)
+
+        self.__top_bit = 1
+        while self.__top_bit*2 <= size:
+            self.__top_bit *= 2
+
+    def __len__(self):
+        return len(self.__weights)
+
+    def get_weight(self, ind: int) -> int:
+        return self.__weights[ind]
+
+    def set_weight(self, ind: int, weight: int):
+        if weight < 0:
+            raise ValueError('Weights must not be negative.')
+
+        delta = weight - self.__weights[ind]
+        if delta == 0:
+            return
+
+        self.__weights[ind] = weight
+        self.__total += delta
+
+        pos = ind + 1
+        while pos < len(self.__tree):
+            self.__tree[pos] += delta
+            pos += pos & -pos
+
+    def get_total(self) -> int:
+        return self.__total
+
+    # The first index where the sum of the weights up to and including it is
+    # greater than target.  target must be in [0, get_total()).
+    def find(self, target: int) -> int:
+        pos = 0
+        bit = self.__top_bit
+        while bit > 0:
+            next_pos = pos + bit
+            if next_pos < len(self.__tree) and \
+               self.__tree[next_pos] <= target:
+                pos = next_pos
+                target -= self.__tree[next_pos]
+            bit //= 2
+
+        return pos
+
+    # Draw an index with probability proportional to its weight.  rng is
+    # the random.Random (or the random module) to draw with.
+    def draw(self, rng=rand) -> int:
+        return self.find(rng.randrange(0, self.get_total()))
+
+    # Draw k indices (with replacement).  The same as calling draw k times.
+    def sample(self, k: int, rng=rand) -> list[int]:
+        total = self.get_total()
+        return [self.find(rng.randrange(0, total)) for i in range(k)]